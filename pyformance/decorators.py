@@ -1,4 +1,5 @@
 import functools
+import inspect
 import sys
 
 import pyformance.registry as global_registry
@@ -10,9 +11,108 @@ def get_qualname(obj):
     return obj.__name__
 
 
+class _MetricHandle(object):
+    """
+    The metric a decorator reports to, resolved once instead of on every call of
+    the decorated function. It is looked up again only when the registry changes,
+    either because set_global_registry swapped it or because it was cleared.
+    """
+
+    def __init__(self, getter_name, metric_name, registry, tags):
+        self.getter_name = getter_name
+        self.metric_name = metric_name
+        self.registry = registry
+        self.tags = tags
+        # (registry, epoch, metric) as a single tuple so threads never see a mix
+        self._bound = (None, None, None)
+
+    def get(self):
+        _registry = self.registry or global_registry._global_registry
+        bound_registry, bound_epoch, metric = self._bound
+        epoch = getattr(_registry, "_epoch", None)
+        if bound_registry is not _registry or bound_epoch != epoch:
+            metric = getattr(_registry, self.getter_name)(self.metric_name, self.tags)
+            self._bound = (_registry, epoch, metric)
+        return metric
+
+
+class _OnEnter(object):
+    """
+    Context manager which runs an action when the wrapped execution starts.
+    """
+
+    def __init__(self, action):
+        self.action = action
+
+    def __enter__(self):
+        self.action()
+
+    def __exit__(self, t, v, tb):
+        pass
+
+
+def _is_deferred(fn):
+    "True if calling fn only creates a coroutine or generator which runs later"
+    return (
+        inspect.iscoroutinefunction(fn)
+        or inspect.isasyncgenfunction(fn)
+        or inspect.isgeneratorfunction(fn)
+    )
+
+
+def _wrap_deferred(fn, context):
+    """
+    Wraps a coroutine function, async generator function or generator function
+    with a function of the same kind, entering C{context()} around the awaited or
+    iterated body rather than around the creation of the coroutine or generator.
+    Everything runs on the caller's thread or event loop.
+    """
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with context():
+                return await fn(*args, **kwargs)
+
+    elif inspect.isasyncgenfunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with context():
+                agen = fn(*args, **kwargs)
+                try:
+                    value = await agen.__anext__()
+                except StopAsyncIteration:
+                    return
+                # forward asend/athrow/aclose, as "yield from" does for generators
+                while True:
+                    try:
+                        sent = yield value
+                    except GeneratorExit:
+                        await agen.aclose()
+                        raise
+                    except BaseException as exc:
+                        try:
+                            value = await agen.athrow(exc)
+                        except StopAsyncIteration:
+                            return
+                    else:
+                        try:
+                            value = await agen.asend(sent)
+                        except StopAsyncIteration:
+                            return
+
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with context():
+                return (yield from fn(*args, **kwargs))
+
+    return wrapper
+
+
 def count_calls(original_func=None, registry=None, tags=None):
     """
     Decorator to track the number of times a function is called.
+    Calls of coroutine functions and generators are counted when they start running.
 
     :param original_func: the function to be decorated
     :type original_func: C{func}
@@ -27,14 +127,15 @@ def count_calls(original_func=None, registry=None, tags=None):
     """
 
     def _decorate(fn):
-        @functools.wraps(fn)
-        def wrapper(*args, **kwargs):
-            function_name = get_qualname(fn)
-            metric_name = "%s_calls" % function_name
+        metric_name = "%s_calls" % get_qualname(fn)
+        handle = _MetricHandle("counter", metric_name, registry, tags)
 
-            _registry = registry or global_registry
-            _histogram = _registry.counter(metric_name, tags).inc()
+        if _is_deferred(fn):
+            return _wrap_deferred(fn, lambda: _OnEnter(handle.get().inc))
 
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            handle.get().inc()
             return fn(*args, **kwargs)
 
         return wrapper
@@ -48,6 +149,7 @@ def count_calls(original_func=None, registry=None, tags=None):
 def meter_calls(original_func=None, registry=None, tags=None):
     """
     Decorator to the rate at which a function is called.
+    Calls of coroutine functions and generators are marked when they start running.
 
     :param original_func: the function to be decorated
     :type original_func: C{func}
@@ -62,14 +164,15 @@ def meter_calls(original_func=None, registry=None, tags=None):
     """
 
     def _decorate(fn):
-        @functools.wraps(fn)
-        def wrapper(*args, **kwargs):
-            function_name = get_qualname(fn)
-            metric_name = "%s_calls" % function_name
+        metric_name = "%s_calls" % get_qualname(fn)
+        handle = _MetricHandle("meter", metric_name, registry, tags)
 
-            _registry = registry or global_registry
-            _histogram = _registry.meter(metric_name, tags).mark()
+        if _is_deferred(fn):
+            return _wrap_deferred(fn, lambda: _OnEnter(handle.get().mark))
 
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            handle.get().mark()
             return fn(*args, **kwargs)
 
         return wrapper
@@ -96,17 +199,28 @@ def hist_calls(original_func=None, registry=None, tags=None):
     :rtype: C{func}
     """
     def _decorate(fn):
+        metric_name = "%s_calls" % get_qualname(fn)
+        handle = _MetricHandle("histogram", metric_name, registry, tags)
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                _histogram = handle.get()
+
+                rtn = await fn(*args, **kwargs)
+                if type(rtn) in (int, float):
+                    _histogram.add(rtn)
+                return rtn
+
+            return wrapper
+
         @functools.wraps(fn)
         def wrapper(*args, **kwargs):
-            function_name = get_qualname(fn)
-            metric_name = "%s_calls" % function_name
-
-            _registry = registry or global_registry
-            _histogram = _registry.histogram(metric_name, tags)
+            _histogram = handle.get()
 
             rtn = fn(*args, **kwargs)
             if type(rtn) in (int, float):
-                _histogram.update(rtn)
+                _histogram.add(rtn)
             return rtn
 
         return wrapper
@@ -120,6 +234,8 @@ def hist_calls(original_func=None, registry=None, tags=None):
 def time_calls(original_func=None, registry=None, tags=None):
     """
     Decorator to time the execution of the function.
+    Coroutine functions and generators are timed until they finish running, not just
+    until the coroutine or generator object is created.
 
     :param original_func: the function to be decorated
     :type original_func: C{func}
@@ -133,15 +249,16 @@ def time_calls(original_func=None, registry=None, tags=None):
     :rtype: C{func}
     """
     def _decorate(fn):
-        @functools.wraps(fn)
-        def wrapper(*args, **kwargs):
-            function_name = get_qualname(fn)
-            metric_name = "%s_calls" % function_name
+        function_name = get_qualname(fn)
+        metric_name = "%s_calls" % function_name
+        handle = _MetricHandle("timer", metric_name, registry, tags)
 
-            _registry = registry or global_registry
-            _timer = _registry.timer(metric_name, tags)
+        if _is_deferred(fn):
+            return _wrap_deferred(fn, lambda: handle.get().time(fn=function_name))
 
-            with _timer.time(fn=function_name):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with handle.get().time(fn=function_name):
                 return fn(*args, **kwargs)
 
         return wrapper
@@ -1,7 +1,7 @@
-from .counter import Counter
-from .meter import Meter
-from .histogram import Histogram
-from .timer import Timer
+from .counter import Counter, StripedCounter
+from .meter import Meter, StripedMeter
+from .histogram import Histogram, StripedHistogram
+from .timer import Timer, StripedTimer
 from .gauge import Gauge, CallbackGauge, SimpleGauge
-from .base_metric import BaseMetric
+from .base_metric import BaseMetric, next_generation
 from .event import Event, EventPoint
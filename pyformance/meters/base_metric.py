@@ -1,9 +1,27 @@
+import itertools
+from threading import Lock
+
+# stamps metric updates; next() on it is atomic, so it needs no lock
+_generations = itertools.count(1)
+
+
+def next_generation():
+    """
+    Returns a generation greater than that of every metric update so far. Taken
+    before a dump, it is the cursor to pass as C{since} to the next dump.
+    """
+    return next(_generations)
+
+
 class BaseMetric(object):
 
     """
     Abstract class for grouping common properties of metrics, such as tags
     """
 
+    # the generation of the last update, see L{next_generation}
+    _generation = 0
+
     def __init__(self, key, tags=None):
         self.key = key
         self.tags = tags or {}
@@ -14,6 +32,22 @@ class BaseMetric(object):
     def get_key(self):
         return self.key
 
+    @property
+    def generation(self):
+        "the generation of the metric's last update"
+        return self._generation
+
+    def _after_fork_in_child(self, reset):
+        """
+        Called in a forked child. Replaces the lock, which another thread of the
+        parent may have held while forking, and clears the values inherited from
+        the parent if C{reset}.
+        """
+        if hasattr(self, "lock"):
+            self.lock = Lock()
+        if reset and hasattr(self, "clear"):
+            self.clear()
+
     def __hash__(self):
         if not self.tags:
             return hash(self.key)
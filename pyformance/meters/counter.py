@@ -1,5 +1,5 @@
-from threading import Lock
-from .base_metric import BaseMetric
+from threading import Lock, current_thread, local
+from .base_metric import BaseMetric, next_generation
 
 
 class Counter(BaseMetric):
@@ -17,6 +17,7 @@ class Counter(BaseMetric):
         "increment counter by val (default is 1)"
         with self.lock:
             self.counter = self.counter + val
+            self._generation = next_generation()
 
     def dec(self, val=1):
         "decrement counter by val (default is 1)"
@@ -30,3 +31,68 @@ class Counter(BaseMetric):
         "reset counter to 0"
         with self.lock:
             self.counter = 0
+            self._generation = next_generation()
+
+
+class StripedCounter(Counter):
+
+    """
+    A counter for hot paths incremented from many threads. Every thread adds to
+    its own cell without taking a lock, and get_count sums the cells, so
+    concurrent increments don't contend on a single lock. Cells of threads which
+    have exited are folded into the total and released. Its generation is
+    only stamped when a read finds the total changed.
+    """
+
+    def __init__(self, key, tags=None):
+        super(StripedCounter, self).__init__(key, tags)
+        self._local = local()
+        self._cells = []
+        self._last_count = 0
+
+    def inc(self, val=1):
+        "increment counter by val (default is 1)"
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._add_cell()
+        # only the owning thread ever writes to its cell
+        cell[0] += val
+
+    def _add_cell(self):
+        cell = [0]
+        with self.lock:
+            self._local.cell = cell
+            self._cells.append((current_thread(), cell))
+        return cell
+
+    def get_count(self):
+        "return current value of counter"
+        with self.lock:
+            live_cells = []
+            for thread, cell in self._cells:
+                if thread.is_alive():
+                    live_cells.append((thread, cell))
+                else:
+                    self.counter += cell[0]
+            self._cells = live_cells
+            count = self.counter + sum(cell[0] for _, cell in live_cells)
+            if count != self._last_count:
+                self._last_count = count
+                self._generation = next_generation()
+            return count
+
+    @property
+    def generation(self):
+        "the generation of the metric's last update"
+        self.get_count()
+        return self._generation
+
+    def clear(self):
+        "reset counter to 0"
+        with self.lock:
+            self.counter = 0
+            self._local = local()
+            self._cells = []
+            self._last_count = 0
+            self._generation = next_generation()
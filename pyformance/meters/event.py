@@ -3,7 +3,7 @@ from dataclasses import dataclass
 from threading import Lock
 from typing import Any, Dict
 
-from .base_metric import BaseMetric
+from .base_metric import BaseMetric, next_generation
 
 
 @dataclass
@@ -49,6 +49,7 @@ class Event(BaseMetric):
                 time=self.clock.time(),
                 values=values
             ))
+            self._generation = next_generation()
 
     def clear(self):
         with self.lock:
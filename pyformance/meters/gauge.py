@@ -1,6 +1,6 @@
 from threading import Lock
 
-from .base_metric import BaseMetric
+from .base_metric import BaseMetric, next_generation
 
 
 class Gauge(BaseMetric):
@@ -24,6 +24,11 @@ class Gauge(BaseMetric):
         "A subclass of Gauge should implement this method"
         raise NotImplementedError()
 
+    @property
+    def generation(self):
+        "a gauge computing its value cannot tell when it changed, so it always did"
+        return next_generation()
+
 
 class CallbackGauge(Gauge):
 
@@ -52,6 +57,12 @@ class SimpleGauge(Gauge):
         super(SimpleGauge, self).__init__(key, tags)
         self.lock = Lock()
         self._value = value
+        self._generation = next_generation()
+
+    @property
+    def generation(self):
+        "the generation of the metric's last update"
+        return self._generation
 
     def get_value(self):
         "getter returns current value"
@@ -61,3 +72,4 @@ class SimpleGauge(Gauge):
         "setter changes current value"
         with self.lock:
             self._value = value
+            self._generation = next_generation()
@@ -1,9 +1,11 @@
 import time
 import math
-from threading import Lock
-from .base_metric import BaseMetric
+from threading import Lock, current_thread, local
+from .base_metric import BaseMetric, next_generation
 from ..stats.samples import ExpDecayingSample, DEFAULT_SIZE, DEFAULT_ALPHA
 
+DEFAULT_BUFFER_SIZE = 1024
+
 
 class Histogram(BaseMetric):
 
@@ -38,12 +40,16 @@ class Histogram(BaseMetric):
         :type value: float
         """
         with self.lock:
-            self.sample.update(value)
-            self.counter = self.counter + 1
-            self.max = value if value > self.max else self.max
-            self.min = value if value < self.min else self.min
-            self.sum = self.sum + value
-            self._update_var(value)
+            self._add(value)
+
+    def _add(self, value):
+        self.sample.update(value)
+        self.counter = self.counter + 1
+        self.max = value if value > self.max else self.max
+        self.min = value if value < self.min else self.min
+        self.sum = self.sum + value
+        self._update_var(value)
+        self._generation = next_generation()
 
     def clear(self):
         "reset histogram to initial state"
@@ -54,6 +60,7 @@ class Histogram(BaseMetric):
             self.min = 2147483647.0
             self.sum = 0.0
             self.var = [-1.0, 0.0]
+            self._generation = next_generation()
 
     def get_count(self):
         "get current value of counter"
@@ -102,3 +109,130 @@ class Histogram(BaseMetric):
             new_m = old_m + ((value - old_m) / self.counter)
             new_s = old_s + ((value - old_m) * (value - new_m))
         self.var = [new_m, new_s]
+
+
+class StripedHistogram(Histogram):
+
+    """
+    A histogram for hot paths updated from many threads. Every thread appends
+    its values to a buffer of its own without taking a lock; the buffers are
+    merged into the histogram whenever it is read, or by the owning thread once
+    its buffer holds C{buffer_size} values. Buffers of threads which have exited
+    are merged and released.
+    """
+
+    def __init__(
+        self,
+        key,
+        size=DEFAULT_SIZE,
+        alpha=DEFAULT_ALPHA,
+        clock=time,
+        sample=None,
+        tags=None,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+    ):
+        self.buffer_size = buffer_size
+        self._local = local()
+        self._cells = []
+        super(StripedHistogram, self).__init__(key, size, alpha, clock, sample, tags)
+
+    def add(self, value):
+        """
+        Add value to histogram
+
+        :type value: float
+        """
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._add_cell()
+        # only the owning thread appends to its buffer
+        cell.append(value)
+        if len(cell) >= self.buffer_size:
+            with self.lock:
+                self._drain(cell)
+
+    def _add_cell(self):
+        cell = []
+        with self.lock:
+            self._local.cell = cell
+            self._cells.append((current_thread(), cell))
+        return cell
+
+    def _drain(self, cell):
+        count = len(cell)
+        values = cell[:count]
+        # values appended meanwhile stay in the buffer
+        del cell[:count]
+        if not values:
+            return
+        update = self.sample.update
+        update_var = self._update_var
+        for value in values:
+            update(value)
+            self.counter += 1
+            update_var(value)
+        self.sum += sum(values)
+        self.max = max(self.max, max(values))
+        self.min = min(self.min, min(values))
+        self._generation = next_generation()
+
+    def collect(self):
+        "merge the buffered values of all threads"
+        with self.lock:
+            live_cells = []
+            for thread, cell in self._cells:
+                # checked first, so a thread cannot append after its buffer was drained
+                alive = thread.is_alive()
+                self._drain(cell)
+                if alive:
+                    live_cells.append((thread, cell))
+            self._cells = live_cells
+
+    @property
+    def generation(self):
+        "the generation of the metric's last update"
+        self.collect()
+        return self._generation
+
+    def clear(self):
+        "reset histogram to initial state"
+        super(StripedHistogram, self).clear()
+        with self.lock:
+            self._local = local()
+            self._cells = []
+
+    def get_count(self):
+        "get current value of counter"
+        self.collect()
+        return self.counter
+
+    def get_sum(self):
+        "get current sum"
+        self.collect()
+        return self.sum
+
+    def get_max(self):
+        "get current maximum"
+        self.collect()
+        return self.max
+
+    def get_min(self):
+        "get current minimum"
+        self.collect()
+        return self.min
+
+    def get_mean(self):
+        "get current mean"
+        self.collect()
+        return super(StripedHistogram, self).get_mean()
+
+    def get_var(self):
+        "get current variance"
+        self.collect()
+        return super(StripedHistogram, self).get_var()
+
+    def get_snapshot(self):
+        "get snapshot instance which holds the percentiles"
+        self.collect()
+        return super(StripedHistogram, self).get_snapshot()
@@ -1,6 +1,6 @@
 import time
-from threading import Lock
-from .base_metric import BaseMetric
+from threading import Lock, current_thread, local
+from .base_metric import BaseMetric, next_generation
 from ..stats.moving_average import ExpWeightedMovingAvg
 
 
@@ -24,6 +24,7 @@ class Meter(BaseMetric):
             self.m1rate = ExpWeightedMovingAvg(period=1, clock=self.clock)
             self.m5rate = ExpWeightedMovingAvg(period=5, clock=self.clock)
             self.m15rate = ExpWeightedMovingAvg(period=15, clock=self.clock)
+            self._generation = next_generation()
 
     def get_one_minute_rate(self):
         return self.m1rate.get_rate()
@@ -45,6 +46,7 @@ class Meter(BaseMetric):
             self.m1rate.add(value)
             self.m5rate.add(value)
             self.m15rate.add(value)
+            self._generation = next_generation()
 
     def get_count(self):
         return self.counter
@@ -57,3 +59,91 @@ class Meter(BaseMetric):
 
     def _convertNsRate(self, ratePerNs):
         return ratePerNs
+
+
+class StripedMeter(Meter):
+
+    """
+    A meter for hot paths marked from many threads. Every thread adds to its
+    own cell without taking a lock; the cells are folded into the count and
+    the moving averages whenever the meter is read. Cells of threads which
+    have exited are folded in and released.
+    """
+
+    def __init__(self, key, clock=time, tags=None):
+        self._local = local()
+        self._cells = []
+        super(StripedMeter, self).__init__(key, clock, tags)
+
+    def clear(self):
+        super(StripedMeter, self).clear()
+        with self.lock:
+            self._local = local()
+            self._cells = []
+
+    def mark(self, value=1):
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._add_cell()
+        # only the owning thread writes the total, only collect writes the folded part
+        cell[0] += value
+
+    def _add_cell(self):
+        # the marks of the thread, and how many of them were folded in already
+        cell = [0, 0]
+        with self.lock:
+            self._local.cell = cell
+            self._cells.append((current_thread(), cell))
+        return cell
+
+    def collect(self):
+        "fold the marks of all threads into the meter"
+        with self.lock:
+            live_cells = []
+            marked = 0
+            for thread, cell in self._cells:
+                # checked first, so a thread cannot mark after its cell was folded
+                alive = thread.is_alive()
+                total = cell[0]
+                marked += total - cell[1]
+                cell[1] = total
+                if alive:
+                    live_cells.append((thread, cell))
+            self._cells = live_cells
+            if marked:
+                self.counter += marked
+                self.m1rate.add(marked)
+                self.m5rate.add(marked)
+                self.m15rate.add(marked)
+                self._generation = next_generation()
+
+    @property
+    def generation(self):
+        "the generation of the metric's last update"
+        self.collect()
+        return self._generation
+
+    def get_one_minute_rate(self):
+        self.collect()
+        return super(StripedMeter, self).get_one_minute_rate()
+
+    def get_five_minute_rate(self):
+        self.collect()
+        return super(StripedMeter, self).get_five_minute_rate()
+
+    def get_fifteen_minute_rate(self):
+        self.collect()
+        return super(StripedMeter, self).get_fifteen_minute_rate()
+
+    def tick(self):
+        self.collect()
+        super(StripedMeter, self).tick()
+
+    def get_count(self):
+        self.collect()
+        return self.counter
+
+    def get_mean_rate(self):
+        self.collect()
+        return super(StripedMeter, self).get_mean_rate()
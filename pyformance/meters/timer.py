@@ -5,8 +5,8 @@ try:
     from blinker import Namespace
 except ImportError:
     Namespace = None
-from .histogram import Histogram, DEFAULT_SIZE, DEFAULT_ALPHA
-from .meter import Meter
+from .histogram import Histogram, StripedHistogram, DEFAULT_SIZE, DEFAULT_ALPHA
+from .meter import Meter, StripedMeter
 
 if Namespace is not None:
     timer_signals = Namespace()
@@ -23,6 +23,9 @@ class Timer(BaseMetric):
 
     """
 
+    meter_class = Meter
+    histogram_class = Histogram
+
     def __init__(
         self,
         key,
@@ -35,8 +38,8 @@ class Timer(BaseMetric):
         tags=None
     ):
         super(Timer, self).__init__(key, tags)
-        self.meter = Meter(key=key, tags=tags, clock=clock)
-        self.hist = Histogram(
+        self.meter = self.meter_class(key=key, tags=tags, clock=clock)
+        self.hist = self.histogram_class(
             key=key,
             tags=tags,
             size=size,
@@ -47,6 +50,11 @@ class Timer(BaseMetric):
         self.sink = sink
         self.threshold = threshold
 
+    @property
+    def generation(self):
+        "the generation of the last update of the internal histogram or meter"
+        return max(self.hist.generation, self.meter.generation)
+
     def get_count(self):
         "get count from internal histogram"
         return self.hist.get_count()
@@ -110,23 +118,41 @@ class Timer(BaseMetric):
         """
         return TimerContext(self, self.meter.clock, *args, **kwargs)
 
+    def _after_fork_in_child(self, reset):
+        self.meter._after_fork_in_child(reset)
+        self.hist._after_fork_in_child(reset)
+
     def clear(self):
         "clear internal histogram and meter"
         self.hist.clear()
         self.meter.clear()
 
 
+class StripedTimer(Timer):
+
+    """
+    A timer for hot paths updated from many threads, recording into a
+    L{StripedMeter} and a L{StripedHistogram} without taking a lock.
+    """
+
+    meter_class = StripedMeter
+    histogram_class = StripedHistogram
+
+
 class TimerContext(object):
     def __init__(self, timer, clock, *args, **kwargs):
         super(TimerContext, self).__init__()
         self.clock = clock
+        # durations are measured on a monotonic high resolution clock when the clock
+        # provides one (the time module does); other clocks fall back to clock.time
+        self._now = getattr(clock, "perf_counter", clock.time)
         self.timer = timer
-        self.start_time = self.clock.time()
+        self.start_time = self._now()
         self.kwargs = kwargs
         self.args = args
 
     def stop(self):
-        elapsed = self.clock.time() - self.start_time
+        elapsed = self._now() - self.start_time
         self.timer._update(elapsed)
         if (
             self.timer.threshold
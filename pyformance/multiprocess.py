@@ -0,0 +1,666 @@
+"""
+Metrics shared by the processes of a pre-fork server.
+
+Every worker uses a L{MultiprocessRegistry}. Its counters, meters and gauges
+keep their values in a memory mapped file per process, so they are visible to
+other processes as soon as they change, and the counts of a worker survive it
+being recycled. Its histograms and timers are kept in the worker in a
+L{DDSketchSample} and written out periodically, since sketches can be merged
+without losing their accuracy.
+
+A single process, usually the one running the reporters, uses a
+L{MultiprocessCollector}: a registry which merges the files of all processes
+whenever it is read, so any reporter can report the aggregated metrics.
+Events and callback gauges are not shared, they only exist in the process
+they were created in.
+"""
+import atexit
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+import weakref
+from pathlib import Path
+from threading import Event as ThreadingEvent, Lock, Thread
+
+from .meters import BaseMetric, Counter, Histogram, Meter, SimpleGauge, Timer, next_generation
+from .registry import FORK_RESET, MetricsRegistry
+from .reporters.segment_writer import _pid_exists
+from .stats.samples import DDSketchSample
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 5
+DEFAULT_RELATIVE_ACCURACY = 0.01
+INITIAL_FILE_SIZE = 64 * 1024
+
+GAUGE_MODES = ("all", "liveall", "sum", "livesum", "max", "min")
+
+_HEADER = struct.Struct("<Q")
+_LENGTH = struct.Struct("<I")
+_VALUE = struct.Struct("<d")
+
+_registries = weakref.WeakSet()
+# registries of one process writing to the same directory share its files
+_open_values = weakref.WeakValueDictionary()
+_open_values_lock = Lock()
+
+
+def _encode_key(metric_type, key, tags, mode=None):
+    return json.dumps([metric_type, key, tags or {}, mode], sort_keys=True).encode("utf-8")
+
+
+def _decode_key(data):
+    metric_type, key, tags, mode = json.loads(data.decode("utf-8"))
+    return metric_type, key, tags, mode
+
+
+class _MmapValues(object):
+    """
+    The values of one process, in a file only that process writes to.
+
+    The file starts with the number of bytes in use, followed by the entries:
+    the length of the key, the key padded to 8 bytes and the value as a
+    double. An entry is written completely before the used size is updated,
+    so readers never see half an entry.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self._file = open(str(path), "a+b")
+        size = os.fstat(self._file.fileno()).st_size
+        if size < INITIAL_FILE_SIZE:
+            self._file.truncate(INITIAL_FILE_SIZE)
+            size = INITIAL_FILE_SIZE
+        self._capacity = size
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._used = _HEADER.unpack_from(self._map, 0)[0] or _HEADER.size
+        self._offsets = {}
+        for key, offset in _read_entries(self._map, self._used):
+            self._offsets[key] = offset
+
+    def slot(self, key):
+        """Returns the offset of the value of a key, adding it with a value of 0."""
+        with self.lock:
+            offset = self._offsets.get(key)
+            if offset is None:
+                offset = self._append(key)
+            return offset
+
+    def _append(self, key):
+        padded = _LENGTH.size + len(key)
+        padded += -padded % 8
+        entry_size = padded + _VALUE.size
+        if self._used + entry_size > self._capacity:
+            capacity = self._capacity
+            while self._used + entry_size > capacity:
+                capacity *= 2
+            self._map.close()
+            self._file.truncate(capacity)
+            self._capacity = capacity
+            self._map = mmap.mmap(self._file.fileno(), capacity)
+        start = self._used
+        _LENGTH.pack_into(self._map, start, len(key))
+        self._map[start + _LENGTH.size:start + _LENGTH.size + len(key)] = key
+        offset = start + padded
+        _VALUE.pack_into(self._map, offset, 0.0)
+        self._used = offset + _VALUE.size
+        _HEADER.pack_into(self._map, 0, self._used)
+        self._offsets[key] = offset
+        return offset
+
+    def get(self, offset):
+        # the map is replaced when the file grows
+        with self.lock:
+            return _VALUE.unpack_from(self._map, offset)[0]
+
+    def set(self, offset, value):
+        with self.lock:
+            _VALUE.pack_into(self._map, offset, value)
+
+    def add(self, offset, value):
+        with self.lock:
+            _VALUE.pack_into(self._map, offset, _VALUE.unpack_from(self._map, offset)[0] + value)
+
+    def close(self):
+        with self.lock:
+            self._map.close()
+            self._file.close()
+
+
+def _values_file(path):
+    with _open_values_lock:
+        values = _open_values.get(path)
+        if values is None:
+            values = _open_values[path] = _MmapValues(path)
+        return values
+
+
+def _read_entries(data, used):
+    """Yields the C{(key, value offset)} of the entries in a values file."""
+    pos = _HEADER.size
+    while pos + _LENGTH.size <= used:
+        length = _LENGTH.unpack_from(data, pos)[0]
+        key = bytes(data[pos + _LENGTH.size:pos + _LENGTH.size + length])
+        padded = _LENGTH.size + length
+        padded += -padded % 8
+        offset = pos + padded
+        if offset + _VALUE.size > used:
+            return
+        yield key, offset
+        pos = offset + _VALUE.size
+
+
+def _read_values(path):
+    """Yields the C{(key, value)} entries of a values file written by any process."""
+    with open(str(path), "rb") as values_file:
+        data = values_file.read()
+    if len(data) < _HEADER.size:
+        return
+    used = min(_HEADER.unpack_from(data, 0)[0], len(data))
+    for key, offset in _read_entries(data, used):
+        yield key, _VALUE.unpack_from(data, offset)[0]
+
+
+def _file_pid(path):
+    try:
+        return int(path.stem.rsplit("_", 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+class _SharedValue(object):
+    """The slot of a single metric in its process' values file."""
+
+    def __init__(self, values, key):
+        self.key = key
+        self.bind(values)
+
+    def bind(self, values):
+        self.values = values
+        self.offset = values.slot(self.key)
+
+    def get(self):
+        return self.values.get(self.offset)
+
+    def set(self, value):
+        self.values.set(self.offset, value)
+
+    def add(self, value):
+        self.values.add(self.offset, value)
+
+
+def _as_count(value):
+    return int(value) if value.is_integer() else value
+
+
+class MultiprocessCounter(Counter):
+    """A L{Counter} whose count is kept in the process' values file."""
+
+    def __init__(self, key, value, tags=None):
+        super(MultiprocessCounter, self).__init__(key, tags)
+        self._shared = value
+
+    def inc(self, val=1):
+        "increment counter by val (default is 1)"
+        self._shared.add(val)
+        self._generation = next_generation()
+
+    def get_count(self):
+        "return the count of this process"
+        return _as_count(self._shared.get())
+
+    def clear(self):
+        "reset counter to 0"
+        self._shared.set(0)
+        self._generation = next_generation()
+
+
+class MultiprocessMeter(Meter):
+    """
+    A L{Meter} whose count is kept in the process' values file. Its rates only
+    cover the marks of this process.
+    """
+
+    def __init__(self, key, value, clock=time, tags=None):
+        self._shared = value
+        super(MultiprocessMeter, self).__init__(key, clock, tags)
+
+    def clear(self):
+        super(MultiprocessMeter, self).clear()
+        self._shared.set(0)
+
+    def mark(self, value=1):
+        super(MultiprocessMeter, self).mark(value)
+        self._shared.add(value)
+
+    def get_count(self):
+        return _as_count(self._shared.get())
+
+
+class MultiprocessGauge(SimpleGauge):
+    """A L{SimpleGauge} whose value is kept in the process' values file."""
+
+    def __init__(self, key, value, default=float("nan"), tags=None):
+        super(MultiprocessGauge, self).__init__(key, default, tags)
+        self._shared = value
+        self._shared.set(default)
+
+    def get_value(self):
+        "getter returns current value"
+        return self._shared.get()
+
+    def set_value(self, value):
+        "setter changes current value"
+        self._shared.set(value)
+        self._generation = next_generation()
+
+
+class MultiprocessRegistry(MetricsRegistry):
+    """
+    The registry of a worker process, whose metrics are aggregated by a
+    L{MultiprocessCollector} reading the same directory.
+
+    Counters, meters and simple gauges are kept in C{counter_<pid>.db} and
+    C{gauge_<pid>.db}. Histograms and timers must use a L{DDSketchSample}
+    (one is created by default); their sketches are written to
+    C{histogram_<pid>.db} every C{flush_interval} seconds, on L{flush} and at
+    exit. The fork policy is always C{"reset"}: a forked child starts with
+    files of its own, zero counts and unset gauges, so it does not count the
+    parent's values again.
+    """
+
+    def __init__(
+            self,
+            path,
+            clock=time,
+            gauge_mode="all",
+            relative_accuracy=DEFAULT_RELATIVE_ACCURACY,
+            flush_interval=DEFAULT_FLUSH_INTERVAL,
+    ):
+        """
+        :param path: the directory shared with the collector; it should be emptied
+                     when the server starts
+        :param gauge_mode: how the collector combines the gauges of the processes:
+                           "all" reports each process' value with a C{pid} tag,
+                           "sum", "max" and "min" combine them, and "liveall" and
+                           "livesum" skip processes which exited
+        :param relative_accuracy: the accuracy of the sketches of histograms and
+                                  timers
+        :param flush_interval: the seconds between writing out histograms
+        """
+        if gauge_mode not in GAUGE_MODES:
+            raise ValueError("Unsupported gauge mode %r" % gauge_mode)
+        super(MultiprocessRegistry, self).__init__(clock, FORK_RESET)
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.gauge_mode = gauge_mode
+        self.relative_accuracy = relative_accuracy
+        self.flush_interval = flush_interval
+        self._flush_lock = Lock()
+        self._flusher = None
+        self._flusher_stopped = None
+        self._open_files()
+        _registries.add(self)
+
+    def _open_files(self):
+        self._pid = os.getpid()
+        self._counter_values = _values_file(self.path / ("counter_%d.db" % self._pid))
+        self._gauge_values = _values_file(self.path / ("gauge_%d.db" % self._pid))
+        self._histogram_path = self.path / ("histogram_%d.db" % self._pid)
+
+    def counter(self, key, tags=None, striped=False):
+        """
+        Gets a counter based on a key, creates a new one if it does not exist.
+        C{striped} is ignored, the count is kept in the values file.
+
+        :return: L{MultiprocessCounter}
+        """
+        metric = self._get_cached(self._counters, key, tags)
+        if metric is not None:
+            return metric
+        return self._get_or_create(
+            self._counters,
+            key,
+            tags,
+            lambda: MultiprocessCounter(
+                key,
+                _SharedValue(self._counter_values, _encode_key("counter", key, tags)),
+                tags=tags,
+            ),
+        )
+
+    def meter(self, key, tags=None):
+        metric = self._get_cached(self._meters, key, tags)
+        if metric is not None:
+            return metric
+        return self._get_or_create(
+            self._meters,
+            key,
+            tags,
+            lambda: MultiprocessMeter(
+                key,
+                _SharedValue(self._counter_values, _encode_key("meter", key, tags)),
+                clock=self._clock,
+                tags=tags,
+            ),
+        )
+
+    def gauge(self, key, gauge=None, default=float("nan"), tags=None):
+        if gauge is not None:
+            # callback gauges cannot be evaluated in another process
+            return super(MultiprocessRegistry, self).gauge(key, gauge, default, tags)
+        metric = self._get_cached(self._gauges, key, tags)
+        if metric is not None:
+            return metric
+        return self._get_or_create(
+            self._gauges,
+            key,
+            tags,
+            lambda: MultiprocessGauge(
+                key,
+                _SharedValue(
+                    self._gauge_values, _encode_key("gauge", key, tags, self.gauge_mode)
+                ),
+                default=default,
+                tags=tags,
+            ),
+        )
+
+    def create_sample(self, sample):
+        if sample is None:
+            return DDSketchSample(relative_accuracy=self.relative_accuracy)
+        if not isinstance(sample, DDSketchSample):
+            raise TypeError("Histograms shared between processes must use a DDSketchSample")
+        return sample
+
+    def histogram(self, key, tags=None, sample=None):
+        self._start_flusher()
+        return super(MultiprocessRegistry, self).histogram(key, tags, sample)
+
+    def timer(self, key, tags=None, sample=None):
+        self._start_flusher()
+        return super(MultiprocessRegistry, self).timer(key, tags, sample)
+
+    def _start_flusher(self):
+        if self._flusher is not None or not self.flush_interval:
+            return
+        self._flusher_stopped = ThreadingEvent()
+        self._flusher = Thread(
+            target=self._flush_loop,
+            args=(self._flusher_stopped,),
+            name="pyformance multiprocess flusher",
+        )
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _flush_loop(self, stopped):
+        while not stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                LOG.exception("Cannot write histograms to %s", self.path)
+
+    def flush(self):
+        """Writes the sketches of this process' histograms and timers."""
+        entries = []
+        for metric_type, metrics in (("histogram", self._histograms), ("timer", self._timers)):
+            for metric_key, metric in list(metrics.items()):
+                histogram = metric.hist if metric_type == "timer" else metric
+                with histogram.lock:
+                    blob = histogram.sample.to_bytes()
+                key = _encode_key(metric_type, metric_key.get_key(), metric_key.get_tags())
+                entries.append(_LENGTH.pack(len(key)) + key + _LENGTH.pack(len(blob)) + blob)
+        if not entries:
+            return
+        with self._flush_lock:
+            temp_path = self._histogram_path.with_name(self._histogram_path.name + ".tmp")
+            with open(str(temp_path), "wb") as histogram_file:
+                histogram_file.write(b"".join(entries))
+            os.replace(str(temp_path), str(self._histogram_path))
+
+    def _after_fork_in_child(self):
+        # the parent's values stay in the parent's files, the child counts from zero
+        self._flush_lock = Lock()
+        self._open_files()
+        for metrics, values in (
+                (self._counters, self._counter_values),
+                (self._meters, self._counter_values),
+                (self._gauges, self._gauge_values),
+        ):
+            for metric in list(metrics.values()):
+                if isinstance(getattr(metric, "_shared", None), _SharedValue):
+                    metric._shared.bind(values)
+        super(MultiprocessRegistry, self)._after_fork_in_child()
+        for metric in list(self._gauges.values()):
+            if isinstance(metric, MultiprocessGauge):
+                metric.set_value(float("nan"))
+        if self._flusher is not None:
+            self._flusher = None
+            self._start_flusher()
+
+    def close(self):
+        """Stops writing out histograms, after writing them a last time."""
+        if self._flusher is not None:
+            self._flusher_stopped.set()
+            self._flusher = None
+        self.flush()
+        _registries.discard(self)
+
+
+def _flush_at_exit():
+    for registry in list(_registries):
+        if registry._pid != os.getpid():
+            continue
+        try:
+            registry.flush()
+        except Exception:
+            LOG.exception("Cannot write histograms to %s", registry.path)
+
+
+atexit.register(_flush_at_exit)
+
+
+def mark_process_dead(pid, path):
+    """
+    Removes the gauges of a process which exited, e.g. from gunicorn's
+    C{child_exit} hook. Its counts and histograms are kept, so totals do not
+    drop when a worker is recycled.
+    """
+    try:
+        os.unlink(os.path.join(str(path), "gauge_%d.db" % pid))
+    except OSError:
+        pass
+
+
+class MultiprocessCollector(MetricsRegistry):
+    """
+    A registry holding the metrics of all the processes writing to a directory.
+
+    The files are read again whenever the registry is collected, i.e. on every
+    C{dump_metrics}. Counters are summed. Meters are summed, with their rates
+    computed from the increase of the total between collections. Gauges are
+    combined as set by the writing registry's C{gauge_mode}. The sketches of
+    histograms and timers are merged; timer rates, like meter rates, follow
+    the total count.
+
+    Metrics registered with the collector itself are reported alongside.
+    """
+
+    def __init__(self, path, clock=time):
+        """
+        :param path: the directory the worker registries write to
+        """
+        super(MultiprocessCollector, self).__init__(clock)
+        self.path = Path(path)
+        self._collected = set()
+        self._collect_lock = Lock()
+
+    def collect(self):
+        with self._collect_lock:
+            counts = {}
+            gauges = {}
+            sketches = {}
+            for values_path in self.path.glob("counter_*.db"):
+                for key, value in self._read(values_path, _read_values):
+                    metric_type, name, tags, _mode = _decode_key(key)
+                    metric_key = (metric_type, BaseMetric(name, tags))
+                    counts[metric_key] = counts.get(metric_key, 0) + value
+            for values_path in self.path.glob("gauge_*.db"):
+                pid = _file_pid(values_path)
+                for key, value in self._read(values_path, _read_values):
+                    _type, name, tags, mode = _decode_key(key)
+                    gauges.setdefault((mode, name, json.dumps(tags, sort_keys=True)), []).append(
+                        (pid, tags, value)
+                    )
+            for histogram_path in self.path.glob("histogram_*.db"):
+                for key, blob in self._read(histogram_path, _read_sketches):
+                    metric_type, name, tags, _mode = _decode_key(key)
+                    metric_key = (metric_type, BaseMetric(name, tags))
+                    sketch = DDSketchSample.from_bytes(blob)
+                    if metric_key in sketches:
+                        sketches[metric_key].merge(sketch)
+                    else:
+                        sketches[metric_key] = sketch
+
+            collected = set()
+            for (metric_type, metric_key), count in counts.items():
+                collected.add((metric_type, metric_key))
+                if metric_type == "meter":
+                    self._update_meter(self._collected_meter(metric_key), count)
+                else:
+                    counter = self._collected_metric(
+                        self._counters, metric_key,
+                        lambda: Counter(metric_key.get_key(), metric_key.get_tags()),
+                    )
+                    count = _as_count(count)
+                    if counter.counter != count:
+                        counter.counter = count
+                        counter._generation = next_generation()
+            for (mode, name, _tags), values in gauges.items():
+                for tags, value in self._combine_gauges(mode, values):
+                    metric_key = BaseMetric(name, tags)
+                    collected.add(("gauge", metric_key))
+                    gauge = self._collected_metric(
+                        self._gauges, metric_key, lambda: SimpleGauge(name, tags=tags)
+                    )
+                    if gauge.get_value() != value:
+                        gauge.set_value(value)
+            for (metric_type, metric_key), sketch in sketches.items():
+                collected.add((metric_type, metric_key))
+                if metric_type == "timer":
+                    timer = self._collected_metric(
+                        self._timers, metric_key,
+                        lambda: Timer(
+                            metric_key.get_key(), clock=self._clock,
+                            sample=DDSketchSample(sketch.relative_accuracy),
+                            tags=metric_key.get_tags(),
+                        ),
+                    )
+                    self._update_histogram(timer.hist, sketch)
+                    self._update_meter(timer.meter, sketch.counter)
+                else:
+                    histogram = self._collected_metric(
+                        self._histograms, metric_key,
+                        lambda: Histogram(
+                            metric_key.get_key(), clock=self._clock,
+                            sample=DDSketchSample(sketch.relative_accuracy),
+                            tags=metric_key.get_tags(),
+                        ),
+                    )
+                    self._update_histogram(histogram, sketch)
+
+            metrics_by_type = {
+                "counter": self._counters, "meter": self._meters, "gauge": self._gauges,
+                "histogram": self._histograms, "timer": self._timers,
+            }
+            for metric_type, metric_key in self._collected - collected:
+                metrics_by_type[metric_type].pop(metric_key, None)
+            self._collected = collected
+            self._handles.clear()
+
+    def _read(self, path, reader):
+        try:
+            return list(reader(path))
+        except (IOError, ValueError, struct.error) as err:
+            # the process may have removed it, or a file may be cut short
+            LOG.debug("Cannot read %s: %s", path, err)
+            return []
+
+    def _collected_meter(self, metric_key):
+        return self._collected_metric(
+            self._meters, metric_key,
+            lambda: Meter(metric_key.get_key(), clock=self._clock, tags=metric_key.get_tags()),
+        )
+
+    @staticmethod
+    def _collected_metric(metrics, metric_key, factory):
+        metric = metrics.get(metric_key)
+        if metric is None:
+            metric = metrics[metric_key] = factory()
+        return metric
+
+    @staticmethod
+    def _update_meter(meter, count):
+        increase = count - meter.get_count()
+        if increase > 0:
+            meter.mark(increase)
+        elif increase < 0:
+            # files of exited processes were removed
+            meter.counter = count
+            meter._generation = next_generation()
+
+    @staticmethod
+    def _update_histogram(histogram, sketch):
+        with histogram.lock:
+            if sketch.counter != histogram.counter or sketch.sum != histogram.sum:
+                histogram._generation = next_generation()
+            histogram.sample = sketch
+            histogram.counter = float(sketch.counter)
+            histogram.sum = sketch.sum
+            if sketch.counter:
+                histogram.min = sketch.min
+                histogram.max = sketch.max
+
+    @staticmethod
+    def _combine_gauges(mode, values):
+        # gauges which were never set hold NaN
+        values = [entry for entry in values if not math.isnan(entry[2])]
+        if mode in ("liveall", "livesum"):
+            values = [entry for entry in values if _pid_exists(entry[0])]
+        if not values:
+            return []
+        if mode in ("all", "liveall"):
+            result = []
+            for pid, tags, value in values:
+                tags = dict(tags)
+                tags["pid"] = str(pid)
+                result.append((tags, value))
+            return result
+        tags = values[0][1]
+        numbers = [value for _pid, _tags, value in values]
+        if mode == "max":
+            return [(tags, max(numbers))]
+        if mode == "min":
+            return [(tags, min(numbers))]
+        return [(tags, sum(numbers))]
+
+
+def _read_sketches(path):
+    """Yields the C{(key, sketch bytes)} entries of a histogram file."""
+    with open(str(path), "rb") as histogram_file:
+        data = histogram_file.read()
+    pos = 0
+    while pos < len(data):
+        length = _LENGTH.unpack_from(data, pos)[0]
+        pos += _LENGTH.size
+        key = data[pos:pos + length]
+        pos += length
+        length = _LENGTH.unpack_from(data, pos)[0]
+        pos += _LENGTH.size
+        yield key, data[pos:pos + length]
+        pos += length
@@ -1,9 +1,22 @@
+import logging
+import os
 import re
 import time
+import weakref
 from typing import Dict
 
 from .meters import BaseMetric, CallbackGauge, Counter, Event, Gauge, Histogram, Meter, \
-    SimpleGauge, Timer
+    SimpleGauge, StripedCounter, StripedHistogram, StripedMeter, StripedTimer, Timer, \
+    next_generation
+
+LOG = logging.getLogger(__name__)
+
+# what a forked child does with the values of the metrics it inherited
+FORK_INHERIT = "inherit"
+FORK_RESET = "reset"
+FORK_POLICIES = (FORK_INHERIT, FORK_RESET)
+
+_registries = weakref.WeakSet()
 
 
 class MetricsRegistry(object):
@@ -12,19 +25,50 @@ class MetricsRegistry(object):
     all the relevant Counters, Meters, Histograms, and Timers. It does not have
     a reference back to its service. The service would create a
     L{MetricsRegistry} to manage all of its metrics tools.
+
+    Repeated lookups of the same metric are served from a handle cache keyed by
+    the metric name and the identity of the tags dict: passing no tags, or the
+    same tags object the metric was created with, skips building a L{BaseMetric}
+    key and hashing its tags. As with L{BaseMetric} itself, a tags dict must not
+    be mutated once it was used to create a metric.
+
+    When the process forks, the child replaces the locks of all metrics, so
+    it cannot deadlock on a lock another thread of the parent held. With the
+    C{"reset"} fork policy the child also clears the counters, meters,
+    histograms, timers and events it inherited, so it does not report the
+    parent's values again; gauges are kept.
+
+    With C{striped} set, counters, meters, histograms and timers are created
+    striped: each thread updates buffers of its own without taking a lock, and
+    the buffers are merged when the metric is read, e.g. by L{dump_metrics}.
     """
 
-    def __init__(self, clock=time):
+    def __init__(self, clock=time, fork_policy=FORK_INHERIT, striped=False):
         """
         Creates a new L{MetricsRegistry} instance.
+
+        :param fork_policy: C{"inherit"} to keep the metric values in forked
+        children, C{"reset"} to clear them
+        :param striped: create striped counters, meters, histograms and timers,
+        for hot paths updated from many threads
         """
+        if fork_policy not in FORK_POLICIES:
+            raise ValueError("Unsupported fork policy %r" % fork_policy)
         self._timers = {}
         self._meters = {}
         self._counters = {}
         self._histograms = {}
         self._gauges = {}
         self._events = {}
+        self._handles = {}
+        # bumped by clear() so holders of metric references know to look them up again
+        self._epoch = 0
         self._clock = clock
+        self.fork_policy = fork_policy
+        self.striped = striped
+        # whether striped metrics were created or added to a registry which is not striped
+        self._has_striped = False
+        _registries.add(self)
 
     def add(self, key, metric, tags=None):
         """
@@ -53,10 +97,38 @@ class MetricsRegistry(object):
                 if metric_key in registry:
                     raise LookupError("Metric %r already registered" % key)
                 registry[metric_key] = metric
+                if isinstance(metric, (StripedCounter, StripedHistogram, StripedMeter, StripedTimer)):
+                    self._has_striped = True
                 return
         raise TypeError("Invalid class. Could not register metric %r" % key)
 
-    def counter(self, key, tags=None):
+    def _get_cached(self, metrics, key, tags):
+        """
+        Returns the metric previously looked up with this key and tags object,
+        or None if it is not in the handle cache.
+        """
+        handle = self._handles.get((key, id(tags), id(metrics)))
+        # the handle keeps a reference to the tags object, so its id can't be reused
+        if handle is not None and handle[0] is tags:
+            return handle[1]
+        return None
+
+    def _get_or_create(self, metrics, key, tags, factory):
+        """
+        Looks up a metric in one of the metric dicts by its L{BaseMetric} key,
+        creating it with C{factory()} if it does not exist yet.
+        """
+        metric_key = BaseMetric(key, tags)
+        metric = metrics.get(metric_key)
+        if metric is None:
+            metric = metrics[metric_key] = factory()
+        # only cache the tags object the metric holds on to anyway, so the cache
+        # never outgrows the registry when callers build a new tags dict per call
+        if tags is None or metric.get_tags() is tags:
+            self._handles[(key, id(tags), id(metrics))] = (tags, metric)
+        return metric
+
+    def counter(self, key, tags=None, striped=False):
         """
         Gets a counter based on a key, creates a new one if it does not exist.
 
@@ -66,14 +138,25 @@ class MetricsRegistry(object):
         :param tags: tags attached to the counter (e.g. {'region': 'us-west-1'})
         :type tags: C{dict}
 
+        :param striped: create a L{StripedCounter}, which avoids lock contention
+        when many threads increment the same counter; always done by a striped
+        registry
+        :type striped: C{bool}
+
         :return: L{Counter}
         """
-        metric_key = BaseMetric(key, tags)
-        if metric_key not in self._counters:
-            self._counters[metric_key] = Counter(key=key, tags=tags)
-        return self._counters[metric_key]
+        metric = self._get_cached(self._counters, key, tags)
+        if metric is not None:
+            return metric
+        counter_class = Counter
+        if striped or self.striped:
+            counter_class = StripedCounter
+            self._has_striped = True
+        return self._get_or_create(
+            self._counters, key, tags, lambda: counter_class(key=key, tags=tags)
+        )
 
-    def histogram(self, key, tags=None):
+    def histogram(self, key, tags=None, sample=None):
         """
         Gets a histogram based on a key, creates a new one if it does not exist.
 
@@ -83,18 +166,31 @@ class MetricsRegistry(object):
         :param tags: tags attached to the histogram (e.g. {'region': 'us-west-1'})
         :type tags: C{dict}
 
+        :param sample: a sample manager, default is ExpDecayingSample
+        :type sample: L{Object}
+
         :return: L{Histogram}
         """
-        metric_key = BaseMetric(key, tags)
-        if metric_key not in self._histograms:
-            self._histograms[metric_key] = Histogram(key=key, clock=self._clock, tags=tags)
-        return self._histograms[metric_key]
+        metric = self._get_cached(self._histograms, key, tags)
+        if metric is not None:
+            return metric
+        return self._get_or_create(
+            self._histograms,
+            key,
+            tags,
+            lambda: (StripedHistogram if self.striped else Histogram)(
+                key=key, clock=self._clock, sample=self.create_sample(sample), tags=tags
+            ),
+        )
 
     def gauge(self, key, gauge=None, default=float("nan"), tags=None):
-        metric_key = BaseMetric(key, tags)
-        if metric_key not in self._gauges:
+        metric = self._get_cached(self._gauges, key, tags)
+        if metric is not None:
+            return metric
+
+        def create_gauge():
             if gauge is None:
-                gauge = SimpleGauge(
+                return SimpleGauge(
                     key=key,
                     value=default,
                     tags=tags
@@ -102,9 +198,10 @@ class MetricsRegistry(object):
             elif not isinstance(gauge, Gauge):
                 if not callable(gauge):
                     raise TypeError("gauge getter not callable")
-                gauge = CallbackGauge(key=key, callback=gauge, tags=tags)
-            self._gauges[metric_key] = gauge
-        return self._gauges[metric_key]
+                return CallbackGauge(key=key, callback=gauge, tags=tags)
+            return gauge
+
+        return self._get_or_create(self._gauges, key, tags, create_gauge)
 
     def meter(self, key, tags=None):
         """
@@ -118,14 +215,28 @@ class MetricsRegistry(object):
 
         :return: L{Meter}
         """
-        metric_key = BaseMetric(key, tags)
-        if metric_key not in self._meters:
-            self._meters[metric_key] = Meter(key=key, clock=self._clock, tags=tags)
-        return self._meters[metric_key]
+        metric = self._get_cached(self._meters, key, tags)
+        if metric is not None:
+            return metric
+        return self._get_or_create(
+            self._meters,
+            key,
+            tags,
+            lambda: (StripedMeter if self.striped else Meter)(
+                key=key, clock=self._clock, tags=tags
+            ),
+        )
 
     def create_sink(self):
         return None
 
+    def create_sample(self, sample):
+        """
+        Returns the sample of a histogram or timer being created, given the one
+        passed in, if any. Only called when the metric does not exist yet.
+        """
+        return sample
+
     def timer(self, key, tags=None, sample=None):
         """
         Gets a timer based on a key, creates a new one if it does not exist.
@@ -141,16 +252,21 @@ class MetricsRegistry(object):
 
         :return: L{Timer}
         """
-        metric_key = BaseMetric(key, tags)
-        if metric_key not in self._timers:
-            self._timers[metric_key] = Timer(
+        metric = self._get_cached(self._timers, key, tags)
+        if metric is not None:
+            return metric
+        return self._get_or_create(
+            self._timers,
+            key,
+            tags,
+            lambda: (StripedTimer if self.striped else Timer)(
                 key=key,
                 clock=self._clock,
                 sink=self.create_sink(),
                 tags=tags,
-                sample=sample,
-            )
-        return self._timers[metric_key]
+                sample=self.create_sample(sample),
+            ),
+        )
 
     def event(self, key: str, tags: Dict[str, str] = None) -> Event:
         """
@@ -159,22 +275,30 @@ class MetricsRegistry(object):
         :param tags: Tags to attach to the metric
         :return: Event object you can add readings to
         """
-        metric_key = BaseMetric(key, tags)
-        if metric_key not in self._events:
-            self._events[metric_key] = Event(
+        metric = self._get_cached(self._events, key, tags)
+        if metric is not None:
+            return metric
+        return self._get_or_create(
+            self._events,
+            key,
+            tags,
+            lambda: Event(
                 clock=self._clock,
                 key=key,
                 tags=tags
-            )
-        return self._events[metric_key]
+            ),
+        )
 
     def clear(self):
+        self._epoch += 1
+        self._handles.clear()
         self._meters.clear()
         self._counters.clear()
         self._gauges.clear()
         self._timers.clear()
         self._events.clear()
         self._histograms.clear()
+        self._has_striped = False
 
     def _get_counter_metrics(self, metric_key):
         if metric_key in self._counters:
@@ -237,14 +361,15 @@ class MetricsRegistry(object):
     def _get_timer_metrics(self, metric_key):
         if metric_key in self._timers:
             timer = self._timers[metric_key]
+            # a single snapshot feeds every statistic, so the sample is sorted once
             snapshot = timer.get_snapshot()
             res = {
-                "avg": timer.get_mean(),
-                "sum": timer.get_sum(),
+                "avg": snapshot.get_mean(),
+                "sum": snapshot.get_sum(),
                 "count": timer.get_count(),
-                "max": timer.get_max(),
-                "min": timer.get_min(),
-                "std_dev": timer.get_stddev(),
+                "max": snapshot.get_max(),
+                "min": snapshot.get_min(),
+                "std_dev": snapshot.get_stddev(),
                 "15m_rate": timer.get_fifteen_minute_rate(),
                 "5m_rate": timer.get_five_minute_rate(),
                 "1m_rate": timer.get_one_minute_rate(),
@@ -270,6 +395,7 @@ class MetricsRegistry(object):
 
         :return: C{dict}
         """
+        self.collect()
         return self._get_metrics_by_metric_key(BaseMetric(key, tags))
 
     def _get_metrics_by_metric_key(self, metric_key):
@@ -285,15 +411,57 @@ class MetricsRegistry(object):
             metrics.update(getter(metric_key))
         return metrics
 
-    def dump_metrics(self, key_is_metric=False):
+    def _after_fork_in_child(self):
+        reset = self.fork_policy == FORK_RESET
+        for metrics in (
+                self._counters,
+                self._histograms,
+                self._meters,
+                self._timers,
+                self._gauges,
+                self._events,
+        ):
+            for metric in list(metrics.values()):
+                metric._after_fork_in_child(reset)
+
+    def collect(self):
+        """
+        Brings the metrics up to date before they are read. Registries which
+        aggregate metrics kept elsewhere override it; reporters which read the
+        metrics without L{dump_metrics} call it first.
+
+        Striped metrics merge their buffers here, which stamps their generation.
+        """
+        if not (self.striped or self._has_striped):
+            return
+        for metrics in (self._counters, self._histograms, self._meters, self._timers):
+            for metric in list(metrics.values()):
+                # noinspection PyStatementEffect
+                metric.generation
+
+    def cursor(self):
+        """
+        Returns the generation to pass as C{since} to a later L{dump_metrics}.
+        The metrics are collected first, so the updates they merge are not
+        dumped again.
+        """
+        self.collect()
+        return next_generation()
+
+    def dump_metrics(self, key_is_metric=False, since=None):
         """
         Formats all of the metrics and returns them as a dict.
 
         :param key_is_metric: True if the resulting dict's keys are the metric objects themselves,
         False if the keys are names only (thus effectively ignoring tags)
+        :param since: only format the metrics updated after this L{cursor},
+        taken before an earlier dump. Gauges
+        computed by a callback are always formatted, and meters left out keep
+        decaying their rates unreported. See L{IncrementalRegistryView}.
 
         :return: C{list} of C{dict} of metrics
         """
+        self.collect()
         metrics = {}
         for metric_type in (
                 self._counters,
@@ -303,7 +471,9 @@ class MetricsRegistry(object):
                 self._gauges,
                 self._events,
         ):
-            for metric_key in metric_type.keys():
+            for metric_key, metric in list(metric_type.items()):
+                if since is not None and metric.generation <= since:
+                    continue
                 if key_is_metric:
                     key = metric_key
                 else:
@@ -318,6 +488,54 @@ class MetricsRegistry(object):
         return metrics
 
 
+class IncrementalRegistryView(object):
+    """
+    Wraps a registry for a reporter, so each report only formats and sends the
+    metrics updated since the previous one. Every C{full_refresh_interval}
+    seconds all metrics are dumped, so that a receiver which missed a report,
+    or expires series it does not hear from, catches up.
+
+    Anything but C{dump_metrics} is passed on to the wrapped registry, so
+    reporters which read the registry directly still see every metric.
+    Reporters sending counts as deltas keep the last count of metrics left out
+    of a dump. The view keeps the cursor of a single reporter, so each
+    reporter needs a view of its own.
+    """
+
+    def __init__(self, registry, full_refresh_interval=300, clock=time):
+        """
+        :param full_refresh_interval: the most seconds between dumps of all
+        metrics; 0 to always dump all of them
+        """
+        self.registry = registry
+        self.full_refresh_interval = full_refresh_interval
+        self.clock = clock
+        self._cursor = None
+        self._refreshed_at = None
+
+    def __getattr__(self, name):
+        return getattr(self.registry, name)
+
+    def dump_metrics(self, key_is_metric=False):
+        """
+        Formats the metrics updated since the previous call, or all of them
+        when a full refresh is due.
+        """
+        now = self.clock.time()
+        since = self._cursor
+        if self._refreshed_at is None or now - self._refreshed_at >= self.full_refresh_interval:
+            since = None
+            self._refreshed_at = now
+        # updates made while dumping get a later generation, so they are dumped
+        # again next time rather than lost
+        self._cursor = self.registry.cursor()
+        return self.registry.dump_metrics(key_is_metric, since=since)
+
+    def refresh(self):
+        "makes the next dump a full one"
+        self._refreshed_at = None
+
+
 # TODO make sure tags are supported properly
 class RegexRegistry(MetricsRegistry):
     """
@@ -330,8 +548,8 @@ class RegexRegistry(MetricsRegistry):
         /api/users/2/edit -> users/edit
     """
 
-    def __init__(self, pattern=None, clock=time):
-        super(RegexRegistry, self).__init__(clock)
+    def __init__(self, pattern=None, clock=time, fork_policy=FORK_INHERIT, striped=False):
+        super(RegexRegistry, self).__init__(clock, fork_policy, striped)
         if pattern is not None:
             self.pattern = re.compile(pattern)
         else:
@@ -345,11 +563,15 @@ class RegexRegistry(MetricsRegistry):
     def timer(self, key, tags=None, sample=None):
         return super(RegexRegistry, self).timer(key=self._get_key(key), tags=tags, sample=sample)
 
-    def histogram(self, key, tags=None):
-        return super(RegexRegistry, self).histogram(key=self._get_key(key), tags=tags)
+    def histogram(self, key, tags=None, sample=None):
+        return super(RegexRegistry, self).histogram(
+            key=self._get_key(key), tags=tags, sample=sample
+        )
 
-    def counter(self, key, tags=None):
-        return super(RegexRegistry, self).counter(key=self._get_key(key), tags=tags)
+    def counter(self, key, tags=None, striped=False):
+        return super(RegexRegistry, self).counter(
+            key=self._get_key(key), tags=tags, striped=striped
+        )
 
     def gauge(self, key, gauge=None, default=float("nan"), tags=None):
         return super(RegexRegistry, self).gauge(
@@ -363,6 +585,18 @@ class RegexRegistry(MetricsRegistry):
         return super(RegexRegistry, self).meter(key=self._get_key(key), tags=tags)
 
 
+def _after_fork_in_child():
+    for registry in list(_registries):
+        # a failure must not leave the other registries with the parent's state
+        try:
+            registry._after_fork_in_child()
+        except Exception:
+            LOG.exception("Cannot reset %r after fork", registry)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
 _global_registry = MetricsRegistry()
 
 
@@ -375,12 +609,12 @@ def set_global_registry(registry):
     _global_registry = registry
 
 
-def counter(key, tags=None):
-    return _global_registry.counter(key, tags)
+def counter(key, tags=None, striped=False):
+    return _global_registry.counter(key, tags, striped=striped)
 
 
-def histogram(key, tags=None):
-    return _global_registry.histogram(key, tags)
+def histogram(key, tags=None, sample=None):
+    return _global_registry.histogram(key, tags, sample=sample)
 
 
 def meter(key, tags=None):
@@ -55,3 +55,27 @@ def OpenTSDBReporter(*args, **kwargs):
     from .opentsdb_reporter import OpenTSDBReporter as cls
 
     return cls(*args, **kwargs)
+
+
+def ReportingScheduler(*args, **kwargs):
+    from .scheduler import ReportingScheduler as cls
+
+    return cls(*args, **kwargs)
+
+
+def PrometheusReporter(*args, **kwargs):
+    from .prometheus import PrometheusReporter as cls
+
+    return cls(*args, **kwargs)
+
+
+def StatsdReporter(*args, **kwargs):
+    from .statsd_reporter import StatsdReporter as cls
+
+    return cls(*args, **kwargs)
+
+
+def OTLPReporter(*args, **kwargs):
+    from .otlp import OTLPReporter as cls
+
+    return cls(*args, **kwargs)
@@ -1,21 +1,39 @@
 # -*- coding: utf-8 -*-
-import contextlib
+import logging
 import pickle
+import random
 import socket
 import struct
 import sys
+from collections import deque
+from itertools import islice
 
 from six import iteritems
 
 from .reporter import Reporter
+from .utils import MAX_UDP_DATAGRAM_SIZE, open_datagram_socket, pack_lines
 
 DEFAULT_CARBON_SERVER = "0.0.0.0"
 DEFAULT_CARBON_PORT = 2003
+DEFAULT_CARBON_TIMEOUT = 5
+DEFAULT_CARBON_MAX_BACKOFF = 60
+DEFAULT_CARBON_MAX_BUFFERED_BYTES = 1024 * 1024
+DEFAULT_CARBON_PICKLE_BATCH_SIZE = 500
+DEFAULT_MAX_DATAGRAM_SIZE = MAX_UDP_DATAGRAM_SIZE
+DROPPED_DATAGRAMS_METRIC = "pyformance.carbon.dropped_datagrams"
+
+LOG = logging.getLogger(__name__)
 
 
 class CarbonReporter(Reporter):
     """
     Carbon is the network daemon to collect metrics for Graphite
+
+    The TCP connection is kept open between reports. When it is lost, the
+    report is sent again on a new connection; if that fails too, reports are
+    buffered (up to C{max_buffered_bytes}) and the reporter waits a jittered,
+    exponentially growing time before connecting again, so a restarting relay
+    is not hit by the whole fleet at once.
     """
 
     def __init__(
@@ -28,80 +46,308 @@ class CarbonReporter(Reporter):
             socket_factory=socket.socket,
             clock=None,
             pickle_protocol=False,
+            timeout=DEFAULT_CARBON_TIMEOUT,
+            max_backoff=DEFAULT_CARBON_MAX_BACKOFF,
+            max_buffered_bytes=DEFAULT_CARBON_MAX_BUFFERED_BYTES,
+            pickle_batch_size=DEFAULT_CARBON_PICKLE_BATCH_SIZE,
     ):
+        """
+        :param timeout: seconds to wait for connecting and for each send
+        :param max_backoff: the longest wait in seconds between connection attempts
+        :param max_buffered_bytes: the most bytes of reports kept while carbon
+                                   cannot be reached; the oldest are dropped
+        :param pickle_batch_size: the most datapoints in one pickle frame
+        """
         super(CarbonReporter, self).__init__(registry, reporting_interval, clock)
         self.prefix = prefix
         self.server = server
         self.port = port
         self.socket_factory = socket_factory
         self.pickle_protocol = pickle_protocol
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.max_buffered_bytes = max_buffered_bytes
+        self.pickle_batch_size = pickle_batch_size
+        self._sock = None
+        self._buffer = deque()
+        self._buffered_bytes = 0
+        self._failures = 0
+        self._retry_at = 0
 
     def report_now(self, registry=None, timestamp=None):
-        metrics = self._collect_metrics(registry or self.registry, timestamp)
-        if metrics:
-            # TODO: keep connection open
-            with contextlib.closing(self.socket_factory()) as sock:
-                sock.connect((self.server, self.port))
-                sock.sendall(metrics)
+        # each pickle frame is sent as soon as it is encoded
+        for payload in self._collect_payloads(registry or self.registry, timestamp):
+            self._buffer_payload(payload)
+            if self.clock.time() >= self._retry_at:
+                self._flush_buffer()
+        if self._buffer and self.clock.time() >= self._retry_at:
+            self._flush_buffer()
+
+    def stop(self):
+        super(CarbonReporter, self).stop()
+        self._disconnect()
+
+    def _after_fork_in_child(self):
+        # the parent keeps its connection and sends what it buffered itself
+        self._disconnect()
+        self._buffer = deque()
+        self._buffered_bytes = 0
+        super(CarbonReporter, self)._after_fork_in_child()
+
+    def _buffer_payload(self, payload):
+        self._buffer.append(payload)
+        self._buffered_bytes += len(payload)
+        dropped = 0
+        while len(self._buffer) > 1 and self._buffered_bytes > self.max_buffered_bytes:
+            old = self._buffer.popleft()
+            self._buffered_bytes -= len(old)
+            dropped += 1
+        if dropped:
+            LOG.warning("Dropped %d buffered reports for %s:%s", dropped, self.server, self.port)
+
+    def _flush_buffer(self):
+        while self._buffer:
+            payload = self._buffer[0]
+            try:
+                self._send(payload)
+            except socket.error as err:
+                self._failures += 1
+                delay = min(self.max_backoff, 2 ** min(self._failures - 1, 30))
+                # half of the delay is random, to spread reconnects of many processes
+                delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+                self._retry_at = self.clock.time() + delay
+                LOG.warning(
+                    "Cannot send to %s:%s, %d reports buffered, retrying in %.1fs: %s",
+                    self.server,
+                    self.port,
+                    len(self._buffer),
+                    delay,
+                    err,
+                )
+                return
+            self._buffer.popleft()
+            self._buffered_bytes -= len(payload)
+        self._failures = 0
+        self._retry_at = 0
+
+    def _send(self, payload):
+        reused = self._sock is not None and self._is_connected(self._sock)
+        if not reused:
+            self._connect()
+        try:
+            self._sock.sendall(payload)
+            return
+        except socket.error:
+            self._disconnect()
+            if not reused:
+                raise
+        # the connection was lost since the last report, send it again on a new one
+        self._connect()
+        try:
+            self._sock.sendall(payload)
+        except socket.error:
+            self._disconnect()
+            raise
+
+    def _connect(self):
+        self._disconnect()
+        sock = self.socket_factory()
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect((self.server, self.port))
+        except socket.error:
+            sock.close()
+            raise
+        self._sock = sock
+
+    def _disconnect(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except socket.error:
+                pass
+            self._sock = None
+
+    def _is_connected(self, sock):
+        try:
+            # the peek must not wait for the socket's timeout
+            sock.settimeout(0)
+            try:
+                # carbon never sends anything, so readable means closed by the peer
+                data = sock.recv(1, socket.MSG_PEEK)
+            finally:
+                sock.settimeout(self.timeout)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except socket.error:
+            return False
+        return bool(data)
 
     def _collect_metrics(self, registry, timestamp=None):
+        return b"".join(self._collect_payloads(registry, timestamp))
+
+    def _collect_payloads(self, registry, timestamp=None):
+        """
+        Yields the report as pickle frames of at most C{pickle_batch_size}
+        datapoints, or as a single plaintext payload.
+        """
         timestamp = timestamp or int(round(self.clock.time()))
         metrics = registry.dump_metrics()
         if self.pickle_protocol:
-            payload = pickle.dumps(
-                [
-                    (
-                        "%s%s.%s" % (self.prefix, metric_name, metric_key),
-                        (timestamp, metric_value),
-                    )
-                    for metric_name, metric in iteritems(metrics)
-                    for metric_key, metric_value in iteritems(metric) if metric_key != "events"
-                ],
-                protocol=2,
-            )
-            header = struct.pack("!L", len(payload))
-            return header + payload
+            for batch in self._pickle_batches(metrics, timestamp):
+                yield self._pickle_frame(batch)
         else:
-            metrics_data = []
-            for metric_name, metric in iteritems(metrics):
-                for metric_key, metric_value in iteritems(metric):
-                    if metric_key != "events":
-                        metric_line = "%s%s.%s %s %s\n" % (
-                            self.prefix,
-                            metric_name,
-                            metric_key,
-                            metric_value,
-                            timestamp,
-                        )
-                        metrics_data.append(metric_line)
-                    else:
-                        for event in metric_value:
-                            for field, value in event.values.items():
-                                metric_line = "%s%s.%s %s %s\n" % (
-                                    self.prefix,
-                                    metric_name,
-                                    field,
-                                    value,
-                                    event.time,
-                                )
-
-                                metrics_data.append(metric_line)
-            result = "".join(metrics_data)
-            if sys.version_info[0] > 2:
-                return result.encode()
-            return result
+            result = "".join(self._plaintext_lines(metrics, timestamp))
+            if result:
+                if sys.version_info[0] > 2:
+                    yield result.encode()
+                else:
+                    yield result
+
+    def _pickle_batches(self, metrics, timestamp):
+        datapoints = (
+            (
+                "%s%s.%s" % (self.prefix, metric_name, metric_key),
+                (timestamp, metric_value),
+            )
+            for metric_name, metric in iteritems(metrics)
+            for metric_key, metric_value in iteritems(metric) if metric_key != "events"
+        )
+        while True:
+            batch = list(islice(datapoints, self.pickle_batch_size))
+            if not batch:
+                return
+            yield batch
+
+    @staticmethod
+    def _pickle_frame(batch):
+        payload = pickle.dumps(batch, protocol=2)
+        return struct.pack("!L", len(payload)) + payload
+
+    def _plaintext_lines(self, metrics, timestamp):
+        metrics_data = []
+        for metric_name, metric in iteritems(metrics):
+            for metric_key, metric_value in iteritems(metric):
+                if metric_key != "events":
+                    metric_line = "%s%s.%s %s %s\n" % (
+                        self.prefix,
+                        metric_name,
+                        metric_key,
+                        metric_value,
+                        timestamp,
+                    )
+                    metrics_data.append(metric_line)
+                else:
+                    for event in metric_value:
+                        for field, value in event.values.items():
+                            metric_line = "%s%s.%s %s %s\n" % (
+                                self.prefix,
+                                metric_name,
+                                field,
+                                value,
+                                event.time,
+                            )
+
+                            metrics_data.append(metric_line)
+        return metrics_data
 
 
 class UdpCarbonReporter(CarbonReporter):
     """
     The default CarbonReporter uses TCP.
     This sub-class uses UDP instead which might be unreliable but it is faster
+
+    Lines, or pickle frames, are packed into datagrams of at most
+    C{max_datagram_size} bytes, sent from one non-blocking socket. A pickle
+    frame holds fewer datapoints than C{pickle_batch_size} when they would not
+    fit, down to a single one. Datagrams which could not be sent are
+    counted in the C{pyformance.carbon.dropped_datagrams} counter of the
+    reporter's registry.
     """
 
+    def __init__(
+            self,
+            registry=None,
+            reporting_interval=5,
+            prefix="",
+            server=DEFAULT_CARBON_SERVER,
+            port=DEFAULT_CARBON_PORT,
+            socket_factory=socket.socket,
+            clock=None,
+            pickle_protocol=False,
+            max_datagram_size=DEFAULT_MAX_DATAGRAM_SIZE,
+    ):
+        """
+        :param max_datagram_size: the most bytes per datagram; the default fits
+                                  an ethernet MTU, avoiding IP fragmentation
+        """
+        super(UdpCarbonReporter, self).__init__(
+            registry,
+            reporting_interval,
+            prefix,
+            server,
+            port,
+            socket_factory,
+            clock,
+            pickle_protocol,
+        )
+        self.max_datagram_size = max_datagram_size
+        self._udp_sock = None
+
     def report_now(self, registry=None, timestamp=None):
-        metrics = self._collect_metrics(registry or self.registry, timestamp)
-        if metrics:
-            with contextlib.closing(
-                    self.socket_factory(socket.AF_INET, socket.SOCK_DGRAM)
-            ) as sock:
-                sock.sendto(metrics, (self.server, self.port))
+        registry = registry or self.registry
+        timestamp = timestamp or int(round(self.clock.time()))
+        if self.pickle_protocol:
+            datagrams = (
+                frame
+                for batch in self._pickle_batches(registry.dump_metrics(), timestamp)
+                for frame in self._fit_pickle_frames(batch)
+            )
+        else:
+            lines = self._plaintext_lines(registry.dump_metrics(), timestamp)
+            datagrams = pack_lines(
+                (line.encode() for line in lines), self.max_datagram_size
+            )
+        dropped = 0
+        for datagram in datagrams:
+            try:
+                self._get_udp_socket().sendto(datagram, (self.server, self.port))
+            except socket.error as err:
+                dropped += 1
+                LOG.debug("Cannot send datagram to %s:%s: %s", self.server, self.port, err)
+        if dropped:
+            self.registry.counter(DROPPED_DATAGRAMS_METRIC).inc(dropped)
+
+    def _fit_pickle_frames(self, batch):
+        """
+        Yields the batch as pickle frames of at most C{max_datagram_size} bytes,
+        splitting it as needed. A single datapoint is sent even if it is larger.
+        """
+        frame = self._pickle_frame(batch)
+        if len(frame) <= self.max_datagram_size or len(batch) == 1:
+            yield frame
+            return
+        # split into about as many parts as datagrams needed, so they come out close to full
+        parts = max(2, -(-len(frame) // self.max_datagram_size))
+        size = -(-len(batch) // parts)
+        for start in range(0, len(batch), size):
+            for part in self._fit_pickle_frames(batch[start:start + size]):
+                yield part
+
+    def _get_udp_socket(self):
+        if self._udp_sock is None:
+            self._udp_sock = open_datagram_socket(self.socket_factory)
+        return self._udp_sock
+
+    def stop(self):
+        super(UdpCarbonReporter, self).stop()
+        self._close_udp_socket()
+
+    def _after_fork_in_child(self):
+        self._close_udp_socket()
+        super(UdpCarbonReporter, self)._after_fork_in_child()
+
+    def _close_udp_socket(self):
+        if self._udp_sock is not None:
+            self._udp_sock.close()
+            self._udp_sock = None
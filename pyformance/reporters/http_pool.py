@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import http.client
+import logging
+import socket
+import time
+from threading import Lock
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_MAX_IDLE = 2
+DEFAULT_BACKOFF = 1
+DEFAULT_MAX_BACKOFF = 60
+
+
+class HTTPPoolError(IOError):
+    """Raised when a request could not be sent, or the pool is backing off."""
+
+
+class HTTPConnectionPool(object):
+    """
+    Keep-alive HTTP(S) connections to a single server.
+
+    Idle connections are reused, so a reporter pays for the TCP connect and the
+    TLS handshake once rather than on every report. A request that fails on a
+    reused connection (the server may have closed it while idle) is retried
+    once on a fresh connection. After a request failed, the pool refuses to
+    connect for a backoff period which doubles with every consecutive failure,
+    so an unreachable server costs one connection attempt per period.
+    """
+
+    def __init__(
+            self,
+            host,
+            port,
+            protocol="http",
+            timeout=DEFAULT_TIMEOUT,
+            max_idle=DEFAULT_MAX_IDLE,
+            backoff=DEFAULT_BACKOFF,
+            max_backoff=DEFAULT_MAX_BACKOFF,
+            ssl_context=None,
+            clock=time,
+    ):
+        """
+        :param protocol: "http" or "https"
+        :param timeout: seconds to wait for connecting and for each socket read
+        :param max_idle: the number of idle connections kept open
+        :param backoff: seconds to wait after the first failure
+        :param max_backoff: the longest wait between connection attempts
+        """
+        if protocol not in ("http", "https"):
+            raise ValueError("Unsupported protocol %r" % protocol)
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.ssl_context = ssl_context
+        self.clock = clock
+        self._idle = []
+        self._lock = Lock()
+        self._failures = 0
+        self._retry_at = 0
+
+    def _new_connection(self):
+        if self.protocol == "https":
+            return http.client.HTTPSConnection(
+                self.host, self.port, timeout=self.timeout, context=self.ssl_context
+            )
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _get_connection(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._new_connection(), False
+
+    def _put_connection(self, connection):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Sends a request and reads the whole response.
+
+        :return: a C{(status, body)} tuple
+        :raise HTTPPoolError: if the request could not be sent or the pool is
+                              backing off after earlier failures
+        """
+        now = self.clock.time()
+        if now < self._retry_at:
+            raise HTTPPoolError(
+                "Backing off from %s:%s for %.1fs"
+                % (self.host, self.port, self._retry_at - now)
+            )
+        connection, reused = self._get_connection()
+        try:
+            try:
+                return self._send(connection, method, path, body, headers)
+            except (http.client.HTTPException, socket.error):
+                connection.close()
+                if not reused:
+                    raise
+            # the idle connection went stale, try once more on a new one
+            connection = self._new_connection()
+            try:
+                return self._send(connection, method, path, body, headers)
+            except (http.client.HTTPException, socket.error):
+                connection.close()
+                raise
+        except (http.client.HTTPException, socket.error) as err:
+            self._failed()
+            raise HTTPPoolError(
+                "Request to %s:%s failed: %s" % (self.host, self.port, err)
+            )
+
+    def _send(self, connection, method, path, body, headers):
+        connection.request(method, path, body, headers or {})
+        response = connection.getresponse()
+        data = response.read()
+        if response.will_close:
+            connection.close()
+        else:
+            self._put_connection(connection)
+        self._failures = 0
+        self._retry_at = 0
+        return response.status, data
+
+    def _failed(self):
+        self._failures += 1
+        delay = min(self.max_backoff, self.backoff * 2 ** min(self._failures - 1, 30))
+        self._retry_at = self.clock.time() + delay
+        LOG.debug(
+            "%s:%s failed %d times in a row, next attempt in %ss",
+            self.host,
+            self.port,
+            self._failures,
+            delay,
+        )
+
+    def _after_fork_in_child(self):
+        """Drops the connections shared with the parent, without closing them for it."""
+        self._lock = Lock()
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            # closes the child's copy of the socket only
+            connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
@@ -1,24 +1,24 @@
 # -*- coding: utf-8 -*-
 
 import base64
+import gzip
 import logging
-import re
+import os
 from pathlib import Path
 
-from six import iteritems
-
 from .utils import ReportingPrecision, to_timestamp_in_precision
 
 try:
-    from urllib2 import quote, urlopen, Request, URLError
+    from urllib2 import quote
+    from urlparse import urlsplit
 except ImportError:
-    from urllib.error import URLError
-    from urllib.parse import quote
-    from urllib.request import urlopen, Request
+    from urllib.parse import quote, urlsplit
 
+from .http_pool import DEFAULT_TIMEOUT, HTTPConnectionPool, HTTPPoolError
+from .line_protocol import LineProtocolEncoder, format_field_value, format_tag_value
 from .reporter import Reporter
-from ..mark_int import MarkInt
-from copy import copy
+from .segment_writer import open_segment
+from .spool import DEFAULT_SPOOL_MAX_BYTES, DiskSpool
 
 LOG = logging.getLogger(__name__)
 
@@ -28,6 +28,8 @@ DEFAULT_INFLUX_DATABASE = "metrics"
 DEFAULT_INFLUX_USERNAME = None
 DEFAULT_INFLUX_PASSWORD = None
 DEFAULT_INFLUX_PROTOCOL = "http"
+DEFAULT_INFLUX_MAX_LINES = 5000
+DEFAULT_SPOOL_REPLAY_RATE = 10000
 
 class InfluxReporter(Reporter):
     """
@@ -50,7 +52,14 @@ class InfluxReporter(Reporter):
             clock=None,
             global_tags=None,
             reporting_precision = ReportingPrecision.SECONDS,
-            retention_policy="autogen"
+            retention_policy="autogen",
+            timeout=DEFAULT_TIMEOUT,
+            max_lines_per_request=DEFAULT_INFLUX_MAX_LINES,
+            max_bytes_per_request=None,
+            gzip_requests=False,
+            spool_path=None,
+            spool_max_bytes=DEFAULT_SPOOL_MAX_BYTES,
+            spool_replay_rate=DEFAULT_SPOOL_REPLAY_RATE,
     ):
         """
         :param reporting_precision: The precision in which the reporter reports to influx.
@@ -58,6 +67,19 @@ class InfluxReporter(Reporter):
         coarse precision may result in significant improvements in compression and vice versa.
         :param retention_policy: The name of the retention policy of your database,
         InluxDB retention policy default value is "autogen".
+        :param timeout: seconds to wait for connecting to influx and for its response.
+        :param max_lines_per_request: the most lines sent in a single write request; a
+        report with more lines is split into several requests. None for no limit.
+        :param max_bytes_per_request: the most bytes of (uncompressed) lines sent in a
+        single write request. None for no limit.
+        :param gzip_requests: compress the request bodies with gzip.
+        :param spool_path: a directory where writes which failed are kept, to be sent again
+        once influx is reachable. None to drop failed writes. Writes influx rejected
+        (4xx responses other than 429) are dropped either way. A forked child spools to
+        a C{child-<pid>} directory inside it.
+        :param spool_max_bytes: the most bytes kept in the spool; the oldest data is dropped
+        beyond it.
+        :param spool_replay_rate: the most spooled lines sent per second of reporting.
         """
         super(InfluxReporter, self).__init__(registry, reporting_interval, clock)
         self.prefix = prefix
@@ -70,7 +92,7 @@ class InfluxReporter(Reporter):
         self.autocreate_database = autocreate_database
         self._did_create_database = False
         self.retention_policy = retention_policy
-        self.reported_files = []
+        self.reported_files = set()
 
         if global_tags is None:
             self.global_tags = {}
@@ -78,26 +100,47 @@ class InfluxReporter(Reporter):
             self.global_tags = global_tags
 
         self.reporting_precision = reporting_precision
+        self._encoder = LineProtocolEncoder()
+        self.max_lines_per_request = max_lines_per_request
+        self.max_bytes_per_request = max_bytes_per_request
+        self.gzip_requests = gzip_requests
+        self.spool_replay_rate = spool_replay_rate
+        if spool_path is None:
+            self._spool = None
+        else:
+            self._spool = DiskSpool(spool_path, max_bytes=spool_max_bytes)
+        self._last_replay_time = None
+        self._pool = HTTPConnectionPool(server, port, protocol, timeout=timeout)
+
+    def _after_fork_in_child(self):
+        self._pool._after_fork_in_child()
+        if self._spool is not None:
+            # the parent keeps replaying its spool, the child spools to a directory
+            # of its own; opening it also replaces the lock the parent may have held
+            self._spool = DiskSpool(
+                self._spool.path / ("child-%d" % os.getpid()),
+                max_bytes=self._spool.max_bytes,
+                segment_bytes=self._spool.segment_bytes,
+            )
+            self._last_replay_time = None
+        super(InfluxReporter, self)._after_fork_in_child()
 
     def _create_database(self):
-        url = "%s://%s:%s/query" % (self.protocol, self.server, self.port)
         q = quote("CREATE DATABASE %s" % self.database)
-        request = Request(url + "?q=" + q)
-        if self.username:
-            auth = _encode_username(self.username, self.password)
-            request.add_header("Authorization", "Basic %s" % auth.decode("utf-8"))
         try:
-            response = urlopen(request)
-            _result = response.read()
-            # Only set if we actually were able to get a successful response
-            self._did_create_database = True
-        except URLError as err:
+            status, _result = self._pool.request(
+                "POST", "/query?q=" + q, headers=self._get_headers()
+            )
+        except HTTPPoolError as err:
+            LOG.warning("Cannot create database %s to %s: %s", self.database, self.server, err)
+            return
+        if status >= 300:
             LOG.warning(
-                "Cannot create database %s to %s: %s",
-                self.database,
-                self.server,
-                err.reason,
+                "Cannot create database %s to %s: HTTP %s", self.database, self.server, status
             )
+            return
+        # Only set if we actually were able to get a successful response
+        self._did_create_database = True
 
     def report_now(self, registry=None, timestamp=None):
         if self.autocreate_database and not self._did_create_database:
@@ -110,54 +153,79 @@ class InfluxReporter(Reporter):
         metrics = (registry or self.registry).dump_metrics(key_is_metric=True)
 
         influx_lines = self._get_influx_protocol_lines(metrics, timestamp_in_reporting_precision)
+        url = self._get_url()
+        sent = failed = 0
         # If you don't have anything nice to say than don't say nothing
-        if influx_lines:
-            post_data = "\n".join(influx_lines)
-            url = self._get_url()
-            self._try_send(url, post_data)
-
-    def _get_table_name(self, metric_key):
-        if not self.prefix:
-            return metric_key
+        for post_data in self._batch_lines(influx_lines):
+            result = self._try_send(url, post_data)
+            if result:
+                sent += 1
+            else:
+                failed += 1
+                # rejected lines would be rejected again, only spool what may succeed later
+                if result is not None and self._spool is not None:
+                    self._spool.append(post_data)
+        if failed:
+            LOG.warning("%d of %d writes to %s failed", failed, sent + failed, self.server)
+        elif self._spool is not None:
+            self._replay_spool(url)
+
+    def _replay_spool(self, url):
+        """Sends spooled lines, at most spool_replay_rate per second since the last replay."""
+        now = self.clock.time()
+        if self._last_replay_time is None:
+            elapsed = self.reporting_interval
         else:
-            return "%s.%s" % (self.prefix, metric_key)
+            elapsed = min(now - self._last_replay_time, self.reporting_interval)
+        self._last_replay_time = now
+        budget = int(self.spool_replay_rate * elapsed)
+        while budget > 0:
+            max_lines = budget
+            if self.max_lines_per_request is not None:
+                max_lines = min(max_lines, self.max_lines_per_request)
+            batch = self._spool.read(max_lines, self.max_bytes_per_request)
+            if batch is None:
+                return
+            post_data, position, lines = batch
+            result = self._try_send(url, post_data)
+            if result is False:
+                return
+            if result is None:
+                LOG.warning("Dropped %d spooled lines rejected by %s", lines, self.server)
+            self._spool.commit(position)
+            budget -= lines
+
+    def _batch_lines(self, lines):
+        """Joins lines into request bodies within the configured size limits."""
+        batch = []
+        batch_bytes = 0
+        for line in lines:
+            line_bytes = len(line.encode("utf-8")) + 1
+            if batch and (
+                    len(batch) == self.max_lines_per_request
+                    or (
+                            self.max_bytes_per_request is not None
+                            and batch_bytes + line_bytes > self.max_bytes_per_request
+                    )
+            ):
+                yield "\n".join(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(line)
+            batch_bytes += line_bytes
+        if batch:
+            yield "\n".join(batch)
 
     def _get_influx_protocol_lines(self, metrics, timestamp):
-        lines = []
-        for key, metric_values in metrics.items():
-            metric_name = key.get_key()
-            table = self._get_table_name(metric_name)
-            values = InfluxReporter._stringify_values(metric_values)
-            tags = self._stringify_tags(key)
-
-            # there's a special case where only events are present, which are skipped by
-            # _stringify_values function
-            if values:
-                line = "%s%s %s %s" % (table, tags, values, timestamp)
-                lines.append(line)
-
-            for event in metric_values.get("events", []):
-                values = InfluxReporter._stringify_values(event.values)
-
-                event_timestamp = to_timestamp_in_precision(
-                    timestamp=event.time,
-                    precision=self.reporting_precision
-                )
-                line = "%s%s %s %s" % (
-                    table,
-                    tags,
-                    values,
-                    event_timestamp
-                )
-
-                lines.append(line)
-
-        return lines
+        return self._encoder.encode(
+            metrics, timestamp, self.reporting_precision, self.prefix, self.global_tags
+        )
 
     def report_from_files(self, files_path: Path) -> None:
         """
         Report to Influx from list of file in a given directory.
-        NOTE: The files in the path must be in line protocol format.
+        NOTE: The files in the path must be in line protocol format. Segments sealed by
+        LineProtocolReporter, compressed or not, are picked up as well.
 
         :param files_path: The path where all the files stored.
         :return: None
@@ -165,86 +233,85 @@ class InfluxReporter(Reporter):
         if not files_path.exists():
             raise FileNotFoundError
 
-        files = [f for f in files_path.glob("*.txt") if f not in self.reported_files]
-
-        for file in files:
-            with open(file, "r") as metrics_file:
-                url = self._get_url()
-                LOG.debug(f"Reporting file {metrics_file.name} with data: {metrics_file.read()}")
-                if self._try_send(url, metrics_file.read()):
-                    self.reported_files.append(file)
-
-    @staticmethod
-    def _stringify_values(metric_values):
-        return ",".join(
-            [
-                "%s=%s" % (k, _format_field_value(v))
-                for (k, v) in iteritems(metric_values) if k != "tags" and k != "events"
-            ]
-        )
-
-    def _stringify_tags(self, metric):
-        # start with the global reporter tags
-        # (copy to avoid mutating to global values)
-        all_tags = copy(self.global_tags)
-
-        # add the local tags on top of those
-        tags = metric.get_tags()
-        all_tags.update(tags)
-
-        if all_tags:
-            return "," + ",".join(
-                [
-                    "%s=%s" % (k, _format_tag_value(v))
-                    for (k, v) in iteritems(all_tags)
-                ]
-            )
-
-        return ""
+        files = set(files_path.glob("*.txt"))
+        files.update(files_path.glob("*.txt.gz"))
+        files.update(files_path.glob("*.txt.xz"))
+        # forget files which were removed, so the set does not grow forever
+        self.reported_files &= files
+
+        url = self._get_url()
+        for file in sorted(files - self.reported_files):
+            LOG.debug("Reporting file %s", file)
+            complete = True
+            with open_segment(file) as metrics_file:
+                lines = (line.rstrip("\n") for line in metrics_file)
+                for post_data in self._batch_lines(line for line in lines if line):
+                    status = self._post(url, post_data)
+                    # a batch rejected as malformed would be rejected again, but one
+                    # too large is accepted once max_bytes_per_request is lowered
+                    if self._is_retryable(status) or status == 413:
+                        complete = False
+                        break
+            # the batches which were written are written again next time, influx
+            # overwrites the same points
+            if complete:
+                self.reported_files.add(file)
 
     def _get_url(self):
         path = "/write?db=%s&precision=%s&rp=%s" % (self.database, self.reporting_precision.value, self.retention_policy)
         return "%s://%s:%s%s" % (self.protocol, self.server, self.port, path)
 
-    def _add_auth_data(self, request):
-        auth = _encode_username(self.username, self.password)
-        request.add_header("Authorization", "Basic %s" % auth.decode('utf-8'))
-
-    def _try_send(self, url, data) -> bool:
-        request = Request(url, data.encode("utf-8"))
+    def _get_headers(self):
+        headers = {}
         if self.username:
-            self._add_auth_data(request)
+            auth = _encode_username(self.username, self.password)
+            headers["Authorization"] = "Basic %s" % auth.decode('utf-8')
+        return headers
+
+    def _try_send(self, url, data):
+        """
+        Returns True if the lines were written, False if writing them may
+        succeed later (the server could not be reached, failed or throttled),
+        and None if the server rejected them, e.g. as malformed.
+        """
+        status = self._post(url, data)
+        if self._is_retryable(status):
+            return False
+        if status >= 300:
+            return None
+        return True
+
+    @staticmethod
+    def _is_retryable(status):
+        "whether a write answered with status, None if influx was not reached, may succeed later"
+        return status is None or status >= 500 or status == 429
+
+    def _post(self, url, data):
+        "writes the lines, returning the HTTP status or None if influx could not be reached"
+        parts = urlsplit(url)
+        path = "%s?%s" % (parts.path, parts.query) if parts.query else parts.path
+        body = data.encode("utf-8")
+        headers = self._get_headers()
+        if self.gzip_requests:
+            body = gzip.compress(body, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
         try:
-            response = urlopen(request)
-            response.read()
-            return True
-        except URLError as err:
-            response = str(err)
+            status, response = self._pool.request("POST", path, body, headers)
+        except HTTPPoolError as err:
+            LOG.warning("Cannot write %d bytes to %s: %s", len(body), url, err)
+            return None
+        if status >= 300:
             LOG.warning(
-                "Cannot write to %s: %s ,url: %s, data: %s, response: %s",
-                self.server,
-                err.reason,
+                "Cannot write %d bytes to %s: HTTP %s, response: %s",
+                len(body),
                 url,
-                data,
-                response
+                status,
+                response[:200]
             )
-            return False
+        return status
 
-def _format_field_value(value):
-    if isinstance(value, MarkInt):
-        return f"{value.value}i"
-    if type(value) is not str:
-        return value
-    else:
-        return '"{}"'.format(value)
-
-
-def _format_tag_value(value):
-    if type(value) is not str:
-        return value
-    else:
-        # Escape special characters
-        return re.sub("([ ,=])", r"\\\1", value)
+_format_field_value = format_field_value
+_format_tag_value = format_tag_value
 
 
 def _encode_username(username, password):
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from ..mark_int import MarkInt
+from .utils import to_timestamp_in_precision
+
+
+def format_field_value(value):
+    if isinstance(value, MarkInt):
+        return "%si" % value.value
+    if type(value) is not str:
+        return value
+    else:
+        return '"{}"'.format(value)
+
+
+def format_tag_value(value):
+    if type(value) is not str:
+        return value
+    else:
+        # Escape special characters
+        return value.replace(" ", "\\ ").replace(",", "\\,").replace("=", "\\=")
+
+
+def format_fields(values):
+    """Formats a metric's values, except its tags and events, as an InfluxDB field set."""
+    fields = []
+    for key, value in values.items():
+        if key == "tags" or key == "events":
+            continue
+        value_type = type(value)
+        if value_type is int or value_type is float:
+            fields.append(key + "=" + repr(value))
+        elif value_type is str:
+            fields.append(key + '="' + value + '"')
+        else:
+            fields.append(key + "=" + str(format_field_value(value)))
+    return ",".join(fields)
+
+
+def format_tags(tags, global_tags=None):
+    """Formats the global tags, overridden by a metric's tags, as C{,key=value,...}."""
+    # start with the global reporter tags, the local tags go on top of those
+    all_tags = dict(global_tags) if global_tags else {}
+    all_tags.update(tags)
+    if not all_tags:
+        return ""
+    return "," + ",".join(
+        "%s=%s" % (key, format_tag_value(value)) for key, value in all_tags.items()
+    )
+
+
+class LineProtocolEncoder(object):
+    """
+    Encodes metrics into InfluxDB line protocol.
+
+    The C{measurement,tags} prefix of each series is built once and cached by
+    metric. The cache is dropped when the prefix or the global tags change,
+    and metrics which were not encoded in the last pass are forgotten.
+    """
+
+    def __init__(self):
+        self._series = {}
+        self._prefix = None
+        self._global_tags = None
+
+    def series(self, metric, prefix="", global_tags=None):
+        """Returns the escaped C{measurement,tags} prefix of a metric's lines."""
+        table = metric.get_key()
+        if prefix:
+            table = "%s.%s" % (prefix, table)
+        return table + format_tags(metric.get_tags(), global_tags)
+
+    def _cached_series(self, metric, prefix, global_tags):
+        entry = self._series.get(id(metric))
+        # the entry holds on to the metric, so its id cannot be reused
+        if entry is None or entry[0] is not metric:
+            entry = (metric, self.series(metric, prefix, global_tags))
+        return entry
+
+    def encode(self, metrics, timestamp, precision, prefix="", global_tags=None):
+        """
+        Yields the lines of a C{dump_metrics(key_is_metric=True)} result.
+
+        :param timestamp: the timestamp of the lines, already in C{precision}
+        :param precision: the L{ReportingPrecision} of event timestamps
+        """
+        global_tags = global_tags or {}
+        if prefix != self._prefix or global_tags != self._global_tags:
+            self._series = {}
+            self._prefix = prefix
+            self._global_tags = dict(global_tags)
+        series_cache = {}
+        timestamp = " %s" % timestamp
+        for metric, metric_values in metrics.items():
+            entry = self._cached_series(metric, prefix, global_tags)
+            series_cache[id(metric)] = entry
+            series = entry[1]
+
+            fields = format_fields(metric_values)
+            # there's a special case where only events are present, which are skipped by
+            # format_fields
+            if fields:
+                yield series + " " + fields + timestamp
+
+            for event in metric_values.get("events", []):
+                event_timestamp = to_timestamp_in_precision(
+                    timestamp=event.time,
+                    precision=precision
+                )
+                yield "%s %s %s" % (series, format_fields(event.values), event_timestamp)
+        self._series = series_cache
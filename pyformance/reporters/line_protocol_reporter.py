@@ -2,17 +2,24 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
-import re
 import time
 import uuid
 
-from six import iteritems
-
+from pyformance.reporters.line_protocol import (
+    LineProtocolEncoder,
+    format_field_value,
+    format_fields,
+    format_tag_value,
+    format_tags,
+)
 from pyformance.reporters.reporter import Reporter
+from pyformance.reporters.segment_writer import (
+    DEFAULT_MAX_SEGMENT_AGE,
+    DEFAULT_MAX_SEGMENT_BYTES,
+    SegmentWriter,
+)
 from pyformance.reporters.utils import to_timestamp_in_precision, ReportingPrecision
 from pyformance.registry import MetricsRegistry
-from pyformance.mark_int import MarkInt
-from copy import copy
 
 LOG = logging.getLogger(__name__)
 
@@ -32,11 +39,20 @@ class LineProtocolReporter(Reporter):
             clock: time = None,
             global_tags: dict = None,
             reporting_precision = ReportingPrecision.SECONDS,
+            segments: bool = False,
+            max_segment_bytes: int = DEFAULT_MAX_SEGMENT_BYTES,
+            max_segment_age: float = DEFAULT_MAX_SEGMENT_AGE,
+            segment_compression: str | None = None,
     ):
         """
         :param reporting_precision: The precision in which the reporter reports.
         The default is seconds. This is a tradeoff between precision and performance. More
         coarse precision may result in significant improvements in compression and vice versa.
+        :param segments: append the reports to rotating segment files (see SegmentWriter)
+        instead of writing a new file per report.
+        :param max_segment_bytes: the size after which a segment is sealed.
+        :param max_segment_age: the seconds after which a segment is sealed.
+        :param segment_compression: None, "gzip" or "lzma" to compress sealed segments.
         """
         super(LineProtocolReporter, self).__init__(registry, reporting_interval, clock)
         self.path = self._set_path(path, path_suffix)
@@ -51,6 +67,28 @@ class LineProtocolReporter(Reporter):
             self.global_tags = global_tags
 
         self.reporting_precision = reporting_precision
+        self._encoder = LineProtocolEncoder()
+
+        if segments:
+            self._segment_writer = SegmentWriter(
+                self.path,
+                max_segment_bytes=max_segment_bytes,
+                max_segment_age=max_segment_age,
+                compression=segment_compression,
+                clock=self.clock,
+            )
+        else:
+            self._segment_writer = None
+
+    def stop(self):
+        super(LineProtocolReporter, self).stop()
+        if self._segment_writer is not None:
+            self._segment_writer.close()
+
+    def _after_fork_in_child(self):
+        if self._segment_writer is not None:
+            self._segment_writer._after_fork_in_child()
+        super(LineProtocolReporter, self)._after_fork_in_child()
 
     def report_now(self, registry=None, timestamp=None) -> None:
         timestamp = timestamp or self.clock.time()
@@ -61,7 +99,9 @@ class LineProtocolReporter(Reporter):
         metrics = (registry or self.registry).dump_metrics(key_is_metric=True)
         influx_lines = self._get_influx_protocol_lines(metrics, timestamp_in_reporting_precision)
 
-        if influx_lines:
+        if self._segment_writer is not None:
+            self._segment_writer.write("\n".join(influx_lines))
+        elif influx_lines:
             with open(f"{self.path}/{uuid.uuid4().hex}.txt", "a") as file:
                 post_data = "\n".join(influx_lines)
                 file.write(post_data)
@@ -73,64 +113,16 @@ class LineProtocolReporter(Reporter):
             return "%s.%s" % (self.prefix, metric_key)
 
     def _get_influx_protocol_lines(self, metrics, timestamp) -> list:
-        lines = []
-        for key, metric_values in metrics.items():
-            metric_name = key.get_key()
-            table = self._get_table_name(metric_name)
-            values = LineProtocolReporter._stringify_values(metric_values)
-            tags = self._stringify_tags(key)
-
-            # there's a special case where only events are present, which are skipped by
-            # _stringify_values function
-            if values:
-                line = "%s%s %s %s" % (table, tags, values, timestamp)
-                lines.append(line)
-
-            for event in metric_values.get("events", []):
-                values = LineProtocolReporter._stringify_values(event.values)
-
-                event_timestamp = to_timestamp_in_precision(
-                    timestamp=event.time,
-                    precision=self.reporting_precision
-                )
-                line = "%s%s %s %s" % (
-                    table,
-                    tags,
-                    values,
-                    event_timestamp
-                )
-
-                lines.append(line)
-
-        return lines
+        return list(self._encoder.encode(
+            metrics, timestamp, self.reporting_precision, self.prefix, self.global_tags
+        ))
 
     @staticmethod
     def _stringify_values(metric_values) -> str:
-        return ",".join(
-            [
-                "%s=%s" % (k, _format_field_value(v))
-                for (k, v) in iteritems(metric_values) if k != "tags" and k != "events"
-            ]
-        )
+        return format_fields(metric_values)
 
     def _stringify_tags(self, metric) -> str:
-        # start with the global reporter tags
-        # (copy to avoid mutating to global values)
-        all_tags = copy(self.global_tags)
-
-        # add the local tags on top of those
-        tags = metric.get_tags()
-        all_tags.update(tags)
-
-        if all_tags:
-            return "," + ",".join(
-                [
-                    "%s=%s" % (k, _format_tag_value(v))
-                    for (k, v) in iteritems(all_tags)
-                ]
-            )
-
-        return ""
+        return format_tags(metric.get_tags(), self.global_tags)
 
     @staticmethod
     def _set_path(path: str | None, path_suffix: str | None) -> str:
@@ -142,18 +134,6 @@ class LineProtocolReporter(Reporter):
         os.environ["METRICS_REPORTER_FOLDER_PATH"] = path
         return path
 
-def _format_field_value(value) -> str:
-    if isinstance(value, MarkInt):
-        return f"{value.value}i"
-    if type(value) is not str:
-        return value
-    else:
-        return '"{}"'.format(value)
-
-
-def _format_tag_value(value) -> str:
-    if type(value) is not str:
-        return value
-    else:
-        # Escape special characters
-        return re.sub("([ ,=])", r"\\\1", value)
+
+_format_field_value = format_field_value
+_format_tag_value = format_tag_value
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import logging
+import math
+
+from ..stats.samples import DDSketchSample
+from .http_pool import DEFAULT_TIMEOUT, HTTPConnectionPool, HTTPPoolError
+from .reporter import Reporter
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_OTLP_SERVER = "127.0.0.1"
+DEFAULT_OTLP_PORT = 4318
+DEFAULT_OTLP_PROTOCOL = "http"
+DEFAULT_OTLP_PATH = "/v1/metrics"
+DEFAULT_OTLP_MAX_METRICS = 1000
+
+SCOPE_NAME = "pyformance"
+QUANTILES = (0.5, 0.75, 0.95, 0.99, 0.999)
+# AGGREGATION_TEMPORALITY_CUMULATIVE in the OTLP protocol
+CUMULATIVE = 2
+# the scale range allowed for exponential histograms
+MIN_SCALE = -10
+MAX_SCALE = 20
+
+
+def _attributes(tags):
+    attributes = []
+    for key, value in tags.items():
+        if isinstance(value, bool):
+            any_value = {"boolValue": value}
+        elif isinstance(value, int):
+            # 64 bit integers are strings in the JSON encoding
+            any_value = {"intValue": str(value)}
+        elif isinstance(value, float):
+            any_value = {"doubleValue": value}
+        else:
+            any_value = {"stringValue": str(value)}
+        attributes.append({"key": str(key), "value": any_value})
+    return attributes
+
+
+def _is_finite(value):
+    return not (math.isnan(value) or math.isinf(value))
+
+
+def _number(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return {"asInt": str(value)}
+    return {"asDouble": float(value)}
+
+
+def _exponential_buckets(buckets, sketch, scale):
+    """
+    Moves the buckets of one sign of a sketch to exponential histogram buckets
+    of the given scale, by the value each sketch bucket stands for.
+    """
+    if not buckets:
+        return {"offset": 0, "bucketCounts": []}
+    log_base = math.log(2) * 2 ** -scale
+    counts = {}
+    for index, count in buckets.items():
+        # noinspection PyProtectedMember
+        value = sketch._value_at(index)
+        # bucket i holds the values in (base ** i, base ** (i + 1)]
+        target = int(math.ceil(math.log(value) / log_base)) - 1
+        counts[target] = counts.get(target, 0) + count
+    offset = min(counts)
+    return {
+        "offset": offset,
+        "bucketCounts": [str(counts.get(i, 0)) for i in range(offset, max(counts) + 1)],
+    }
+
+
+def sketch_to_exponential_histogram(sketch):
+    """
+    Converts a L{DDSketchSample} to the fields of an OTLP exponential histogram
+    data point.
+
+    The scale is the finest whose buckets are at least as wide as the sketch's,
+    so every sketch bucket lands in a single exponential bucket and the
+    relative error stays within twice the sketch's accuracy.
+    """
+    scale = int(math.floor(math.log(math.log(2) / math.log(sketch.gamma), 2)))
+    scale = max(MIN_SCALE, min(MAX_SCALE, scale))
+    point = {
+        "count": str(sketch.counter),
+        "sum": sketch.sum,
+        "scale": scale,
+        "zeroCount": str(sketch.zero_count),
+        "positive": _exponential_buckets(sketch.positive, sketch, scale),
+        "negative": _exponential_buckets(sketch.negative, sketch, scale),
+    }
+    if sketch.counter:
+        point["min"] = sketch.min
+        point["max"] = sketch.max
+    return point
+
+
+class OTLPReporter(Reporter):
+    """
+    Exports the registry as OpenTelemetry metrics, in the OTLP/HTTP JSON
+    encoding, to a collector.
+
+    Tags become data point attributes. Counters and meters are exported as
+    cumulative monotonic sums, gauges as gauges, and histograms and timers as
+    summaries, or as exponential histograms if they are backed by a
+    L{DDSketchSample}. Events are not exported.
+
+    Like L{PrometheusReporter} it reads the registry directly, since the types
+    and sketches of the metrics are not part of C{dump_metrics}; it therefore
+    needs a L{MetricsRegistry} rather than the collections of a
+    L{ReportingScheduler}.
+    """
+
+    def __init__(
+            self,
+            registry=None,
+            reporting_interval=10,
+            prefix="",
+            server=DEFAULT_OTLP_SERVER,
+            port=DEFAULT_OTLP_PORT,
+            protocol=DEFAULT_OTLP_PROTOCOL,
+            path=DEFAULT_OTLP_PATH,
+            headers=None,
+            resource_attributes=None,
+            timeout=DEFAULT_TIMEOUT,
+            max_metrics_per_request=DEFAULT_OTLP_MAX_METRICS,
+            gzip_requests=True,
+            exponential_histograms=True,
+            clock=None,
+    ):
+        """
+        :param headers: extra request headers, e.g. for authentication
+        :param resource_attributes: attributes of the exporting resource, such as
+                                    C{{"service.name": "api"}}
+        :param max_metrics_per_request: the most metrics sent in a single request;
+                                        None for no limit
+        :param gzip_requests: compress the request bodies with gzip
+        :param exponential_histograms: export histograms backed by a
+                                       L{DDSketchSample} as exponential histograms
+        """
+        super(OTLPReporter, self).__init__(registry, reporting_interval, clock)
+        self.prefix = prefix
+        self.server = server
+        self.port = port
+        self.path = path
+        self.headers = headers or {}
+        self.resource_attributes = resource_attributes or {}
+        self.max_metrics_per_request = max_metrics_per_request
+        self.gzip_requests = gzip_requests
+        self.exponential_histograms = exponential_histograms
+        self._start_times = {}
+        self._pool = HTTPConnectionPool(server, port, protocol, timeout=timeout)
+
+    def report_now(self, registry=None, timestamp=None):
+        timestamp = timestamp or self.clock.time()
+        metrics = self._get_otlp_metrics(registry or self.registry, timestamp)
+        sent = failed = 0
+        for batch in self._batch_metrics(metrics):
+            if self._try_send(self._get_request(batch)):
+                sent += 1
+            else:
+                failed += 1
+        if failed:
+            LOG.warning("%d of %d exports to %s failed", failed, sent + failed, self.server)
+
+    def stop(self):
+        super(OTLPReporter, self).stop()
+        self._pool.close()
+
+    def _after_fork_in_child(self):
+        self._pool._after_fork_in_child()
+        super(OTLPReporter, self)._after_fork_in_child()
+
+    def _batch_metrics(self, metrics):
+        batch = []
+        for metric in metrics:
+            if batch and len(batch) == self.max_metrics_per_request:
+                yield batch
+                batch = []
+            batch.append(metric)
+        if batch:
+            yield batch
+
+    def _get_request(self, metrics):
+        return {
+            "resourceMetrics": [
+                {
+                    "resource": {"attributes": _attributes(self.resource_attributes)},
+                    "scopeMetrics": [{"scope": {"name": SCOPE_NAME}, "metrics": metrics}],
+                }
+            ]
+        }
+
+    def _name(self, key):
+        if self.prefix:
+            return "%s.%s" % (self.prefix, key)
+        return key
+
+    def _get_otlp_metrics(self, registry, timestamp):
+        registry.collect()
+        now = "%d" % (timestamp * 1e9)
+        start_times = self._start_times
+        self._start_times = {}
+
+        def point(metric_key, total, **fields):
+            # a cumulative series starts when it was first exported, or when its
+            # total was last found to be reset
+            start, last_total = start_times.get(metric_key, (timestamp, total))
+            if total < last_total:
+                start = timestamp
+            self._start_times[metric_key] = (start, total)
+            fields["attributes"] = _attributes(metric_key.get_tags())
+            fields["startTimeUnixNano"] = "%d" % (start * 1e9)
+            fields["timeUnixNano"] = now
+            return fields
+
+        def monotonic_sum(metric_key, count):
+            data_point = point(metric_key, count, **_number(count))
+            return {
+                "name": self._name(metric_key.get_key()),
+                "sum": {
+                    "dataPoints": [data_point],
+                    "aggregationTemporality": CUMULATIVE,
+                    "isMonotonic": True,
+                },
+            }
+
+        metrics = []
+        # noinspection PyProtectedMember
+        for metric_key, counter in list(registry._counters.items()):
+            metrics.append(monotonic_sum(metric_key, counter.get_count()))
+        # noinspection PyProtectedMember
+        for metric_key, meter in list(registry._meters.items()):
+            metrics.append(monotonic_sum(metric_key, meter.get_count()))
+        # noinspection PyProtectedMember
+        for metric_key, gauge in list(registry._gauges.items()):
+            value = gauge.get_value()
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if not _is_finite(value):
+                continue
+            metrics.append({
+                "name": self._name(metric_key.get_key()),
+                "gauge": {"dataPoints": [
+                    dict(
+                        _number(value),
+                        attributes=_attributes(metric_key.get_tags()),
+                        timeUnixNano=now,
+                    )
+                ]},
+            })
+        # noinspection PyProtectedMember
+        for metric_key, histogram, unit in [
+            (metric_key, histogram, None)
+            for metric_key, histogram in list(registry._histograms.items())
+        ] + [
+            (metric_key, timer.hist, "s")
+            for metric_key, timer in list(registry._timers.items())
+        ]:
+            metric = {"name": self._name(metric_key.get_key())}
+            if unit:
+                metric["unit"] = unit
+            if self.exponential_histograms and isinstance(histogram.sample, DDSketchSample):
+                with histogram.lock:
+                    fields = sketch_to_exponential_histogram(histogram.sample)
+                metric["exponentialHistogram"] = {
+                    "dataPoints": [point(metric_key, int(fields["count"]), **fields)],
+                    "aggregationTemporality": CUMULATIVE,
+                }
+            else:
+                count = int(histogram.get_count())
+                quantiles = []
+                if count:
+                    snapshot = histogram.get_snapshot()
+                    quantiles = [
+                        {"quantile": quantile, "value": snapshot.get_percentile(quantile)}
+                        for quantile in QUANTILES
+                    ]
+                metric["summary"] = {"dataPoints": [
+                    point(
+                        metric_key,
+                        count,
+                        count=str(count),
+                        sum=histogram.get_sum(),
+                        quantileValues=quantiles,
+                    )
+                ]}
+            metrics.append(metric)
+        return metrics
+
+    def _try_send(self, request):
+        body = json.dumps(request, separators=(",", ":")).encode("utf-8")
+        headers = dict(self.headers)
+        headers["Content-Type"] = "application/json"
+        if self.gzip_requests:
+            body = gzip.compress(body, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+        try:
+            status, response = self._pool.request("POST", self.path, body, headers)
+        except HTTPPoolError as err:
+            LOG.warning("Cannot export %d bytes to %s: %s", len(body), self.server, err)
+            return False
+        if status >= 300:
+            LOG.warning(
+                "Cannot export %d bytes to %s: HTTP %s, response: %s",
+                len(body),
+                self.server,
+                status,
+                response[:200],
+            )
+            return False
+        self._log_partial_success(response)
+        return True
+
+    def _log_partial_success(self, response):
+        try:
+            partial = json.loads(response.decode("utf-8") or "{}").get("partialSuccess")
+        except (ValueError, AttributeError):
+            return
+        if partial and int(partial.get("rejectedDataPoints") or 0):
+            LOG.warning(
+                "%s rejected %s data points: %s",
+                self.server,
+                partial["rejectedDataPoints"],
+                partial.get("errorMessage", ""),
+            )
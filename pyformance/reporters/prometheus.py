@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+import logging
+import math
+import os
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+from ..stats.samples import DDSketchSample, HdrHistogramSample
+from .reporter import Reporter
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_PROMETHEUS_HOST = ""
+DEFAULT_PROMETHEUS_PORT = 9464
+DEFAULT_MIN_REFRESH_INTERVAL = 1
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+QUANTILES = (0.5, 0.75, 0.95, 0.99, 0.999)
+# the default buckets of the Prometheus client libraries, for latencies in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1, 2.5, 5, 7.5, 10)
+# samples whose buckets count every value since they were cleared
+CUMULATIVE_SAMPLES = (DDSketchSample, HdrHistogramSample)
+# the names of the samples of each type of family, after the family name
+_SAMPLE_SUFFIXES = {
+    "counter": ("",),
+    "gauge": ("",),
+    "summary": ("", "_sum", "_count"),
+    "histogram": ("_bucket", "_sum", "_count"),
+}
+
+_INVALID_NAME_CHARS = re.compile(r"[^a-zA-Z0-9_:]")
+_INVALID_LABEL_CHARS = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _format_name(name):
+    name = _INVALID_NAME_CHARS.sub("_", name)
+    if name[:1].isdigit():
+        name = "_" + name
+    return name
+
+
+def _format_labels(tags, extra=None):
+    labels = [
+        '%s="%s"' % (
+            _INVALID_LABEL_CHARS.sub("_", str(key)),
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for key, value in tags.items()
+    ]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(labels)
+
+
+def _format_value(value):
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+class PrometheusReporter(Reporter):
+    """
+    Serves the registry in the Prometheus text exposition format, to be
+    scraped rather than pushing.
+
+    Tags become labels. Counters and gauges are exposed as gauges (a counter
+    can be decremented), meters as counters named C{<name>_total}. Histograms
+    and timers backed by a L{HdrHistogramSample} or L{DDSketchSample}, which
+    count every value until cleared, are exposed as histograms with the bounds
+    in C{buckets}; the values of a sample bucket are counted by the value it
+    stands for. Other histograms and timers only hold a reservoir of values
+    and are exposed as summaries. Events are not exposed.
+
+    A metric whose name, once sanitized, clashes with a metric of another type
+    or with the samples of a histogram or summary (such as C{<name>_count}) is
+    left out with a warning, since Prometheus would reject the whole page.
+
+    The registry is read directly, without C{dump_metrics}, so events stay
+    available to other reporters. The rendered page is cached for
+    C{min_refresh_interval} seconds, so concurrent scrapers share one render.
+    """
+
+    def __init__(
+            self,
+            registry=None,
+            host=DEFAULT_PROMETHEUS_HOST,
+            port=DEFAULT_PROMETHEUS_PORT,
+            namespace="",
+            min_refresh_interval=DEFAULT_MIN_REFRESH_INTERVAL,
+            buckets=DEFAULT_BUCKETS,
+            clock=None,
+    ):
+        """
+        :param host: the address to listen on, all interfaces by default
+        :param port: the port to listen on; 0 picks a free one. Only a reporter on
+        port 0 serves again in forked children with C{restart_after_fork}, the
+        parent keeps any other port.
+        :param namespace: prepended to every metric name
+        :param min_refresh_interval: the seconds a rendered page is served for
+        :param buckets: the upper bounds of the histogram buckets, +Inf is added
+        """
+        super(PrometheusReporter, self).__init__(registry, min_refresh_interval, clock)
+        self.host = host
+        self.port = port
+        self.namespace = namespace
+        self.min_refresh_interval = min_refresh_interval
+        self.buckets = sorted(float(bound) for bound in buckets)
+        self._clashes = set()
+        self._render_lock = Lock()
+        self._rendered = None
+        self._rendered_at = None
+        self._server = None
+        self._server_thread = None
+
+    @property
+    def server_address(self):
+        """The C{(host, port)} the server listens on, once started."""
+        if self._server is None:
+            return None
+        return self._server.server_address
+
+    def start(self):
+        if self._stopped.is_set() or self._server is not None:
+            return False
+        self._server = _PrometheusServer((self.host, self.port), self)
+        self._server_thread = Thread(
+            target=self._server.serve_forever, name="pyformance prometheus server"
+        )
+        self._server_thread.daemon = True
+        self._server_thread.start()
+        return True
+
+    def stop(self):
+        super(PrometheusReporter, self).stop()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _after_fork_in_child(self):
+        server = self._server
+        self._server = None
+        self._render_lock = Lock()
+        super(PrometheusReporter, self)._after_fork_in_child()
+        if server is None:
+            return
+        # closes the child's copy of the listening socket, the parent keeps serving
+        server.socket.close()
+        if self.restart_after_fork and not self._stopped.is_set():
+            if self.port:
+                # the parent still listens on it
+                LOG.warning(
+                    "Not serving metrics in forked child %d, port %d is the parent's",
+                    os.getpid(), self.port,
+                )
+            else:
+                self.start()
+
+    def report_now(self, registry=None, timestamp=None):
+        """Renders the registry now, refreshing the cached page."""
+        with self._render_lock:
+            self._rendered = self._render(registry or self.registry)
+            self._rendered_at = self.clock.time()
+            return self._rendered
+
+    def render(self):
+        """Returns the page, rendering it again if the cached one is too old."""
+        with self._render_lock:
+            now = self.clock.time()
+            if self._rendered is None or now - self._rendered_at >= self.min_refresh_interval:
+                self._rendered = self._render(self.registry)
+                self._rendered_at = now
+            return self._rendered
+
+    def _name(self, key):
+        if self.namespace:
+            key = "%s_%s" % (self.namespace, key)
+        return _format_name(key)
+
+    def _render(self, registry):
+        registry.collect()
+        families = {}
+        # the family each sample name belongs to, to find clashing names
+        sample_names = {}
+        series = set()
+
+        def family(metric_type, key, metric_key):
+            """
+            Returns the name and sample lines of the family to add a metric to,
+            or None if the metric clashes with one added before.
+            """
+            name = self._name(key)
+            labels = _format_labels(metric_key.get_tags())
+            lines = None
+            if name not in families:
+                names = [name + suffix for suffix in _SAMPLE_SUFFIXES[metric_type]]
+                if not any(sample_name in sample_names for sample_name in names):
+                    families[name] = (metric_type, [])
+                    sample_names.update((sample_name, name) for sample_name in names)
+            if families.get(name, (None,))[0] == metric_type and (name, labels) not in series:
+                series.add((name, labels))
+                lines = families[name][1]
+            if lines is None:
+                if (metric_type, name) not in self._clashes:
+                    self._clashes.add((metric_type, name))
+                    LOG.warning(
+                        "Skipping %s %s, its name clashes with another metric", metric_type, name
+                    )
+                return None
+            return name, lines
+
+        def sample(lines, name, metric_key, suffix, value, extra_label=None):
+            lines.append(
+                "%s%s%s %s" % (
+                    name, suffix, _format_labels(metric_key.get_tags(), extra_label),
+                    _format_value(value),
+                )
+            )
+
+        # noinspection PyProtectedMember
+        for metric_type, metric_key, value in [
+            ("gauge", metric_key, counter.get_count())
+            for metric_key, counter in list(registry._counters.items())
+        ] + [
+            ("gauge", metric_key, gauge.get_value())
+            for metric_key, gauge in list(registry._gauges.items())
+        ]:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            target = family(metric_type, metric_key.get_key(), metric_key)
+            if target is not None:
+                sample(target[1], target[0], metric_key, "", value)
+        # noinspection PyProtectedMember
+        for metric_key, meter in list(registry._meters.items()):
+            target = family("counter", metric_key.get_key() + "_total", metric_key)
+            if target is not None:
+                sample(target[1], target[0], metric_key, "", meter.get_count())
+        # noinspection PyProtectedMember
+        for metric_key, histogram in list(registry._histograms.items()) + [
+            (metric_key, timer.hist) for metric_key, timer in list(registry._timers.items())
+        ]:
+            if isinstance(histogram.sample, CUMULATIVE_SAMPLES):
+                target = family("histogram", metric_key.get_key(), metric_key)
+                if target is None:
+                    continue
+                name, lines = target
+                # striped buffers were merged by collect(), the sample is read as is
+                with histogram.lock:
+                    snapshot = histogram.sample.get_snapshot()
+                count = 0
+                values = iter(snapshot.buckets)
+                pending = next(values, None)
+                for bound in self.buckets:
+                    while pending is not None and pending[0] <= bound:
+                        count += pending[1]
+                        pending = next(values, None)
+                    sample(
+                        lines, name, metric_key, "_bucket", count,
+                        'le="%s"' % _format_value(bound),
+                    )
+                # the count must match the +Inf bucket, so both come from the snapshot
+                count = sum(bucket_count for _, bucket_count in snapshot.buckets)
+                sample(lines, name, metric_key, "_bucket", count, 'le="+Inf"')
+                sample(lines, name, metric_key, "_sum", snapshot.get_sum())
+                sample(lines, name, metric_key, "_count", count)
+            else:
+                target = family("summary", metric_key.get_key(), metric_key)
+                if target is None:
+                    continue
+                name, lines = target
+                snapshot = histogram.get_snapshot()
+                for quantile in QUANTILES:
+                    sample(
+                        lines, name, metric_key, "", snapshot.get_percentile(quantile),
+                        'quantile="%s"' % quantile,
+                    )
+                sample(lines, name, metric_key, "_sum", histogram.get_sum())
+                sample(lines, name, metric_key, "_count", histogram.get_count())
+
+        lines = []
+        for name in sorted(families):
+            metric_type, samples = families[name]
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            lines.extend(samples)
+        lines.append("")
+        return "\n".join(lines).encode("utf-8")
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        try:
+            body = self.server.reporter.render()
+        except Exception:
+            LOG.exception("Cannot render metrics")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _PrometheusServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, reporter):
+        ThreadingHTTPServer.__init__(self, address, _PrometheusHandler)
+        self.reporter = reporter
@@ -1,18 +1,37 @@
+import logging
+import os
 import time
+import weakref
 from threading import Thread, Event
 import six
 from pyformance.registry import global_registry
 from pyformance.decorators import get_qualname
 
+LOG = logging.getLogger(__name__)
+
+_reporters = weakref.WeakSet()
+
 
 class Reporter(object):
+    """
+    Reports a registry from a background thread, once per C{reporting_interval}.
+
+    A forked child does not inherit the reporting thread. The child gets a
+    fresh thread and drops the connections it inherited. It starts reporting
+    again by itself only if C{restart_after_fork} is set; otherwise parent and
+    child would both report the metrics the child inherited.
+    """
+
+    # start the reporter again in forked children if it was running in the parent
+    restart_after_fork = False
+
     def create_thread(self):
         # noinspection PyAttributeOutsideInit
         self._loop_thread = Thread(
             target=self._loop,
             name="pyformance reporter {0}".format(get_qualname(type(self))),
         )
-        self._loop_thread.setDaemon(True)
+        self._loop_thread.daemon = True
 
     def __init__(self, registry=None, reporting_interval=30, clock=None):
         self.registry = registry or global_registry()
@@ -20,22 +39,37 @@ class Reporter(object):
         self.clock = clock or time
         self._stopped = Event()
         self.create_thread()
+        _reporters.add(self)
 
     def start(self):
         if self._stopped.is_set():
             return False
-
-        r = str(self._loop_thread)
-        if "stopped" in r:
-            # has to be recreated in a celery worker
-            self.create_thread()
-        elif "started" in r:
+        if self._loop_thread.is_alive():
             # already started
             return False
+        if self._loop_thread.ident is not None:
+            # the thread ended, e.g. it was not carried over to a forked child
+            self.create_thread()
 
         self._loop_thread.start()
         return True
 
+    def _after_fork_in_child(self):
+        """
+        Called in a forked child, after the registries were taken care of.
+        Subclasses drop connections and other state shared with the parent
+        here.
+        """
+        running = self._loop_thread.ident is not None and not self._stopped.is_set()
+        # the parent's reporting thread may have held the event's lock
+        stopped = self._stopped.is_set()
+        self._stopped = Event()
+        if stopped:
+            self._stopped.set()
+        self.create_thread()
+        if running and self.restart_after_fork:
+            self.start()
+
     def stop(self):
         self._stopped.set()
 
@@ -58,3 +92,16 @@ class Reporter(object):
 
     def report_now(self, registry=None, timestamp=None):
         raise NotImplementedError(self.report_now)
+
+
+def _after_fork_in_child():
+    for reporter in list(_reporters):
+        # a failure must not leave the other reporters with the parent's connections
+        try:
+            reporter._after_fork_in_child()
+        except Exception:
+            LOG.exception("Cannot reset %r after fork", reporter)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import logging
+import queue
+from threading import Lock, Thread
+
+from pyformance.decorators import get_qualname
+from .reporter import Reporter
+
+LOG = logging.getLogger(__name__)
+
+
+class CollectedMetrics(object):
+    """
+    The result of one collection pass over a registry.
+
+    It answers C{dump_metrics} like the registry it was collected from, so it
+    can be passed to any reporter's C{report_now} in place of the registry.
+    Every call returns fresh dicts, so reporters cannot see each other's
+    changes.
+    """
+
+    def __init__(self, metrics, timestamp=None):
+        """
+        :param metrics: the result of C{registry.dump_metrics(key_is_metric=True)}
+        :param timestamp: the time the metrics were collected at
+        """
+        self._metrics = metrics
+        self.timestamp = timestamp
+
+    def dump_metrics(self, key_is_metric=False):
+        metrics = {}
+        for metric_key, values in self._metrics.items():
+            key = metric_key if key_is_metric else metric_key.get_key()
+            metrics[key] = dict(values)
+        return metrics
+
+
+class _ReporterSink(object):
+    """Feeds collected metrics to one reporter from its own thread."""
+
+    def __init__(self, reporter, queue_size):
+        self.reporter = reporter
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stopped = False
+        self._thread = Thread(
+            target=self._loop,
+            name="pyformance sink {0}".format(get_qualname(type(reporter))),
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, collected, timestamp):
+        item = (collected, timestamp)
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            # the reporter is falling behind; the newest collection wins
+            try:
+                self._queue.get_nowait()
+                self._queue.task_done()
+            except queue.Empty:
+                continue
+            LOG.warning(
+                "Dropped a collection for slow reporter %s",
+                get_qualname(type(self.reporter)),
+            )
+
+    def flush(self):
+        self._queue.join()
+
+    def stop(self):
+        self._stopped = True
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            # the thread is busy and checks the flag before taking the next item
+            pass
+
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None or self._stopped:
+                    return
+                collected, timestamp = item
+                self.reporter.report_now(collected, timestamp)
+            except Exception:
+                LOG.exception(
+                    "Reporter %s failed", get_qualname(type(self.reporter))
+                )
+            finally:
+                self._queue.task_done()
+
+
+class ReportingScheduler(Reporter):
+    """
+    Collects the registry once per interval and hands the result to several
+    reporters.
+
+    Snapshots are computed and events are drained once per interval no matter
+    how many reporters are attached. Each reporter sends from its own thread,
+    fed by a bounded queue, so a slow reporter delays neither the collection
+    nor the other reporters. Attached reporters should not be started
+    themselves, and must read metrics through C{dump_metrics}.
+    """
+
+    def __init__(
+            self, reporters=(), registry=None, reporting_interval=30, clock=None,
+            queue_size=1
+    ):
+        """
+        :param reporters: the reporters to feed
+        :param queue_size: the number of collections that may wait for a
+                           reporter before the oldest one is dropped
+        """
+        super(ReportingScheduler, self).__init__(registry, reporting_interval, clock)
+        self.queue_size = queue_size
+        self._sinks = []
+        self._sinks_lock = Lock()
+        for reporter in reporters:
+            self.add_reporter(reporter)
+
+    def add_reporter(self, reporter):
+        with self._sinks_lock:
+            self._sinks = self._sinks + [_ReporterSink(reporter, self.queue_size)]
+
+    def remove_reporter(self, reporter):
+        with self._sinks_lock:
+            removed = [sink for sink in self._sinks if sink.reporter is reporter]
+            self._sinks = [sink for sink in self._sinks if sink.reporter is not reporter]
+        for sink in removed:
+            sink.stop()
+
+    def collect(self, registry=None):
+        registry = registry or self.registry
+        return CollectedMetrics(
+            registry.dump_metrics(key_is_metric=True), self.clock.time()
+        )
+
+    def report_now(self, registry=None, timestamp=None):
+        collected = self.collect(registry)
+        # every reporter stamps the collection with the time it was taken, not
+        # with the time it gets around to sending it
+        timestamp = timestamp or collected.timestamp
+        for sink in self._sinks:
+            sink.submit(collected, timestamp)
+
+    def flush(self):
+        """Waits until every reporter has handled the collections queued for it."""
+        for sink in self._sinks:
+            sink.flush()
+
+    def stop(self):
+        super(ReportingScheduler, self).stop()
+        for sink in self._sinks:
+            sink.stop()
+
+    def _after_fork_in_child(self):
+        # the sink threads were not carried over to the child
+        self._sinks_lock = Lock()
+        self._sinks = [
+            _ReporterSink(sink.reporter, self.queue_size)
+            for sink in self._sinks
+            if not sink._stopped
+        ]
+        super(ReportingScheduler, self)._after_fork_in_child()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import gzip
+import logging
+import lzma
+import os
+import shutil
+import time
+from pathlib import Path
+from threading import Lock
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_MAX_SEGMENT_AGE = 600
+DEFAULT_BUFFER_SIZE = 64 * 1024
+DEFAULT_FSYNC_INTERVAL = 10
+
+INDEX_FILE_NAME = "index"
+OPEN_SUFFIX = ".open"
+SEALED_SUFFIXES = {None: ".txt", "gzip": ".txt.gz", "lzma": ".txt.xz"}
+_OPENERS = {".gz": gzip.open, ".xz": lzma.open}
+
+
+def open_segment(path):
+    """Opens a sealed segment for reading text, decompressing it if needed."""
+    path = Path(path)
+    opener = _OPENERS.get(path.suffix, open)
+    return opener(str(path), "rt", encoding="utf-8")
+
+
+class SegmentWriter(object):
+    """
+    Appends line protocol data to a few large segment files.
+
+    The segment being written is named C{<name>.open}. It is sealed once it
+    grows beyond C{max_segment_bytes} or gets older than C{max_segment_age}:
+    it is renamed to C{<name>.txt} (or compressed to C{<name>.txt.gz} /
+    C{<name>.txt.xz}) and its file name is appended to the C{index} file, so
+    consumers only ever see complete segments. Writes are buffered and synced
+    to disk at most once per C{fsync_interval}, and always when sealing.
+    """
+
+    def __init__(
+            self,
+            path,
+            max_segment_bytes=DEFAULT_MAX_SEGMENT_BYTES,
+            max_segment_age=DEFAULT_MAX_SEGMENT_AGE,
+            compression=None,
+            buffer_size=DEFAULT_BUFFER_SIZE,
+            fsync_interval=DEFAULT_FSYNC_INTERVAL,
+            clock=time,
+    ):
+        """
+        :param path: the directory the segments are written to
+        :param compression: None, "gzip" or "lzma"
+        :param fsync_interval: the most seconds between syncing the open segment
+                               to disk; None to only sync when sealing
+        """
+        if compression not in SEALED_SUFFIXES:
+            raise ValueError("Unsupported compression %r" % compression)
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_age = max_segment_age
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.fsync_interval = fsync_interval
+        self.clock = clock
+        self._lock = Lock()
+        self._file = None
+        self._file_path = None
+        self._created = None
+        self._synced = None
+        self._size = 0
+        self._seq = 0
+        self._recover()
+
+    def _recover(self):
+        """Seals segments left open by processes which are gone."""
+        for path in self.path.glob("*" + OPEN_SUFFIX):
+            try:
+                pid = int(path.name.split("-")[1])
+            except (IndexError, ValueError):
+                continue
+            if _pid_exists(pid):
+                continue
+            self._seal(path)
+
+    def write(self, data):
+        """Appends lines to the open segment, rotating it first if it is due."""
+        with self._lock:
+            now = self.clock.time()
+            if self._file is not None and (
+                    self._size >= self.max_segment_bytes
+                    or now - self._created >= self.max_segment_age
+            ):
+                self._close_and_seal()
+            if not data:
+                return
+            if self._file is None:
+                self._open(now)
+            encoded = data.encode("utf-8")
+            if not encoded.endswith(b"\n"):
+                encoded += b"\n"
+            self._file.write(encoded)
+            self._size += len(encoded)
+            if self.fsync_interval is not None and now - self._synced >= self.fsync_interval:
+                self._sync()
+                self._synced = now
+
+    def _open(self, now):
+        self._seq += 1
+        name = "%013d-%d-%d" % (int(now * 1000), os.getpid(), self._seq)
+        self._file_path = self.path / (name + OPEN_SUFFIX)
+        self._file = open(str(self._file_path), "ab", buffering=self.buffer_size)
+        self._created = self._synced = now
+        self._size = 0
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _close_and_seal(self):
+        self._sync()
+        self._file.close()
+        self._file = None
+        self._seal(self._file_path)
+
+    def _seal(self, open_path):
+        name = open_path.name[: -len(OPEN_SUFFIX)]
+        sealed_path = self.path / (name + SEALED_SUFFIXES[self.compression])
+        if self.compression is None:
+            os.replace(str(open_path), str(sealed_path))
+        else:
+            opener = _OPENERS[sealed_path.suffix]
+            temp_path = self.path / (name + ".compressing")
+            with open(str(open_path), "rb") as source, opener(str(temp_path), "wb") as target:
+                shutil.copyfileobj(source, target)
+            _fsync_path(temp_path)
+            os.replace(str(temp_path), str(sealed_path))
+            os.unlink(str(open_path))
+        with open(str(self.path / INDEX_FILE_NAME), "a") as index:
+            index.write(sealed_path.name + "\n")
+            index.flush()
+            os.fsync(index.fileno())
+        LOG.debug("Sealed segment %s", sealed_path)
+
+    def sealed_segments(self):
+        """Returns the paths of the sealed segments listed in the index, oldest first."""
+        try:
+            with open(str(self.path / INDEX_FILE_NAME)) as index:
+                names = [line.strip() for line in index if line.strip()]
+        except IOError:
+            return []
+        return [self.path / name for name in names if (self.path / name).exists()]
+
+    def _after_fork_in_child(self):
+        """Leaves the open segment to the parent; the child opens one of its own."""
+        self._lock = Lock()
+        if self._file is not None:
+            # point the inherited file at /dev/null, so closing it cannot write the
+            # parent's buffered lines to the segment a second time
+            null = os.open(os.devnull, os.O_WRONLY)
+            try:
+                os.dup2(null, self._file.fileno())
+            finally:
+                os.close(null)
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        """Seals the open segment."""
+        with self._lock:
+            if self._file is not None:
+                self._close_and_seal()
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _fsync_path(path):
+    with open(str(path), "rb") as f:
+        os.fsync(f.fileno())
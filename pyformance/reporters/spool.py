@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+from pathlib import Path
+from threading import Lock
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_SEGMENT_BYTES = 1024 * 1024
+
+OFFSET_FILE_NAME = "offset"
+
+
+class DiskSpool(object):
+    """
+    A bounded on-disk queue of line protocol data.
+
+    Data is appended to numbered segment files (C{000000000001.txt}, ...). The
+    read position is kept in an C{offset} file, which is replaced atomically on
+    every commit, so data is neither lost nor sent twice after a restart.
+    Segments are deleted once they were read completely. When the spool grows
+    beyond C{max_bytes} the oldest segments are dropped.
+    """
+
+    def __init__(
+            self,
+            path,
+            max_bytes=DEFAULT_SPOOL_MAX_BYTES,
+            segment_bytes=DEFAULT_SEGMENT_BYTES,
+    ):
+        """
+        :param path: the directory holding the spool, created if missing
+        :param max_bytes: the most bytes kept in the spool
+        :param segment_bytes: the size after which a new segment is started
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self._lock = Lock()
+        self._sizes = {}
+        for segment in self.path.glob("*.txt"):
+            if segment.stem.isdigit():
+                self._sizes[int(segment.stem)] = segment.stat().st_size
+        self._segments = sorted(self._sizes)
+        if self._segments:
+            self._truncate_partial_line(self._segments[-1])
+        self._read_seq, self._read_offset = self._load_offset()
+        while self._segments and self._segments[0] < self._read_seq:
+            self._remove_segment(self._segments[0])
+        self._next_seq = max([self._read_seq] + [seq + 1 for seq in self._segments])
+
+    def _segment_path(self, seq):
+        return self.path / ("%012d.txt" % seq)
+
+    def _truncate_partial_line(self, seq):
+        """
+        Cuts a line a crash left half written off the end of a segment, so the
+        next append does not extend it into a malformed line.
+        """
+        with open(self._segment_path(seq), "r+b") as segment:
+            data = segment.read()
+            size = data.rfind(b"\n") + 1
+            if size < len(data):
+                LOG.warning(
+                    "Dropped %d bytes of a write cut short in %s",
+                    len(data) - size,
+                    self._segment_path(seq),
+                )
+                segment.truncate(size)
+                self._sizes[seq] = size
+
+    def _load_offset(self):
+        try:
+            with open(self.path / OFFSET_FILE_NAME) as offset_file:
+                seq, offset = offset_file.read().split()
+                return int(seq), int(offset)
+        except (IOError, ValueError):
+            return (self._segments[0] if self._segments else 0), 0
+
+    def _save_offset(self):
+        temp_path = self.path / (OFFSET_FILE_NAME + ".tmp")
+        with open(temp_path, "w") as offset_file:
+            offset_file.write("%d %d\n" % (self._read_seq, self._read_offset))
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.replace(temp_path, self.path / OFFSET_FILE_NAME)
+
+    def _remove_segment(self, seq):
+        self._segments.remove(seq)
+        size = self._sizes.pop(seq)
+        try:
+            self._segment_path(seq).unlink()
+        except OSError:
+            pass
+        return size
+
+    @property
+    def pending_bytes(self):
+        with self._lock:
+            total = sum(self._sizes.values())
+            if self._read_seq in self._sizes:
+                total -= self._read_offset
+            return total
+
+    def append(self, data):
+        """Adds line protocol data to the end of the spool."""
+        encoded = data.encode("utf-8")
+        if not encoded.endswith(b"\n"):
+            encoded += b"\n"
+        with self._lock:
+            if not self._segments or self._sizes[self._segments[-1]] >= self.segment_bytes:
+                self._segments.append(self._next_seq)
+                self._sizes[self._next_seq] = 0
+                self._next_seq += 1
+            seq = self._segments[-1]
+            with open(self._segment_path(seq), "ab") as segment:
+                segment.write(encoded)
+                segment.flush()
+                os.fsync(segment.fileno())
+            self._sizes[seq] += len(encoded)
+            self._enforce_limit()
+
+    def _enforce_limit(self):
+        dropped = 0
+        while len(self._segments) > 1 and sum(self._sizes.values()) > self.max_bytes:
+            seq = self._segments[0]
+            dropped += self._remove_segment(seq)
+            if self._read_seq <= seq:
+                self._read_seq, self._read_offset = self._segments[0], 0
+        if dropped:
+            self._save_offset()
+            LOG.warning("Spool %s is full, dropped %d bytes of old data", self.path, dropped)
+
+    def read(self, max_lines=None, max_bytes=None):
+        """
+        Reads the oldest data which was not committed yet.
+
+        :param max_lines: the most lines to read
+        :param max_bytes: the most bytes to read; at least one line is read
+        :return: a C{(data, position, lines)} tuple, where C{position} is to be
+                 passed to L{commit} once the data was handled, or None if the
+                 spool is empty
+        """
+        with self._lock:
+            while self._segments:
+                seq = self._segments[0]
+                offset = self._read_offset if seq == self._read_seq else 0
+                lines = []
+                size = 0
+                with open(self._segment_path(seq), "rb") as segment:
+                    segment.seek(offset)
+                    for line in segment:
+                        if not line.endswith(b"\n"):
+                            # a write which was cut short
+                            break
+                        if lines and (
+                                len(lines) == max_lines
+                                or (max_bytes is not None and size + len(line) > max_bytes)
+                        ):
+                            break
+                        lines.append(line)
+                        size += len(line)
+                if lines:
+                    data = b"".join(lines).decode("utf-8").rstrip("\n")
+                    return data, (seq, offset + size), len(lines)
+                if seq == self._segments[-1]:
+                    return None
+                # a sealed segment which was read completely
+                self._remove_segment(seq)
+            return None
+
+    def commit(self, position):
+        """Marks the data up to C{position}, as returned by L{read}, as handled."""
+        seq, offset = position
+        with self._lock:
+            while self._segments and self._segments[0] < seq:
+                self._remove_segment(self._segments[0])
+            if self._segments and self._segments[0] == seq and offset >= self._sizes[seq]:
+                # the segment was read completely; appends go to a new one
+                self._remove_segment(seq)
+                seq = self._segments[0] if self._segments else self._next_seq
+                offset = 0
+            self._read_seq, self._read_offset = seq, offset
+            self._save_offset()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+import logging
+import math
+import re
+import socket
+
+from six import iteritems
+
+from ..registry import FORK_RESET
+from .reporter import Reporter
+from .utils import MAX_UDP_DATAGRAM_SIZE, open_datagram_socket, pack_lines
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_STATSD_HOST = "127.0.0.1"
+DEFAULT_STATSD_PORT = 8125
+DEFAULT_UDP_PACKET_SIZE = MAX_UDP_DATAGRAM_SIZE
+# unix sockets do not fragment, the agents read up to 8 KiB per datagram
+DEFAULT_UDS_PACKET_SIZE = 8192
+DROPPED_PACKETS_METRIC = "pyformance.statsd.dropped_packets"
+
+_INVALID_NAME_CHARS = re.compile(r"[:|@\s]")
+_INVALID_TAG_CHARS = re.compile(r"[,|#\s]")
+
+
+def _format_value(value):
+    value = float(value)
+    # counts are kept as floats; some agents only parse integral counters
+    if value.is_integer():
+        return "%d" % value
+    return repr(value)
+
+
+class StatsdReporter(Reporter):
+    """
+    Sends the registry to a StatsD or DogStatsD agent, over UDP or a unix
+    datagram socket.
+
+    Values are aggregated in the process and sent once per interval, packed
+    into as few packets as fit C{max_packet_size}. Counts (of counters,
+    meters, histograms and timers) are sent as counters holding the change
+    since the last report; a plain counter is sent as C{<name>}, the count of
+    other metrics as C{<name>.count}. Gauge values and the statistics of
+    histograms and timers (avg, min, max, percentiles...) are sent as gauges
+    named C{<name>.<statistic>}. Rates are left out, the agent computes them
+    from the counts. Tags are sent in the DogStatsD C{|#key:value} format, or
+    dropped when C{dogstatsd} is False. Events are not sent.
+
+    A count lower than the last one is sent as a negative change, as counters
+    can be decremented. Counts start over after the registry is cleared, and in
+    a forked child whose registry resets its metrics.
+    """
+
+    def __init__(
+            self,
+            registry=None,
+            reporting_interval=10,
+            prefix="",
+            host=DEFAULT_STATSD_HOST,
+            port=DEFAULT_STATSD_PORT,
+            socket_path=None,
+            max_packet_size=None,
+            dogstatsd=True,
+            global_tags=None,
+            socket_factory=socket.socket,
+            clock=None,
+    ):
+        """
+        :param socket_path: the path of the agent's unix datagram socket; if set,
+                            it is used instead of UDP to host and port
+        :param max_packet_size: the most bytes per packet; by default 1452 for UDP
+                                (fits an ethernet MTU) and 8192 for unix sockets
+        :param dogstatsd: send tags in the DogStatsD format
+        """
+        super(StatsdReporter, self).__init__(registry, reporting_interval, clock)
+        self.prefix = prefix
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        if max_packet_size is None:
+            if socket_path is None:
+                max_packet_size = DEFAULT_UDP_PACKET_SIZE
+            else:
+                max_packet_size = DEFAULT_UDS_PACKET_SIZE
+        self.max_packet_size = max_packet_size
+        self.dogstatsd = dogstatsd
+        self.global_tags = global_tags or {}
+        self.socket_factory = socket_factory
+        self._sock = None
+        self._last_counts = {}
+        self._last_epoch = None
+
+    def report_now(self, registry=None, timestamp=None):
+        registry = registry or self.registry
+        # clear() bumps the epoch of a registry, its counts start over
+        epoch = getattr(registry, "_epoch", None)
+        if epoch != self._last_epoch:
+            self._last_counts = {}
+            self._last_epoch = epoch
+        metrics = registry.dump_metrics(key_is_metric=True)
+        lines = self._get_statsd_lines(metrics)
+        dropped = 0
+        for packet in pack_lines(lines, self.max_packet_size, b"\n"):
+            try:
+                self._get_socket().send(packet)
+            except socket.error as err:
+                dropped += 1
+                LOG.debug("Cannot send packet to statsd: %s", err)
+                if not isinstance(err, BlockingIOError):
+                    # reconnect on the next report, the agent may have restarted
+                    self._close()
+        if dropped:
+            self.registry.counter(DROPPED_PACKETS_METRIC).inc(dropped)
+
+    def _get_statsd_lines(self, metrics):
+        # counts of metrics missing from the dump are kept, since an
+        # IncrementalRegistryView leaves out the ones which did not change
+        last_counts = self._last_counts
+        for metric_key, values in iteritems(metrics):
+            name = self._get_name(metric_key.get_key())
+            tags = self._get_tags(metric_key)
+            if "count" in values:
+                count = values["count"]
+                delta = count - last_counts.get(metric_key, 0)
+                last_counts[metric_key] = count
+                if delta:
+                    count_name = name if len(values) == 1 else name + ".count"
+                    yield self._line(count_name, delta, "c", tags)
+            for field, value in iteritems(values):
+                if field in ("count", "events", "tags") or field.endswith("_rate"):
+                    continue
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                if math.isnan(value) or math.isinf(value):
+                    continue
+                gauge_name = name if field == "value" else "%s.%s" % (name, field)
+                if value < 0 and not self.dogstatsd:
+                    # plain statsd reads a signed gauge value as a change, so set it
+                    # to zero first
+                    yield self._line(gauge_name, 0, "g", tags)
+                yield self._line(gauge_name, value, "g", tags)
+
+    def _line(self, name, value, metric_type, tags):
+        return ("%s:%s|%s%s" % (name, _format_value(value), metric_type, tags)).encode(
+            "utf-8"
+        )
+
+    def _get_name(self, key):
+        if self.prefix:
+            key = "%s.%s" % (self.prefix, key)
+        return _INVALID_NAME_CHARS.sub("_", key)
+
+    def _get_tags(self, metric_key):
+        if not self.dogstatsd:
+            return ""
+        all_tags = dict(self.global_tags)
+        all_tags.update(metric_key.get_tags())
+        if not all_tags:
+            return ""
+        return "|#" + ",".join(
+            "%s:%s" % (
+                _INVALID_TAG_CHARS.sub("_", str(key)),
+                _INVALID_TAG_CHARS.sub("_", str(value)),
+            )
+            for key, value in iteritems(all_tags)
+        )
+
+    def _get_socket(self):
+        if self._sock is None:
+            if self.socket_path is None:
+                sock = open_datagram_socket(self.socket_factory, socket.AF_INET)
+                address = (self.host, self.port)
+            else:
+                sock = open_datagram_socket(self.socket_factory, socket.AF_UNIX)
+                address = self.socket_path
+            try:
+                sock.connect(address)
+            except socket.error:
+                sock.close()
+                raise
+            self._sock = sock
+        return self._sock
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def stop(self):
+        super(StatsdReporter, self).stop()
+        self._close()
+
+    def _after_fork_in_child(self):
+        self._close()
+        if getattr(self.registry, "fork_policy", None) == FORK_RESET:
+            # the registry cleared the counts the parent reported
+            self._last_counts = {}
+        super(StatsdReporter, self)._after_fork_in_child()
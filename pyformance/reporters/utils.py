@@ -1,4 +1,5 @@
 # Copyright (c) 2023 Lightricks. All rights reserved.
+import socket
 from enum import Enum
 
 
@@ -30,3 +31,38 @@ def to_timestamp_in_precision(timestamp: float, precision: ReportingPrecision) -
         return int(timestamp * 1e9)
 
     raise Exception("Unsupported ReportingPrecision")
+
+
+# an ethernet MTU of 1500 bytes, less the IPv6 and UDP headers
+MAX_UDP_DATAGRAM_SIZE = 1452
+
+
+def pack_lines(lines, max_size, separator=b""):
+    """
+    Joins encoded lines into payloads of at most max_size bytes, such as UDP
+    datagrams, without splitting a line. A line longer than max_size is
+    yielded on its own.
+    """
+    batch = []
+    size = 0
+    for line in lines:
+        added = len(line) + (len(separator) if batch else 0)
+        if batch and size + added > max_size:
+            yield separator.join(batch)
+            batch = []
+            size = 0
+            added = len(line)
+        batch.append(line)
+        size += added
+    if batch:
+        yield separator.join(batch)
+
+
+def open_datagram_socket(socket_factory, family=socket.AF_INET):
+    """
+    Opens a non-blocking datagram socket, so a full send buffer drops the
+    datagram rather than blocking the reporter.
+    """
+    sock = socket_factory(family, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    return sock
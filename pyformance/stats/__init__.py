@@ -1,3 +1,4 @@
-from .samples import ExpDecayingSample
+from .samples import DDSketchSample, ExpDecayingSample, HdrHistogramSample, \
+    SlidingTimeWindowSample
 from .moving_average import ExpWeightedMovingAvg
-from .snapshot import Snapshot
+from .snapshot import BucketSnapshot, Snapshot
@@ -1,8 +1,9 @@
 import time
 import random
 import math
-import heapq
-from .snapshot import Snapshot
+import struct
+from array import array
+from .snapshot import BucketSnapshot, Snapshot
 
 DEFAULT_SIZE = 1028
 DEFAULT_ALPHA = 0.015
@@ -45,8 +46,9 @@ class ExpDecayingSample(object):
         self.clear()
 
     def clear(self):
-        self.values = {}
-        self.priorities = []
+        # parallel arrays in min-heap order of priority; values[i] has priorities[i]
+        self.values = []
+        self.priorities = array("d")
         self.counter = 0
         self.start_time = self.clock.time()
         self.next_time = self.clock.time() + ExpDecayingSample.RESCALE_THREASHOLD
@@ -65,23 +67,54 @@ class ExpDecayingSample(object):
             return
         self._rescale_if_necessary()
         priority = self._weight(self.clock.time() - self.start_time) / random.random()
-        new_counter = self.counter + 1
-        self.counter = new_counter
+        self.counter += 1
 
-        if new_counter <= self.size:
-            self.values[priority] = value
-            heapq.heappush(self.priorities, priority)
-        else:
-            first = heapq.heappop(self.priorities)
-            if first < priority:
-                if priority not in self.values:
-                    self.values[priority] = value
-                    heapq.heappush(self.priorities, priority)
-                    while first not in self.values:
-                        first = heapq.heappop(self.priorities)
-                    del self.values[first]
-            else:
-                heapq.heappush(self.priorities, first)
+        priorities = self.priorities
+        if len(priorities) < self.size:
+            self.values.append(value)
+            priorities.append(priority)
+            self._sift_up(len(priorities) - 1)
+        elif priorities[0] < priority:
+            # replace the lowest priority entry; lower priorities are rejected
+            # without touching the heap, which is the common case once it is full
+            self.values[0] = value
+            priorities[0] = priority
+            self._sift_down(0)
+
+    def _sift_up(self, pos):
+        priorities = self.priorities
+        values = self.values
+        priority = priorities[pos]
+        value = values[pos]
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if priorities[parent] <= priority:
+                break
+            priorities[pos] = priorities[parent]
+            values[pos] = values[parent]
+            pos = parent
+        priorities[pos] = priority
+        values[pos] = value
+
+    def _sift_down(self, pos):
+        priorities = self.priorities
+        values = self.values
+        end = len(priorities)
+        priority = priorities[pos]
+        value = values[pos]
+        child = 2 * pos + 1
+        while child < end:
+            right = child + 1
+            if right < end and priorities[right] < priorities[child]:
+                child = right
+            if priorities[child] >= priority:
+                break
+            priorities[pos] = priorities[child]
+            values[pos] = values[child]
+            pos = child
+            child = 2 * pos + 1
+        priorities[pos] = priority
+        values[pos] = value
 
     def _rescale_if_necessary(self):
         if self.clock.time() >= self.next_time:
@@ -91,53 +124,434 @@ class ExpDecayingSample(object):
         self.next_time = self.clock.time() + ExpDecayingSample.RESCALE_THREASHOLD
         old_start_time = self.start_time
         self.start_time = self.clock.time()
-        new_values = {}
-        new_priorities = []
-        for key, val in self.values.items():
-            priority = key * math.exp(-self.alpha * (self.start_time - old_start_time))
-            new_values[priority] = val
-            heapq.heappush(new_priorities, priority)
-        self.values = new_values
-        self.priorities = new_priorities
+        factor = math.exp(-self.alpha * (self.start_time - old_start_time))
+        # entries whose weight decayed to zero carry no information anymore; a
+        # sorted array is a valid min-heap, so the rest needs no further sifting
+        entries = [
+            (priority * factor, value)
+            for priority, value in zip(self.priorities, self.values)
+            if priority * factor > 0
+        ]
+        entries.sort(key=lambda entry: entry[0])
+        self.priorities = array("d", (priority for priority, _ in entries))
+        self.values = [value for _, value in entries]
         self.counter = len(self.values)
 
     def _weight(self, value):
         return math.exp(self.alpha * value)
 
     def get_snapshot(self):
-        return Snapshot(self.values.values())
+        return Snapshot(self.values)
 
 
 class SlidingTimeWindowSample(object):
 
     """
     A sample of measurements made in a sliding time window.
+
+    The window is split into a ring of time buckets. Adding a value appends it to
+    the current bucket, and a bucket is recycled once the window slid past it, so
+    expiry costs one check per bucket rather than one per value. Values are
+    expired at bucket granularity: a snapshot covers at least the window and at
+    most one bucket more.
     """
 
     DEFAULT_WINDOW = 300
+    DEFAULT_BUCKETS = 60
 
-    def __init__(self, window=DEFAULT_WINDOW, clock=time):
+    def __init__(
+        self, window=DEFAULT_WINDOW, clock=time, buckets=DEFAULT_BUCKETS, max_size=None
+    ):
         """Creates a SlidingTimeWindowSample.
 
         :param window: the length of the time window in seconds
         :param clock: clock.time() is called to get the current time as seconds
                       since the epoch.
+        :param buckets: the number of buckets the window is split into
+        :param max_size: if set, the maximum number of values kept for the whole
+                         window; a bucket receiving more than its share keeps a
+                         uniform random sample of its values
         """
         self.window = window
         self.clock = clock
+        self.bucket_width = float(window) / buckets
+        # one extra slot, so the oldest bucket is not recycled while the window
+        # still overlaps it
+        self._slots = buckets + 1
+        if max_size is None:
+            self._bucket_size = None
+        else:
+            self._bucket_size = max(1, max_size // buckets)
         self.clear()
 
     def clear(self):
-        self.values = []
+        self._epochs = [None] * self._slots
+        self._buckets = [[] for _ in range(self._slots)]
+        self._current_epoch = None
+        self._current = None
+        self._current_seen = 0
+
+    def get_size(self):
+        return sum(len(bucket) for bucket in self._live_buckets())
+
+    def _live_buckets(self):
+        oldest_epoch = int(self.clock.time() // self.bucket_width) - self._slots + 1
+        for slot, epoch in enumerate(self._epochs):
+            if epoch is None:
+                continue
+            if epoch < oldest_epoch:
+                self._epochs[slot] = None
+                self._buckets[slot] = []
+            else:
+                yield self._buckets[slot]
+
+    def _advance(self, epoch):
+        slot = epoch % self._slots
+        self._epochs[slot] = epoch
+        self._buckets[slot] = self._current = []
+        self._current_epoch = epoch
+        self._current_seen = 0
+
+    def update(self, value):
+        epoch = int(self.clock.time() // self.bucket_width)
+        # a clock stepping backwards keeps writing to the current bucket
+        if self._current_epoch is None or epoch > self._current_epoch:
+            self._advance(epoch)
+        if self._bucket_size is None:
+            self._current.append(value)
+            return
+        self._current_seen += 1
+        if self._current_seen <= self._bucket_size:
+            self._current.append(value)
+        else:
+            # reservoir sampling over the values added to this bucket
+            index = random.randrange(self._current_seen)
+            if index < self._bucket_size:
+                self._current[index] = value
+
+    def get_snapshot(self):
+        return Snapshot(value for bucket in self._live_buckets() for value in bucket)
+
+
+class HdrHistogramSample(object):
+
+    """
+    A sample which counts values in fixed log-linear buckets, in the manner of
+    HdrHistogram. Recording a value is a constant time counter increment, memory
+    is fixed up front, and percentiles are read from the bucket counts without
+    sorting. Unlike the reservoir samples it never drops values, which keeps the
+    tail of wide latency distributions visible.
+
+    @see: <a href="http://hdrhistogram.org/">HdrHistogram</a>
+    """
+
+    def __init__(
+        self,
+        lowest_discernible_value=0.000001,
+        highest_trackable_value=3600.0,
+        significant_digits=2,
+    ):
+        """
+        Creates a new L{HdrHistogramSample}.
+
+        :type lowest_discernible_value: C{float}
+        :param lowest_discernible_value: the smallest value told apart from zero;
+                                         with timers, 1 microsecond by default
+        :type highest_trackable_value: C{float}
+        :param highest_trackable_value: larger values are counted as this value
+        :type significant_digits: C{int}
+        :param significant_digits: number of significant decimal digits kept for
+                                   every value, between 1 and 5
+        """
+        super(HdrHistogramSample, self).__init__()
+        if not 1 <= significant_digits <= 5:
+            raise ValueError("significant_digits must be between 1 and 5")
+        if not 0 < lowest_discernible_value < highest_trackable_value:
+            raise ValueError(
+                "expected 0 < lowest_discernible_value < highest_trackable_value"
+            )
+        self.unit = float(lowest_discernible_value)
+        self.significant_digits = significant_digits
+        self._highest = int(math.ceil(highest_trackable_value / self.unit))
+
+        largest_single_unit_value = 2 * 10 ** significant_digits
+        self._sub_bucket_count_magnitude = int(math.ceil(math.log(largest_single_unit_value, 2)))
+        self._sub_bucket_half_count_magnitude = self._sub_bucket_count_magnitude - 1
+        sub_bucket_count = 1 << self._sub_bucket_count_magnitude
+        self._sub_bucket_half_count = sub_bucket_count >> 1
+        self._sub_bucket_mask = sub_bucket_count - 1
+
+        bucket_count = 1
+        smallest_untrackable_value = sub_bucket_count
+        while smallest_untrackable_value <= self._highest:
+            smallest_untrackable_value <<= 1
+            bucket_count += 1
+        self._counts_length = (bucket_count + 1) * self._sub_bucket_half_count
+        self.clear()
+
+    def clear(self):
+        self.counts = array("q", bytes(8 * self._counts_length))
+        self.counter = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def get_size(self):
+        return self.counter
+
+    def _index_of(self, units):
+        bucket_index = (
+            (units | self._sub_bucket_mask).bit_length() - self._sub_bucket_count_magnitude
+        )
+        return (
+            ((bucket_index + 1) << self._sub_bucket_half_count_magnitude)
+            + (units >> bucket_index)
+            - self._sub_bucket_half_count
+        )
+
+    def _value_at(self, index):
+        "the value in the middle of the range counted at index"
+        bucket_index = (index >> self._sub_bucket_half_count_magnitude) - 1
+        sub_bucket_index = (index & (self._sub_bucket_half_count - 1)) + self._sub_bucket_half_count
+        if bucket_index < 0:
+            sub_bucket_index -= self._sub_bucket_half_count
+            bucket_index = 0
+        lowest_equivalent = sub_bucket_index << bucket_index
+        return (lowest_equivalent + ((1 << bucket_index) >> 1)) * self.unit
+
+    def update(self, value):
+        """
+        Adds a value to the sample.
+
+        :type value: C{int} or C{float}
+        :param value: the value to be added
+        """
+        units = int(value / self.unit)
+        if units < 0:
+            units = 0
+        elif units > self._highest:
+            units = self._highest
+        self.counts[self._index_of(units)] += 1
+        self.counter += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def get_snapshot(self):
+        value_at = self._value_at
+        return BucketSnapshot(
+            [(value_at(index), count) for index, count in enumerate(self.counts) if count],
+            total=self.sum,
+            minimum=self.min,
+            maximum=self.max,
+        )
+
+
+def _write_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class DDSketchSample(object):
+
+    """
+    A quantile sketch with relative error guarantees. Every percentile it reports
+    is within C{relative_accuracy} of the true value. Sketches with the same
+    accuracy can be merged without losing that guarantee, so sketches recorded in
+    separate processes can be combined into correct fleet-wide percentiles, which
+    is not possible with reservoir samples. L{to_bytes} and L{from_bytes} give a
+    compact binary form for shipping sketches to an aggregator.
+
+    @see: <a href="https://arxiv.org/abs/1908.10693">Masson et al. DDSketch: A Fast
+          and Fully-Mergeable Quantile Sketch with Relative-Error Guarantees.
+          PVLDB 12(12) (2019)</a>
+    """
+
+    SERIALIZATION_VERSION = 1
+    # values closer to zero than this are counted as zero
+    MIN_INDEXABLE_VALUE = 1e-9
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        """
+        Creates a new L{DDSketchSample}.
+
+        :type relative_accuracy: C{float}
+        :param relative_accuracy: the relative error of reported percentiles
+        :type max_buckets: C{int}
+        :param max_buckets: upper bound for the buckets kept per sign; beyond it
+                            the lowest buckets are collapsed, which only loses
+                            accuracy at the low end of the distribution
+        """
+        super(DDSketchSample, self).__init__()
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._multiplier = 1 / math.log(self.gamma)
+        self.clear()
+
+    def clear(self):
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.counter = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def get_size(self):
+        return self.counter
+
+    def _index_of(self, value):
+        return int(math.ceil(math.log(value) * self._multiplier))
 
-    def _trim(self):
-        deadline = self.clock.time() - self.window
-        while self.values and self.values[0][0] < deadline:
-            heapq.heappop(self.values)
+    def _value_at(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
 
     def update(self, value):
-        heapq.heappush(self.values, (self.clock.time(), value))
+        """
+        Adds a value to the sample.
+
+        :type value: C{int} or C{float}
+        :param value: the value to be added
+        """
+        if value > self.MIN_INDEXABLE_VALUE:
+            buckets = self.positive
+            index = self._index_of(value)
+        elif value < -self.MIN_INDEXABLE_VALUE:
+            buckets = self.negative
+            index = self._index_of(-value)
+        else:
+            buckets = None
+            self.zero_count += 1
+        if buckets is not None:
+            buckets[index] = buckets.get(index, 0) + 1
+            if len(buckets) > self.max_buckets:
+                self._collapse(buckets)
+        self.counter += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def _collapse(self, buckets):
+        indices = sorted(buckets)
+        excess = len(indices) - self.max_buckets
+        if excess <= 0:
+            return
+        target = indices[excess]
+        for index in indices[:excess]:
+            buckets[target] += buckets.pop(index)
+
+    def merge(self, other):
+        """
+        Adds the values recorded by another sketch to this one.
+
+        :type other: L{DDSketchSample}
+        :param other: a sketch created with the same relative accuracy
+        """
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+        for buckets, other_buckets in (
+            (self.positive, other.positive),
+            (self.negative, other.negative),
+        ):
+            for index, count in other_buckets.items():
+                buckets[index] = buckets.get(index, 0) + count
+            self._collapse(buckets)
+        self.zero_count += other.zero_count
+        self.counter += other.counter
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def to_bytes(self):
+        """
+        Serializes the sketch: a small header followed by the buckets of each
+        sign, with indices delta encoded and everything stored as varints.
+
+        :rtype: C{bytes}
+        """
+        out = bytearray(
+            struct.pack(
+                "<Bdddd",
+                DDSketchSample.SERIALIZATION_VERSION,
+                self.relative_accuracy,
+                self.sum,
+                float("nan") if self.min is None else self.min,
+                float("nan") if self.max is None else self.max,
+            )
+        )
+        _write_varint(out, self.zero_count)
+        for buckets in (self.positive, self.negative):
+            _write_varint(out, len(buckets))
+            previous = 0
+            for index in sorted(buckets):
+                delta = index - previous
+                previous = index
+                # zigzag encoding keeps small negative deltas small
+                _write_varint(out, (delta << 1) ^ (delta >> 63))
+                _write_varint(out, buckets[index])
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data, max_buckets=2048):
+        """
+        Restores a sketch serialized with L{to_bytes}.
+
+        :type data: C{bytes}
+        :rtype: L{DDSketchSample}
+        """
+        header = struct.Struct("<Bdddd")
+        version, relative_accuracy, total, minimum, maximum = header.unpack_from(data)
+        if version != DDSketchSample.SERIALIZATION_VERSION:
+            raise ValueError("Unsupported sketch serialization version %r" % version)
+        sketch = cls(relative_accuracy=relative_accuracy, max_buckets=max_buckets)
+        sketch.sum = total
+        sketch.min = None if math.isnan(minimum) else minimum
+        sketch.max = None if math.isnan(maximum) else maximum
+        sketch.zero_count, pos = _read_varint(data, header.size)
+        counter = sketch.zero_count
+        for buckets in (sketch.positive, sketch.negative):
+            length, pos = _read_varint(data, pos)
+            index = 0
+            for _ in range(length):
+                zigzag, pos = _read_varint(data, pos)
+                index += (zigzag >> 1) ^ -(zigzag & 1)
+                buckets[index], pos = _read_varint(data, pos)
+                counter += buckets[index]
+        sketch.counter = counter
+        return sketch
 
     def get_snapshot(self):
-        self._trim()
-        return Snapshot(x[1] for x in self.values)
+        value_at = self._value_at
+        buckets = [
+            (-value_at(index), self.negative[index])
+            for index in sorted(self.negative, reverse=True)
+        ]
+        if self.zero_count:
+            buckets.append((0, self.zero_count))
+        buckets.extend(
+            (value_at(index), self.positive[index]) for index in sorted(self.positive)
+        )
+        return BucketSnapshot(buckets, total=self.sum, minimum=self.min, maximum=self.max)
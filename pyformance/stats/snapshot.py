@@ -4,7 +4,10 @@ import math
 class Snapshot(object):
 
     """
-    This class is used by the histogram meter
+    This class is used by the histogram meter.
+
+    A snapshot is an immutable statistics record: the values are sorted once and
+    the aggregates are computed when it is created, so every getter is a cheap read.
     """
 
     MEDIAN = 0.5
@@ -15,15 +18,26 @@ class Snapshot(object):
 
     def __init__(self, values):
         super(Snapshot, self).__init__()
-        self.values = sorted(values)
+        self.values = tuple(sorted(values))
+        self._size = len(self.values)
+        self._sum = float(sum(self.values))
+        if self._size:
+            self._mean = self._sum / self._size
+        else:
+            self._mean = 0
+        if self._size > 1:
+            mean = self._mean
+            self._var = sum((mean - value) ** 2 for value in self.values) / (self._size - 1)
+        else:
+            self._var = 0
 
     def get_size(self):
         "get current size"
-        return len(self.values)
+        return self._size
 
     def get_sum(self):
         "get current sum"
-        return float(sum(self.values))
+        return self._sum
 
     def get_max(self):
         "get current maximum value"
@@ -39,23 +53,17 @@ class Snapshot(object):
 
     def get_mean(self):
         "get current mean value"
-        if not self.values:
-            return 0
-        return float(sum(self.values)) / self.get_size()
+        return self._mean
 
     def get_stddev(self):
         "get current standard deviation"
         if not self.values:
             return 0
-        return math.sqrt(self.get_var())
+        return math.sqrt(self._var)
 
     def get_var(self):
         "get current variance"
-        if not self.values or self.get_size() == 1:
-            return 0
-        mean = self.get_mean()
-        square_differences = [(mean - value) ** 2 for value in self.values]
-        return sum(square_differences) / (self.get_size() - 1)
+        return self._var
 
     def get_median(self):
         "get current median"
@@ -96,3 +104,87 @@ class Snapshot(object):
         lower = self.values[int(pos) - 1]
         upper = self.values[int(pos)]
         return lower + (pos - int(pos)) * (upper - lower)
+
+
+class BucketSnapshot(Snapshot):
+
+    """
+    A snapshot of a bucketed sample, such as L{HdrHistogramSample}. It holds how
+    many values fell into each bucket instead of the values themselves, so
+    percentiles are read off the cumulative counts without sorting.
+    """
+
+    def __init__(self, buckets, total=None, minimum=None, maximum=None):
+        """
+        :param buckets: C{(value, count)} pairs in ascending order of value, where
+                        value represents every value recorded into the bucket
+        :param total: exact sum of the recorded values, if the sample tracks it
+        :param minimum: exact minimum of the recorded values, if tracked
+        :param maximum: exact maximum of the recorded values, if tracked
+        """
+        self.buckets = tuple(buckets)
+        self._values = None
+        self._size = sum(count for _, count in self.buckets)
+        if total is None:
+            total = sum(value * count for value, count in self.buckets)
+        self._sum = float(total)
+        if self.buckets:
+            self._min = self.buckets[0][0] if minimum is None else minimum
+            self._max = self.buckets[-1][0] if maximum is None else maximum
+        else:
+            self._min = self._max = 0
+        if self._size:
+            self._mean = self._sum / self._size
+        else:
+            self._mean = 0
+        if self._size > 1:
+            mean = self._mean
+            square_differences = sum(
+                count * (mean - value) ** 2 for value, count in self.buckets
+            )
+            self._var = square_differences / (self._size - 1)
+        else:
+            self._var = 0
+
+    @property
+    def values(self):
+        """
+        The recorded values as sorted by L{Snapshot}, each bucket repeated by its
+        count. They are only expanded when asked for, which takes memory in the
+        number of recorded values rather than buckets.
+        """
+        if self._values is None:
+            self._values = tuple(
+                value for value, count in self.buckets for _ in range(count)
+            )
+        return self._values
+
+    def get_max(self):
+        "get current maximum value"
+        return self._max
+
+    def get_min(self):
+        "get current minimum value"
+        return self._min
+
+    def get_stddev(self):
+        "get current standard deviation"
+        return math.sqrt(self._var)
+
+    def get_percentile(self, percentile):
+        """
+        get custom percentile
+
+        :param percentile: float value between 0 and 1
+        """
+        if percentile < 0 or percentile > 1:
+            raise ValueError("{0} is not in [0..1]".format(percentile))
+        if self._size == 0:
+            return 0
+        rank = max(1, int(math.ceil(percentile * self._size)))
+        seen = 0
+        for value, count in self.buckets:
+            seen += count
+            if seen >= rank:
+                return min(max(value, self._min), self._max)
+        return self._max
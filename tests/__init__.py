@@ -1,4 +1,9 @@
+import gzip
+import json
+import os
 import platform
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 if platform.python_version() < "2.7":
     import unittest2 as unittest
@@ -23,3 +28,64 @@ class ManualClock(object):
 
 class TimedTestCase(unittest.TestCase):
     clock = ManualClock()
+
+
+def in_forked_child(work):
+    """Returns what work() returned in a forked child, passed back as JSON."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            os.write(write_fd, json.dumps(work()).encode())
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as result:
+        data = result.read()
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        self.server.requests.append((self.path, body, self.client_address[1]))
+        self.server.headers.append(self.headers)
+        status = self.server.statuses.pop(0) if self.server.statuses else 204
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    An HTTP server on a free local port, which records the requests it gets
+    and answers them with the statuses queued in C{statuses}, 204 by default.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), StubHandler)
+        self.requests = []
+        self.headers = []
+        self.statuses = []
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
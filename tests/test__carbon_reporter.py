@@ -1,8 +1,11 @@
 from six import BytesIO, PY3
 from pyformance import MetricsRegistry
-from pyformance.reporters.carbon_reporter import CarbonReporter
-from tests import TimedTestCase
+from pyformance.reporters.carbon_reporter import CarbonReporter, UdpCarbonReporter
+from tests import ManualClock, TimedTestCase
 import pickle
+import socket
+import struct
+import time
 
 
 class TestCarbonReporter(TimedTestCase):
@@ -24,6 +27,14 @@ class TestCarbonReporter(TimedTestCase):
         # part of fake socket interface
         pass
 
+    def settimeout(self, timeout):
+        # part of fake socket interface
+        pass
+
+    def recv(self, size, flags=0):
+        # part of fake socket interface, nothing to read on a healthy connection
+        raise BlockingIOError()
+
     def tearDown(self):
         super(TestCarbonReporter, self).tearDown()
 
@@ -154,3 +165,273 @@ if __name__ == "__main__":
     import unittest
 
     unittest.main()
+
+
+class FakeServer(object):
+    """Hands out fake connections and records what was sent on each."""
+
+    def __init__(self):
+        self.connections = []
+        self.refuse = False
+
+    def socket(self):
+        return FakeConnection(self)
+
+
+class FakeConnection(object):
+    def __init__(self, server):
+        self.server = server
+        self.sent = []
+        self.closed = False
+        self.peer_closed = False
+        self.broken = False
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def connect(self, address):
+        if self.server.refuse:
+            raise ConnectionRefusedError()
+        self.server.connections.append(self)
+
+    def recv(self, size, flags=0):
+        if self.peer_closed:
+            return b""
+        raise BlockingIOError()
+
+    def sendall(self, data):
+        if self.broken:
+            raise BrokenPipeError()
+        self.sent.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+class TestCarbonReporterConnection(TimedTestCase):
+    def setUp(self):
+        super(TestCarbonReporterConnection, self).setUp()
+        self.clock = ManualClock()
+        self.clock.now = 100
+        self.registry = MetricsRegistry(clock=self.clock)
+        self.counter = self.registry.counter("c1")
+        self.server = FakeServer()
+        self.reporter = CarbonReporter(
+            registry=self.registry,
+            clock=self.clock,
+            socket_factory=self.server.socket,
+            timeout=3,
+        )
+
+    def report(self, value):
+        self.counter.inc(value - self.counter.get_count())
+        self.reporter.report_now()
+
+    def sent(self):
+        return [
+            data.decode()
+            for connection in self.server.connections
+            for data in connection.sent
+        ]
+
+    def test_keeps_connection_open(self):
+        listener = socket.socket()
+        self.addCleanup(listener.close)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(8)
+        self.reporter.server, self.reporter.port = listener.getsockname()
+        self.reporter.socket_factory = socket.socket
+        self.reporter.timeout = 2
+
+        started = time.time()
+        for value in range(1, 4):
+            self.report(value)
+        # the health check of the open connection must not wait for the timeout
+        self.assertLess(time.time() - started, 1)
+
+        listener.settimeout(0.5)
+        connection, _ = listener.accept()
+        self.addCleanup(connection.close)
+        self.reporter.stop()
+        received = b""
+        connection.settimeout(2)
+        while True:
+            data = connection.recv(4096)
+            if not data:
+                break
+            received += data
+        self.assertEqual(
+            "c1.count 1 100\nc1.count 2 100\nc1.count 3 100\n", received.decode()
+        )
+        # no other connection was opened
+        listener.settimeout(0)
+        with self.assertRaises(BlockingIOError):
+            listener.accept()
+
+    def test_sets_timeout_on_connection(self):
+        self.report(1)
+        self.assertEqual(3, self.server.connections[0].timeout)
+        self.reporter.stop()
+        self.assertTrue(self.server.connections[0].closed)
+
+    def test_reconnects_when_peer_closed(self):
+        self.report(1)
+        self.server.connections[0].peer_closed = True
+        self.report(2)
+
+        self.assertEqual(2, len(self.server.connections))
+        self.assertTrue(self.server.connections[0].closed)
+        self.assertEqual([b"c1.count 2 100\n"], self.server.connections[1].sent)
+
+    def test_resends_when_connection_breaks(self):
+        self.report(1)
+        self.server.connections[0].broken = True
+        self.report(2)
+
+        self.assertEqual(["c1.count 1 100\n", "c1.count 2 100\n"], self.sent())
+
+    def test_buffers_and_backs_off(self):
+        self.server.refuse = True
+        self.report(1)
+        retry_at = self.reporter._retry_at
+        # the first delay is between half a second and a second
+        self.assertTrue(100.5 <= retry_at <= 101)
+
+        self.server.refuse = False
+        self.report(2)
+        self.assertEqual([], self.server.connections)
+
+        self.clock.now = 101
+        self.report(3)
+        self.assertEqual(
+            ["c1.count 1 100\n", "c1.count 2 100\n", "c1.count 3 101\n"], self.sent()
+        )
+        self.assertEqual(0, self.reporter._failures)
+
+    def test_drops_oldest_buffered_reports(self):
+        self.reporter.max_buffered_bytes = 40
+        self.server.refuse = True
+        for value in range(1, 5):
+            self.report(value)
+            self.clock.add(60)
+
+        self.server.refuse = False
+        self.report(5)
+        self.assertEqual(["c1.count 4 280\n", "c1.count 5 340\n"], self.sent())
+
+    def test_pickle_frames_are_bounded(self):
+        self.reporter.pickle_protocol = True
+        self.reporter.pickle_batch_size = 2
+        for i in range(5):
+            self.registry.gauge("g%d" % i).set_value(i)
+        self.report(1)
+
+        frames = self.server.connections[0].sent
+        self.assertEqual(3, len(frames))
+        datapoints = []
+        for frame in frames:
+            (length,) = struct.unpack("!L", frame[:4])
+            self.assertEqual(len(frame) - 4, length)
+            datapoints.extend(pickle.loads(frame[4:]))
+        self.assertEqual(
+            sorted([("c1.count", (100, 1))] + [("g%d.value" % i, (100, i)) for i in range(5)]),
+            sorted(datapoints),
+        )
+
+
+class FakeUdpSocket(object):
+    def __init__(self, family, kind):
+        self.kind = kind
+        self.blocking = True
+        self.datagrams = []
+        self.fail = False
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def sendto(self, data, address):
+        if self.fail:
+            raise BlockingIOError()
+        self.datagrams.append(data)
+
+    def close(self):
+        pass
+
+
+class TestUdpCarbonReporter(TimedTestCase):
+    def setUp(self):
+        super(TestUdpCarbonReporter, self).setUp()
+        self.clock = ManualClock()
+        self.clock.now = 100
+        self.registry = MetricsRegistry(clock=self.clock)
+        self.sockets = []
+
+    def socket_factory(self, family, kind):
+        sock = FakeUdpSocket(family, kind)
+        self.sockets.append(sock)
+        return sock
+
+    def test_packs_lines_into_datagrams(self):
+        for i in range(10):
+            self.registry.gauge("gauge%d" % i).set_value(i)
+        reporter = UdpCarbonReporter(
+            registry=self.registry,
+            clock=self.clock,
+            socket_factory=self.socket_factory,
+            max_datagram_size=40,
+        )
+        reporter.report_now()
+        reporter.report_now()
+
+        self.assertEqual(1, len(self.sockets))
+        sock = self.sockets[0]
+        self.assertEqual(socket.SOCK_DGRAM, sock.kind)
+        self.assertFalse(sock.blocking)
+        # each line is 19 bytes, so two fit a datagram
+        self.assertEqual([38] * 10, [len(datagram) for datagram in sock.datagrams])
+        lines = b"".join(sock.datagrams[:5]).decode().splitlines()
+        self.assertEqual(sorted("gauge%d.value %d 100" % (i, i) for i in range(10)), sorted(lines))
+
+    def test_counts_dropped_datagrams(self):
+        for i in range(3):
+            self.registry.gauge("gauge%d" % i).set_value(i)
+        reporter = UdpCarbonReporter(
+            registry=self.registry,
+            clock=self.clock,
+            socket_factory=self.socket_factory,
+            max_datagram_size=20,
+        )
+        reporter._get_udp_socket().fail = True
+        reporter.report_now()
+
+        self.assertEqual(
+            3, self.registry.counter("pyformance.carbon.dropped_datagrams").get_count()
+        )
+
+    def test_pickle_frames_fit_datagrams(self):
+        for i in range(200):
+            self.registry.gauge("some.rather.long.gauge.name%d" % i).set_value(i)
+        self.registry.gauge("x" * 600).set_value(0)
+        reporter = UdpCarbonReporter(
+            registry=self.registry,
+            clock=self.clock,
+            socket_factory=self.socket_factory,
+            pickle_protocol=True,
+            max_datagram_size=500,
+        )
+        reporter.report_now()
+
+        datapoints = []
+        oversized = []
+        for datagram in self.sockets[0].datagrams:
+            (length,) = struct.unpack("!L", datagram[:4])
+            self.assertEqual(len(datagram) - 4, length)
+            frame = pickle.loads(datagram[4:])
+            datapoints.extend(frame)
+            if len(datagram) > 500:
+                oversized.append(frame)
+        # only the datapoint which cannot fit on its own is sent larger
+        self.assertEqual([[("x" * 600 + ".value", (100, 0))]], oversized)
+        self.assertEqual(201, len(datapoints))
+        # the frames are split close to the limit rather than in halves
+        self.assertLess(len(self.sockets[0].datagrams), 201 * 45 // 500 * 1.5)
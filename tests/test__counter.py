@@ -1,4 +1,6 @@
-from pyformance.meters import Counter
+import threading
+
+from pyformance.meters import Counter, StripedCounter
 from tests import TimedTestCase
 
 
@@ -21,3 +23,37 @@ class CounterTestCase(TimedTestCase):
         self.counter.dec()
         after = self.counter.get_count()
         self.assertEqual(before - 1, after)
+
+
+class StripedCounterTestCase(TimedTestCase):
+    def setUp(self):
+        super(StripedCounterTestCase, self).setUp()
+        self.counter = StripedCounter("test_counter")
+
+    def test__inc_dec(self):
+        self.counter.inc(5)
+        self.counter.dec(2)
+        self.assertEqual(self.counter.get_count(), 3)
+
+    def test__exact_total_across_threads(self):
+        def work():
+            for _ in range(10000):
+                self.counter.inc()
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.counter.get_count(), 80000)
+        # cells of the finished threads are folded into the total
+        self.assertEqual(self.counter._cells, [])
+        self.assertEqual(self.counter.get_count(), 80000)
+
+    def test__clear(self):
+        self.counter.inc(3)
+        self.counter.clear()
+        self.assertEqual(self.counter.get_count(), 0)
+        self.counter.inc()
+        self.assertEqual(self.counter.get_count(), 1)
@@ -0,0 +1,169 @@
+import asyncio
+import inspect
+
+from pyformance import MetricsRegistry, count_calls, hist_calls, meter_calls, time_calls
+from pyformance import global_registry, set_global_registry
+from tests import TimedTestCase
+
+
+class DecoratorsTestCase(TimedTestCase):
+    def setUp(self):
+        super(DecoratorsTestCase, self).setUp()
+        self.registry = MetricsRegistry(clock=self.clock)
+        self.original_global_registry = global_registry()
+
+    def tearDown(self):
+        super(DecoratorsTestCase, self).tearDown()
+        set_global_registry(self.original_global_registry)
+
+    def test_count_calls(self):
+        @count_calls(registry=self.registry, tags={"tag1": "val1"})
+        def counted():
+            pass
+
+        for _ in range(3):
+            counted()
+
+        metric_name = "DecoratorsTestCase.test_count_calls.<locals>.counted_calls"
+        self.assertEqual(self.registry.counter(metric_name, {"tag1": "val1"}).get_count(), 3)
+
+    def test_meter_calls(self):
+        @meter_calls(registry=self.registry)
+        def metered():
+            pass
+
+        metered()
+        metered()
+
+        metric_name = "DecoratorsTestCase.test_meter_calls.<locals>.metered_calls"
+        self.assertEqual(self.registry.meter(metric_name).get_count(), 2)
+
+    def test_hist_calls(self):
+        @hist_calls(registry=self.registry)
+        def returns(value):
+            return value
+
+        returns(1)
+        returns(3)
+        returns("ignored")
+
+        metric_name = "DecoratorsTestCase.test_hist_calls.<locals>.returns_calls"
+        histogram = self.registry.histogram(metric_name)
+        self.assertEqual(histogram.get_count(), 2)
+        self.assertEqual(histogram.get_sum(), 4)
+
+    def test_time_calls(self):
+        @time_calls(registry=self.registry)
+        def timed():
+            self.clock.add(1)
+
+        timed()
+
+        metric_name = "DecoratorsTestCase.test_time_calls.<locals>.timed_calls"
+        self.assertEqual(self.registry.timer(metric_name).get_sum(), 1)
+
+    def test_follows_global_registry_swap(self):
+        @count_calls
+        def counted():
+            pass
+
+        metric_name = "DecoratorsTestCase.test_follows_global_registry_swap.<locals>.counted_calls"
+        first, second = MetricsRegistry(), MetricsRegistry()
+
+        set_global_registry(first)
+        counted()
+        set_global_registry(second)
+        counted()
+        counted()
+
+        self.assertEqual(first.counter(metric_name).get_count(), 1)
+        self.assertEqual(second.counter(metric_name).get_count(), 2)
+
+    def test_rebinds_after_registry_clear(self):
+        @count_calls(registry=self.registry)
+        def counted():
+            pass
+
+        metric_name = "DecoratorsTestCase.test_rebinds_after_registry_clear.<locals>.counted_calls"
+        counted()
+        self.registry.clear()
+        counted()
+
+        self.assertEqual(self.registry.counter(metric_name).get_count(), 1)
+
+    def test_time_calls_coroutine(self):
+        @time_calls(registry=self.registry)
+        async def timed():
+            await asyncio.sleep(0)
+            self.clock.add(2)
+            return "done"
+
+        self.assertTrue(inspect.iscoroutinefunction(timed))
+        coroutine = timed()
+        self.clock.add(5)  # not part of the execution
+        self.assertEqual(asyncio.run(coroutine), "done")
+
+        metric_name = "DecoratorsTestCase.test_time_calls_coroutine.<locals>.timed_calls"
+        _timer = self.registry.timer(metric_name)
+        self.assertEqual(_timer.get_count(), 1)
+        self.assertEqual(_timer.get_sum(), 2)
+
+    def test_time_calls_generator(self):
+        @time_calls(registry=self.registry)
+        def timed():
+            for i in range(3):
+                self.clock.add(1)
+                yield i
+
+        self.assertTrue(inspect.isgeneratorfunction(timed))
+        self.assertEqual(list(timed()), [0, 1, 2])
+
+        metric_name = "DecoratorsTestCase.test_time_calls_generator.<locals>.timed_calls"
+        self.assertEqual(self.registry.timer(metric_name).get_sum(), 3)
+
+    def test_time_calls_async_generator(self):
+        @time_calls(registry=self.registry)
+        async def timed():
+            received = yield 1
+            self.clock.add(1)
+            try:
+                yield received
+            except ValueError:
+                yield "thrown"
+
+        async def consume():
+            agen = timed()
+            first = await agen.__anext__()
+            second = await agen.asend("sent")
+            third = await agen.athrow(ValueError())
+            await agen.aclose()
+            return first, second, third
+
+        self.assertTrue(inspect.isasyncgenfunction(timed))
+        self.assertEqual(asyncio.run(consume()), (1, "sent", "thrown"))
+
+        metric_name = "DecoratorsTestCase.test_time_calls_async_generator.<locals>.timed_calls"
+        _timer = self.registry.timer(metric_name)
+        self.assertEqual(_timer.get_count(), 1)
+        self.assertEqual(_timer.get_sum(), 1)
+
+    def test_count_calls_coroutine(self):
+        @count_calls(registry=self.registry)
+        async def counted():
+            return 1
+
+        coroutine = counted()
+        metric_name = "DecoratorsTestCase.test_count_calls_coroutine.<locals>.counted_calls"
+        self.assertEqual(self.registry.counter(metric_name).get_count(), 0)
+        asyncio.run(coroutine)
+        self.assertEqual(self.registry.counter(metric_name).get_count(), 1)
+
+    def test_hist_calls_coroutine(self):
+        @hist_calls(registry=self.registry)
+        async def returns(value):
+            return value
+
+        asyncio.run(returns(5))
+
+        metric_name = "DecoratorsTestCase.test_hist_calls_coroutine.<locals>.returns_calls"
+        self.assertEqual(self.registry.histogram(metric_name).get_sum(), 5)
@@ -1,5 +1,7 @@
+import threading
+
 from tests import TimedTestCase
-from pyformance.meters import Histogram
+from pyformance.meters import Histogram, StripedHistogram
 
 
 class HistogramTestCase(TimedTestCase):
@@ -52,7 +54,8 @@ class HistogramTestCase(TimedTestCase):
 
         self.clock.add(15 * 3600)  # 15 hours, should trigger rescale
         hist.add(2000)
-        self.assertEqual(hist.get_snapshot().get_size(), 2)
+        # the weights of the old entries decayed to zero, so only the new one is left
+        self.assertEqual(hist.get_snapshot().get_size(), 1)
         for i in hist.sample.get_snapshot().values:
             self.assertTrue(1000 <= i and i <= 3000)
 
@@ -62,3 +65,45 @@ class HistogramTestCase(TimedTestCase):
         self.assertEqual(hist.get_snapshot().get_size(), 10)
         for i in hist.sample.get_snapshot().values:
             self.assertTrue(3000 <= i and i <= 4000)
+
+
+class StripedHistogramTestCase(TimedTestCase):
+    def test__a_sample_of_100_from_1000(self):
+        hist = StripedHistogram(key="test_histogram", size=100, alpha=0.99, buffer_size=64)
+        for i in range(1000):
+            hist.add(i)
+
+        self.assertEqual(1000, hist.get_count())
+        self.assertEqual(100, hist.get_snapshot().get_size())
+        self.assertEqual(999, hist.get_max())
+        self.assertEqual(0, hist.get_min())
+        self.assertEqual(499.5, hist.get_mean())
+        self.assertAlmostEqual(83416.6666, hist.get_var(), delta=0.0001)
+
+    def test__buffers_are_bounded(self):
+        hist = StripedHistogram(key="test_histogram", buffer_size=10)
+        for i in range(25):
+            hist.add(i)
+        # the owning thread merged its buffer twice
+        self.assertEqual(20, hist.counter)
+        self.assertEqual(25, hist.get_count())
+
+    def test__exact_count_across_threads(self):
+        hist = StripedHistogram(key="test_histogram")
+
+        def work():
+            for i in range(5000):
+                hist.add(i)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        hist.get_count()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(40000, hist.get_count())
+        self.assertEqual(8 * sum(range(5000)), hist.get_sum())
+        self.assertEqual(4999, hist.get_max())
+        # buffers of the finished threads are merged and released
+        self.assertEqual([], hist._cells)
@@ -0,0 +1,106 @@
+import socket
+
+from pyformance.reporters.http_pool import HTTPConnectionPool, HTTPPoolError
+from pyformance.reporters.influx import InfluxReporter
+from pyformance import MetricsRegistry
+from tests import ManualClock, StubServer, TimedTestCase
+
+
+class HTTPConnectionPoolTestCase(TimedTestCase):
+    def setUp(self):
+        super(HTTPConnectionPoolTestCase, self).setUp()
+        self.server = StubServer()
+        self.clock = ManualClock()
+        self.pool = HTTPConnectionPool(
+            "127.0.0.1", self.server.port, timeout=2, clock=self.clock
+        )
+
+    def tearDown(self):
+        super(HTTPConnectionPoolTestCase, self).tearDown()
+        self.pool.close()
+        self.server.stop()
+
+    def test_reuses_connection(self):
+        for i in range(3):
+            status, _ = self.pool.request("POST", "/write?db=metrics", b"line %d" % i)
+            self.assertEqual(204, status)
+
+        self.assertEqual(
+            [b"line 0", b"line 1", b"line 2"], [body for _, body, _ in self.server.requests]
+        )
+        # all requests came from the same client port
+        self.assertEqual(1, len({port for _, _, port in self.server.requests}))
+
+    def test_reconnects_after_server_closed_connection(self):
+        self.pool.request("POST", "/write", b"first")
+        # drop the server side of the idle connection
+        for connection in self.pool._idle:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+
+        status, _ = self.pool.request("POST", "/write", b"second")
+
+        self.assertEqual(204, status)
+        self.assertEqual(b"second", self.server.requests[-1][1])
+
+    def test_backs_off_after_failure(self):
+        self.server.stop()
+        with self.assertRaises(HTTPPoolError):
+            self.pool.request("POST", "/write", b"lost")
+        with self.assertRaises(HTTPPoolError) as context:
+            self.pool.request("POST", "/write", b"lost")
+        self.assertIn("Backing off", str(context.exception))
+
+        self.clock.add(1)
+        with self.assertRaises(HTTPPoolError):
+            self.pool.request("POST", "/write", b"lost")
+        # the second consecutive failure doubles the wait
+        self.clock.add(1)
+        with self.assertRaises(HTTPPoolError) as context:
+            self.pool.request("POST", "/write", b"lost")
+        self.assertIn("Backing off", str(context.exception))
+
+    def test_influx_reporter_sends_through_pool(self):
+        registry = MetricsRegistry()
+        registry.gauge("cpu").set_value(65)
+        reporter = InfluxReporter(
+            registry=registry,
+            port=self.server.port,
+            clock=self.clock,
+            autocreate_database=True,
+        )
+        reporter.report_now()
+        reporter.report_now()
+        reporter._pool.close()
+
+        paths = [path for path, _, _ in self.server.requests]
+        self.assertEqual("/query?q=CREATE%20DATABASE%20metrics", paths[0])
+        self.assertEqual(["/write?db=metrics&precision=s&rp=autogen"] * 2, paths[1:])
+        self.assertEqual(b"cpu value=65 " + self.clock.time_string().encode(), self.server.requests[1][1])
+        self.assertEqual(1, len({port for _, _, port in self.server.requests}))
+
+    def test_influx_reporter_reports_error_status(self):
+        self.server.statuses.append(400)
+        reporter = InfluxReporter(port=self.server.port)
+
+        self.assertFalse(reporter._try_send(reporter._get_url(), "bad line"))
+        self.assertTrue(reporter._try_send(reporter._get_url(), "cpu value=1"))
+        reporter._pool.close()
+
+    def test_influx_reporter_gzip(self):
+        registry = MetricsRegistry()
+        for i in range(3):
+            registry.gauge("gauge%d" % i).set_value(i)
+        reporter = InfluxReporter(
+            registry=registry,
+            port=self.server.port,
+            clock=self.clock,
+            gzip_requests=True,
+            max_lines_per_request=2,
+        )
+        reporter.report_now()
+        reporter._pool.close()
+
+        self.assertEqual(
+            [b"gauge0 value=0 0\ngauge1 value=1 0", b"gauge2 value=2 0"],
+            [body for _, body, _ in self.server.requests],
+        )
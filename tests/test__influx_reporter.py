@@ -1,16 +1,17 @@
+import gzip
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
 try:
     import mock
 except ImportError:
     from unittest import mock
 
-try:
-    from urllib2 import Request
-except ImportError:
-    from urllib.request import Request
-
 from pyformance import MetricsRegistry, MarkInt
 from pyformance.reporters.influx import InfluxReporter, _format_tag_value
-from tests import TimedTestCase
+from tests import ManualClock, TimedTestCase, in_forked_child
 
 
 class TestInfluxReporter(TimedTestCase):
@@ -24,17 +25,17 @@ class TestInfluxReporter(TimedTestCase):
     def test_not_called_on_blank(self):
         influx_reporter = InfluxReporter(registry=self.registry)
 
-        with mock.patch("pyformance.reporters.influx.urlopen") as patch:
+        with mock.patch.object(influx_reporter._pool, "request") as patch:
             influx_reporter.report_now()
             patch.assert_not_called()
 
     def test_create_database(self):
         r1 = InfluxReporter(registry=self.registry, autocreate_database=True)
-        with mock.patch("pyformance.reporters.influx.urlopen") as patch:
+        with mock.patch.object(r1._pool, "request", return_value=(200, b"")) as patch:
             r1.report_now()
             if patch.call_count != 1:
                 raise AssertionError(
-                    "Expected 1 calls to 'urlopen'. Received: {}".format(
+                    "Expected 1 calls to 'request'. Received: {}".format(
                         patch.call_count
                     )
                 )
@@ -179,6 +180,197 @@ class TestInfluxReporter(TimedTestCase):
                             self.clock.time_string()
             send_mock.assert_called_once_with(expected_url, expected_data)
 
+    def test_splits_lines_into_requests(self):
+        clock = ManualClock()
+        for i in range(5):
+            self.registry.gauge("gauge%d" % i).set_value(i)
+        influx_reporter = InfluxReporter(
+            registry=self.registry,
+            clock=clock,
+            max_lines_per_request=2,
+        )
+
+        with mock.patch.object(influx_reporter, "_try_send") as send_mock:
+            influx_reporter.report_now()
+
+        bodies = [call[0][1] for call in send_mock.call_args_list]
+        self.assertEqual([2, 2, 1], [len(body.split("\n")) for body in bodies])
+        self.assertEqual(
+            ["gauge%d value=%d %s" % (i, i, clock.time_string()) for i in range(5)],
+            "\n".join(bodies).split("\n"),
+        )
+
+    def test_splits_lines_by_size(self):
+        clock = ManualClock()
+        for i in range(4):
+            self.registry.gauge("gauge%d" % i).set_value(i)
+        line_size = len("gauge0 value=0 " + clock.time_string()) + 1
+        influx_reporter = InfluxReporter(
+            registry=self.registry,
+            clock=clock,
+            max_bytes_per_request=line_size * 3 - 1,
+        )
+
+        with mock.patch.object(influx_reporter, "_try_send", side_effect=[True, False]) as send_mock:
+            with mock.patch("pyformance.reporters.influx.LOG") as log_mock:
+                influx_reporter.report_now()
+
+        bodies = [call[0][1] for call in send_mock.call_args_list]
+        self.assertEqual([2, 2], [len(body.split("\n")) for body in bodies])
+        log_mock.warning.assert_called_once_with(
+            "%d of %d writes to %s failed", 1, 2, "127.0.0.1"
+        )
+
+    def test_failed_writes_are_spooled_and_replayed(self):
+        clock = ManualClock()
+        spool_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_path)
+        gauge = self.registry.gauge("cpu")
+        influx_reporter = InfluxReporter(
+            registry=self.registry,
+            clock=clock,
+            reporting_interval=1,
+            spool_path=spool_path,
+            spool_replay_rate=1,
+        )
+
+        with mock.patch.object(influx_reporter, "_try_send", return_value=False):
+            for i in range(3):
+                gauge.set_value(i)
+                influx_reporter.report_now()
+                clock.add(1)
+
+        with mock.patch.object(influx_reporter, "_try_send", return_value=True) as send_mock:
+            gauge.set_value(3)
+            influx_reporter.report_now()
+            clock.add(1)
+            gauge.set_value(4)
+            influx_reporter.report_now()
+
+        # the live lines go first, then one spooled line per second
+        self.assertEqual(
+            ["cpu value=3 3", "cpu value=0 0", "cpu value=4 4", "cpu value=1 1"],
+            [call[0][1] for call in send_mock.call_args_list],
+        )
+
+    def test_rejected_writes_are_dropped(self):
+        clock = ManualClock()
+        spool_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_path)
+        gauge = self.registry.gauge("cpu")
+        influx_reporter = InfluxReporter(
+            registry=self.registry,
+            clock=clock,
+            reporting_interval=1,
+            spool_path=spool_path,
+            spool_replay_rate=10,
+            max_lines_per_request=1,
+        )
+        influx_reporter._pool = mock.Mock()
+
+        # a failing server is retried, a rejected write is not
+        for status in (503, 429, 400):
+            influx_reporter._pool.request.return_value = (status, b"")
+            gauge.set_value(status)
+            influx_reporter.report_now()
+            clock.add(1)
+
+        def request(method, path, body, headers):
+            data = body.decode()
+            return (400, b"unable to parse") if "value=503" in data else (204, b"")
+
+        influx_reporter._pool.request.side_effect = request
+        gauge.set_value(1)
+        influx_reporter.report_now()
+        sent = [
+            call[0][2].decode()
+            for call in influx_reporter._pool.request.call_args_list[3:]
+        ]
+        self.assertEqual(["cpu value=1 3", "cpu value=503 0", "cpu value=429 1"], sent)
+        # the rejected batch was skipped rather than blocking the spool
+        self.assertIsNone(influx_reporter._spool.read())
+
+    def test_forked_child_spools_to_own_directory(self):
+        spool_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_path)
+        influx_reporter = InfluxReporter(registry=self.registry, spool_path=spool_path)
+        influx_reporter._spool.append("cpu value=1 1")
+
+        def work():
+            spool = influx_reporter._spool
+            if not spool._lock.acquire(timeout=1):
+                return [False, None, None]
+            spool._lock.release()
+            spool.append("cpu value=2 2")
+            return [True, os.path.relpath(str(spool.path), spool_path), spool.read()[0]]
+
+        # the parent's reporter thread may hold the spool's lock while forking
+        with influx_reporter._spool._lock:
+            result = in_forked_child(work)
+        self.assertEqual(result[0], True)
+        self.assertTrue(result[1].startswith("child-"))
+        self.assertEqual(result[2], "cpu value=2 2")
+        # the parent's spool is left alone
+        self.assertEqual(influx_reporter._spool.read()[0], "cpu value=1 1")
+
+    def test_report_from_files(self):
+        files_path = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(files_path))
+        (files_path / "a.txt").write_text("cpu value=1 1")
+        (files_path / "b.txt").write_text("cpu value=2 2")
+        influx_reporter = InfluxReporter(registry=self.registry)
+
+        with mock.patch.object(influx_reporter, "_post", side_effect=[204, 503]) as send_mock:
+            influx_reporter.report_from_files(files_path)
+        self.assertEqual(
+            ["cpu value=1 1", "cpu value=2 2"],
+            [call[0][1] for call in send_mock.call_args_list],
+        )
+
+        (files_path / "a.txt").unlink()
+        with mock.patch.object(influx_reporter, "_post", return_value=204) as send_mock:
+            influx_reporter.report_from_files(files_path)
+            influx_reporter.report_from_files(files_path)
+        send_mock.assert_called_once_with(influx_reporter._get_url(), "cpu value=2 2")
+        self.assertEqual({files_path / "b.txt"}, influx_reporter.reported_files)
+
+    def test_report_from_compressed_segments(self):
+        files_path = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(files_path))
+        with gzip.open(str(files_path / "segment.txt.gz"), "wt") as f:
+            f.write("cpu value=1 1\ncpu value=2 2\n")
+        (files_path / "segment.open").write_text("cpu value=3 3\n")
+        influx_reporter = InfluxReporter(registry=self.registry)
+
+        with mock.patch.object(influx_reporter, "_post", return_value=204) as send_mock:
+            influx_reporter.report_from_files(files_path)
+
+        send_mock.assert_called_once_with(
+            influx_reporter._get_url(), "cpu value=1 1\ncpu value=2 2"
+        )
+
+    def test_report_from_files_in_batches(self):
+        files_path = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(files_path))
+        for name in ("a", "b", "c"):
+            (files_path / ("%s.txt" % name)).write_text(
+                "".join("cpu value=%d %d\n" % (i, i) for i in range(5))
+            )
+        influx_reporter = InfluxReporter(registry=self.registry, max_lines_per_request=2)
+
+        # a.txt is written, b.txt is rejected as malformed, c.txt is too large
+        statuses = [204, 204, 204, 400, 204, 204, 413]
+        with mock.patch.object(influx_reporter, "_post", side_effect=statuses) as send_mock:
+            influx_reporter.report_from_files(files_path)
+
+        self.assertEqual(
+            ["cpu value=0 0\ncpu value=1 1", "cpu value=2 2\ncpu value=3 3", "cpu value=4 4"],
+            [call[0][1] for call in send_mock.call_args_list[:3]],
+        )
+        self.assertEqual(
+            {files_path / "a.txt", files_path / "b.txt"}, influx_reporter.reported_files
+        )
+
     def test__format_tag_value(self):
         self.assertEqual(_format_tag_value("no_special_chars"), "no_special_chars")
         self.assertEqual(_format_tag_value("has space"), "has\\ space")
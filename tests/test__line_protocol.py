@@ -0,0 +1,77 @@
+from pyformance import MarkInt, MetricsRegistry
+from pyformance.reporters.line_protocol import LineProtocolEncoder, format_fields
+from pyformance.reporters.utils import ReportingPrecision
+from tests import ManualClock, TimedTestCase
+
+
+class LineProtocolEncoderTestCase(TimedTestCase):
+    def setUp(self):
+        super(LineProtocolEncoderTestCase, self).setUp()
+        self.registry = MetricsRegistry(clock=ManualClock())
+        self.encoder = LineProtocolEncoder()
+
+    def encode(self, prefix="", global_tags=None):
+        metrics = self.registry.dump_metrics(key_is_metric=True)
+        return list(
+            self.encoder.encode(metrics, 10, ReportingPrecision.SECONDS, prefix, global_tags)
+        )
+
+    def test_format_fields(self):
+        self.assertEqual(
+            'count=1,mean=0.5,name="x",mark=3i,flag=True',
+            format_fields(
+                {
+                    "count": 1,
+                    "mean": 0.5,
+                    "name": "x",
+                    "mark": MarkInt(3),
+                    "flag": True,
+                    "tags": {"a": "b"},
+                    "events": [],
+                }
+            ),
+        )
+
+    def test_encodes_series_with_tags(self):
+        self.registry.counter("requests", tags={"host": "web 1"}).inc()
+
+        self.assertEqual(
+            ["svc.requests,dc=eu,host=web\\ 1 count=1 10"],
+            self.encode(prefix="svc", global_tags={"dc": "eu"}),
+        )
+
+    def test_caches_series_per_metric(self):
+        self.registry.counter("requests", tags={"host": "web"}).inc()
+        global_tags = {"dc": "eu"}
+
+        first = self.encode(global_tags=global_tags)
+        series = dict(self.encoder._series)
+        second = self.encode(global_tags=global_tags)
+
+        self.assertEqual(first, second)
+        self.assertEqual(1, len(series))
+        self.assertEqual(series, self.encoder._series)
+
+    def test_global_tags_changes_invalidate_cache(self):
+        self.registry.counter("requests").inc()
+        global_tags = {"dc": "eu"}
+        self.assertEqual(["requests,dc=eu count=1 10"], self.encode(global_tags=global_tags))
+
+        global_tags["dc"] = "us"
+        self.assertEqual(["requests,dc=us count=1 10"], self.encode(global_tags=global_tags))
+        self.assertEqual(["requests count=1 10"], self.encode())
+        self.assertEqual(["prefix.requests count=1 10"], self.encode(prefix="prefix"))
+
+    def test_forgets_removed_metrics(self):
+        self.registry.counter("first").inc()
+        self.encode()
+        self.registry.clear()
+        self.registry.counter("second").inc()
+
+        self.assertEqual(["second count=1 10"], self.encode())
+        self.assertEqual(1, len(self.encoder._series))
+
+    def test_encodes_events(self):
+        self.registry.event("deploys").add({"version": "1.2"})
+
+        self.assertEqual(['deploys version="1.2" 0'], self.encode())
@@ -1,4 +1,6 @@
-from pyformance.meters import Meter
+import threading
+
+from pyformance.meters import Meter, StripedMeter
 from tests import TimedTestCase
 
 
@@ -78,3 +80,39 @@ class MeterTestCase(TimedTestCase):
         self.meter.tick()
         val = self.meter.get_mean_rate()
         self.assertEqual(1, val)
+
+
+class StripedMeterTestCase(TimedTestCase):
+    def setUp(self):
+        super(StripedMeterTestCase, self).setUp()
+        self.meter = StripedMeter(key="test_meter", clock=TimedTestCase.clock)
+
+    def test__one_minute_rate(self):
+        self.meter.mark(3)
+        self.clock.add(5)
+        self.meter.tick()
+        self.assertAlmostEqual(0.6, self.meter.get_one_minute_rate(), delta=0.000001)
+
+    def test__exact_count_across_threads(self):
+        def work():
+            for _ in range(10000):
+                self.meter.mark()
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        self.meter.get_count()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.meter.get_count(), 80000)
+        # cells of the finished threads are folded in and released
+        self.assertEqual(self.meter._cells, [])
+        self.assertEqual(self.meter.m1rate.uncounted, 80000)
+
+    def test__clear(self):
+        self.meter.mark(3)
+        self.meter.clear()
+        self.assertEqual(self.meter.get_count(), 0)
+        self.meter.mark()
+        self.assertEqual(self.meter.get_count(), 1)
@@ -0,0 +1,215 @@
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+from pyformance.meters import Histogram
+from pyformance.multiprocess import (
+    MultiprocessCollector,
+    MultiprocessRegistry,
+    mark_process_dead,
+)
+from pyformance.stats.samples import ExpDecayingSample
+from tests import ManualClock, TimedTestCase
+
+
+class MultiprocessTestCase(TimedTestCase):
+    def setUp(self):
+        super(MultiprocessTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.clock = ManualClock()
+        self.registries = []
+
+    def tearDown(self):
+        super(MultiprocessTestCase, self).tearDown()
+        for registry in self.registries:
+            registry.close()
+        shutil.rmtree(self.path)
+
+    def worker(self, **kwargs):
+        registry = MultiprocessRegistry(
+            self.path, clock=self.clock, flush_interval=None, **kwargs
+        )
+        self.registries.append(registry)
+        return registry
+
+    def fork(self, work, **kwargs):
+        """Runs work(registry) in a forked process with a registry of its own."""
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                registry = MultiprocessRegistry(
+                    self.path, clock=self.clock, flush_interval=None, **kwargs
+                )
+                work(registry)
+                registry.flush()
+                code = 0
+            finally:
+                os._exit(code)
+        _pid, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        return pid
+
+    def test_counters_are_summed_across_processes(self):
+        registry = self.worker()
+        registry.counter("requests", tags={"route": "a"}).inc(3)
+        self.fork(lambda child: child.counter("requests", tags={"route": "a"}).inc(4))
+        self.fork(lambda child: child.counter("requests", tags={"route": "a"}).inc(5))
+
+        collector = MultiprocessCollector(self.path, clock=self.clock)
+        metrics = collector.dump_metrics(key_is_metric=True)
+        self.assertEqual(len(metrics), 1)
+        (metric_key, values), = metrics.items()
+        self.assertEqual(metric_key.get_tags(), {"route": "a"})
+        # the counts of exited processes are kept
+        self.assertEqual(values, {"count": 12})
+
+        registry.counter("requests", tags={"route": "a"}).inc()
+        self.assertEqual(collector.get_metrics("requests", {"route": "a"}), {"count": 13})
+
+    def test_forked_child_does_not_count_parent_values(self):
+        registry = self.worker()
+        counter = registry.counter("jobs")
+        counter.inc(10)
+        histogram = registry.histogram("size")
+        histogram.add(1)
+        registry.flush()
+
+        def child_work(_registry):
+            # the parent's metrics are reused, with values of the child's own
+            counter.inc()
+            histogram.add(2)
+            registry.flush()
+
+        self.fork(child_work)
+        collector = MultiprocessCollector(self.path, clock=self.clock)
+        self.assertEqual(collector.get_metrics("jobs"), {"count": 11})
+        self.assertEqual(collector.get_metrics("size")["count"], 2)
+        self.assertEqual(counter.get_count(), 10)
+
+    def test_meters_and_timers(self):
+        registry = self.worker()
+        registry.meter("hits").mark(2)
+        registry.timer("latency")._update(0.5)
+        registry.flush()
+
+        def child_work(child):
+            child.meter("hits").mark(3)
+            child.timer("latency")._update(1.5)
+
+        self.fork(child_work)
+        collector = MultiprocessCollector(self.path, clock=self.clock)
+        collector.collect()
+        self.clock.add(1)
+        metrics = collector.dump_metrics()
+        self.assertEqual(metrics["hits"]["count"], 5)
+        self.assertEqual(metrics["latency"]["count"], 2)
+        self.assertEqual(metrics["latency"]["sum"], 2.0)
+        self.assertAlmostEqual(metrics["latency"]["max"], 1.5, delta=0.03)
+        self.assertAlmostEqual(metrics["latency"]["min"], 0.5, delta=0.01)
+
+        # rates follow the increase of the total
+        registry.meter("hits").mark(5)
+        self.clock.add(5)
+        collector.collect()
+        self.assertEqual(collector.meter("hits").get_count(), 10)
+        self.assertEqual(collector.meter("hits").get_mean_rate(), 10 / 6.0)
+
+    def test_gauge_modes(self):
+        for mode, expected in (("sum", 5), ("max", 3), ("min", 2)):
+            registry = self.worker(gauge_mode=mode)
+            registry.gauge(mode).set_value(2)
+            self.fork(lambda child: child.gauge(mode).set_value(3), gauge_mode=mode)
+        collector = MultiprocessCollector(self.path, clock=self.clock)
+        metrics = collector.dump_metrics()
+        self.assertEqual(metrics["sum"], {"value": 5})
+        self.assertEqual(metrics["max"], {"value": 3})
+        self.assertEqual(metrics["min"], {"value": 2})
+
+    def test_all_gauges_are_tagged_with_the_pid(self):
+        registry = self.worker()
+        registry.gauge("memory").set_value(100)
+        registry.gauge("unset")
+        child_pid = self.fork(lambda child: child.gauge("memory").set_value(200))
+        collector = MultiprocessCollector(self.path, clock=self.clock)
+        values = {
+            metric_key.get_tags()["pid"]: values["value"]
+            for metric_key, values in collector.dump_metrics(key_is_metric=True).items()
+        }
+        self.assertEqual(values, {str(os.getpid()): 100, str(child_pid): 200})
+
+        mark_process_dead(child_pid, self.path)
+        self.assertEqual(len(collector.dump_metrics()), 1)
+
+    def test_live_gauges_skip_exited_processes(self):
+        registry = self.worker(gauge_mode="livesum")
+        registry.gauge("connections").set_value(1)
+        self.fork(lambda child: child.gauge("connections").set_value(7), gauge_mode="livesum")
+        collector = MultiprocessCollector(self.path, clock=self.clock)
+        self.assertEqual(collector.dump_metrics()["connections"], {"value": 1})
+
+    def test_histograms_must_be_mergeable(self):
+        registry = self.worker()
+        with self.assertRaises(TypeError):
+            registry.histogram("sizes", sample=ExpDecayingSample())
+        # callback gauges stay in the process
+        registry.gauge("local", gauge=lambda: 1)
+        self.assertEqual(MultiprocessCollector(self.path).dump_metrics(), {})
+
+    def test_values_file_grows(self):
+        registry = self.worker()
+        for i in range(2000):
+            registry.counter("counter-with-a-long-name-%d" % i).inc(i)
+        collector = MultiprocessCollector(self.path, clock=self.clock)
+        metrics = collector.dump_metrics()
+        self.assertEqual(len(metrics), 2000)
+        self.assertEqual(metrics["counter-with-a-long-name-1999"], {"count": 1999})
+
+    def test_cached_lookups_do_not_create_sketches(self):
+        registry = self.worker()
+        timer = registry.timer("db")
+        histogram = registry.histogram("sizes")
+        with mock.patch("pyformance.multiprocess.DDSketchSample") as sketch_class:
+            self.assertIs(timer, registry.timer("db"))
+            self.assertIs(histogram, registry.histogram("sizes"))
+        sketch_class.assert_not_called()
+
+    def test_values_are_read_while_file_grows(self):
+        registry = self.worker()
+        counter = registry.counter("read")
+        counter.inc()
+        errors = []
+        done = threading.Event()
+
+        def read():
+            while not done.is_set():
+                try:
+                    counter.get_count()
+                except ValueError as err:
+                    errors.append(err)
+                    return
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        try:
+            for i in range(5000):
+                registry.counter("counter-with-a-long-name-%d" % i).inc()
+        finally:
+            done.set()
+            reader.join()
+        self.assertEqual([], errors)
+
+    def test_local_metrics_of_the_collector_are_kept(self):
+        collector = MultiprocessCollector(self.path, clock=self.clock)
+        collector.add("local", Histogram("local", clock=self.clock))
+        registry = self.worker()
+        registry.counter("shared").inc()
+        self.assertEqual(set(collector.dump_metrics()), {"local", "shared"})
+        os.unlink(os.path.join(self.path, "counter_%d.db" % os.getpid()))
+        self.assertEqual(set(collector.dump_metrics()), {"local"})
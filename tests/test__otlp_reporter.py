@@ -0,0 +1,155 @@
+import json
+
+from pyformance import MetricsRegistry
+from pyformance.meters import Histogram
+from pyformance.reporters.otlp import OTLPReporter, sketch_to_exponential_histogram
+from pyformance.stats.samples import DDSketchSample
+from tests import ManualClock, StubServer, TimedTestCase
+
+
+class TestOTLPReporter(TimedTestCase):
+    def setUp(self):
+        super(TestOTLPReporter, self).setUp()
+        self.server = StubServer()
+        self.clock = ManualClock()
+        self.clock.now = 100
+        self.registry = MetricsRegistry(clock=self.clock)
+        self.reporter = None
+
+    def tearDown(self):
+        super(TestOTLPReporter, self).tearDown()
+        if self.reporter is not None:
+            self.reporter.stop()
+        self.server.stop()
+
+    def create_reporter(self, **kwargs):
+        self.reporter = OTLPReporter(
+            registry=self.registry,
+            port=self.server.server_address[1],
+            resource_attributes={"service.name": "test"},
+            clock=self.clock,
+            **kwargs
+        )
+        return self.reporter
+
+    def exported(self, request=-1):
+        path, body, _ = self.server.requests[request]
+        content_type = self.server.headers[request]["Content-Type"]
+        self.assertEqual(path, "/v1/metrics")
+        self.assertEqual(content_type, "application/json")
+        resource_metrics = json.loads(body.decode("utf-8"))["resourceMetrics"][0]
+        self.assertEqual(
+            resource_metrics["resource"]["attributes"],
+            [{"key": "service.name", "value": {"stringValue": "test"}}],
+        )
+        scope_metrics = resource_metrics["scopeMetrics"][0]
+        return {metric["name"]: metric for metric in scope_metrics["metrics"]}
+
+    def test_counters_and_gauges(self):
+        r = self.create_reporter(prefix="app")
+        self.registry.counter("hits", tags={"host": "a", "shard": 3}).inc(5)
+        self.registry.gauge("temp").set_value(2.5)
+        self.registry.gauge("name").set_value("not a number")
+        r.report_now()
+        metrics = self.exported()
+        self.assertEqual(set(metrics), {"app.hits", "app.temp"})
+        hits = metrics["app.hits"]["sum"]
+        self.assertTrue(hits["isMonotonic"])
+        self.assertEqual(hits["aggregationTemporality"], 2)
+        self.assertEqual(
+            hits["dataPoints"],
+            [{
+                "asInt": "5",
+                "attributes": [
+                    {"key": "host", "value": {"stringValue": "a"}},
+                    {"key": "shard", "value": {"intValue": "3"}},
+                ],
+                "startTimeUnixNano": "100000000000",
+                "timeUnixNano": "100000000000",
+            }],
+        )
+        self.assertEqual(
+            metrics["app.temp"]["gauge"]["dataPoints"][0]["asDouble"], 2.5
+        )
+
+    def test_start_time_is_kept_until_reset(self):
+        r = self.create_reporter()
+        counter = self.registry.counter("hits")
+        counter.inc(5)
+        r.report_now()
+        self.clock.add(10)
+        counter.inc()
+        r.report_now()
+        point = self.exported()["hits"]["sum"]["dataPoints"][0]
+        self.assertEqual(point["startTimeUnixNano"], "100000000000")
+        self.assertEqual(point["timeUnixNano"], "110000000000")
+        self.clock.add(10)
+        counter.clear()
+        r.report_now()
+        point = self.exported()["hits"]["sum"]["dataPoints"][0]
+        self.assertEqual(point["startTimeUnixNano"], "120000000000")
+
+    def test_timers_are_summaries(self):
+        r = self.create_reporter()
+        timer = self.registry.timer("latency")
+        for value in (1, 2, 3, 4):
+            timer._update(value)
+        self.clock.add(1)
+        r.report_now()
+        latency = self.exported()["latency"]
+        self.assertEqual(latency["unit"], "s")
+        point = latency["summary"]["dataPoints"][0]
+        self.assertEqual(point["count"], "4")
+        self.assertEqual(point["sum"], 10)
+        self.assertEqual(
+            [quantile["quantile"] for quantile in point["quantileValues"]],
+            [0.5, 0.75, 0.95, 0.99, 0.999],
+        )
+        self.assertEqual(point["quantileValues"][-1]["value"], 4)
+
+    def test_sketches_are_exponential_histograms(self):
+        r = self.create_reporter()
+        histogram = Histogram("sizes", sample=DDSketchSample(), clock=self.clock)
+        self.registry.add("sizes", histogram)
+        for value in (0, 1, 10, 100, -5):
+            histogram.add(value)
+        r.report_now()
+        metric = self.exported()["sizes"]["exponentialHistogram"]
+        point = metric["dataPoints"][0]
+        self.assertEqual(metric["aggregationTemporality"], 2)
+        self.assertEqual(point["count"], "5")
+        self.assertEqual(point["zeroCount"], "1")
+        self.assertEqual(point["min"], -5)
+        self.assertEqual(point["max"], 100)
+        self.assertEqual(sum(int(c) for c in point["positive"]["bucketCounts"]), 3)
+        self.assertEqual(sum(int(c) for c in point["negative"]["bucketCounts"]), 1)
+
+    def test_exponential_buckets_keep_values_close(self):
+        sketch = DDSketchSample(relative_accuracy=0.01)
+        for value in (0.003, 1.5, 42, 1e6):
+            sketch.update(value)
+        point = sketch_to_exponential_histogram(sketch)
+        base = 2 ** (2 ** -point["scale"])
+        self.assertLessEqual(base, sketch.gamma ** 2)
+        offset = point["positive"]["offset"]
+        for value in (0.003, 1.5, 42, 1e6):
+            index = [
+                offset + i
+                for i, count in enumerate(point["positive"]["bucketCounts"])
+                if count != "0"
+            ]
+            self.assertTrue(
+                any(base ** i < value * sketch.gamma and value < base ** (i + 1) * sketch.gamma
+                    for i in index)
+            )
+
+    def test_metrics_are_batched(self):
+        r = self.create_reporter(max_metrics_per_request=2, gzip_requests=False)
+        for i in range(5):
+            self.registry.counter("counter%d" % i).inc()
+        r.report_now()
+        self.assertEqual(len(self.server.requests), 3)
+        names = set()
+        for request in range(3):
+            names.update(self.exported(request))
+        self.assertEqual(names, {"counter%d" % i for i in range(5)})
@@ -0,0 +1,186 @@
+import socket
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+from pyformance import MetricsRegistry
+from pyformance.reporters.prometheus import PrometheusReporter
+from pyformance.stats.samples import DDSketchSample, HdrHistogramSample
+from tests import ManualClock, TimedTestCase, in_forked_child
+
+
+class TestPrometheusReporter(TimedTestCase):
+    def setUp(self):
+        super(TestPrometheusReporter, self).setUp()
+        self.clock = ManualClock()
+        self.registry = MetricsRegistry(clock=self.clock)
+        self.reporter = PrometheusReporter(
+            registry=self.registry, host="127.0.0.1", port=0, clock=self.clock
+        )
+
+    def tearDown(self):
+        super(TestPrometheusReporter, self).tearDown()
+        self.reporter.stop()
+
+    def test_render(self):
+        self.registry.counter("requests", tags={"host": 'web "1"'}).inc(3)
+        self.registry.counter("requests", tags={"host": "web2"}).inc()
+        self.registry.gauge("queue.size").set_value(7)
+        self.registry.meter("logins").mark(2)
+        histogram = self.registry.histogram("payload")
+        for value in range(1, 101):
+            histogram.add(value)
+        self.registry.event("deploys").add({"version": 1})
+
+        lines = self.reporter.report_now().decode().splitlines()
+
+        self.assertEqual(
+            [
+                "# TYPE logins_total counter",
+                "logins_total 2.0",
+                "# TYPE payload summary",
+                'payload{quantile="0.5"} 50.5',
+                'payload{quantile="0.75"} 75.75',
+                'payload{quantile="0.95"} 95.94999999999999',
+                'payload{quantile="0.99"} 99.99',
+                'payload{quantile="0.999"} 100.0',
+                "payload_sum 5050.0",
+                "payload_count 100.0",
+                "# TYPE queue_size gauge",
+                "queue_size 7.0",
+                "# TYPE requests gauge",
+                'requests{host="web \\"1\\""} 3.0',
+                'requests{host="web2"} 1.0',
+            ],
+            lines,
+        )
+        # events are left for the other reporters
+        self.clock.add(1)
+        self.assertEqual(1, len(self.registry.dump_metrics()["deploys"]["events"]))
+
+    def test_timer_is_a_summary(self):
+        timer = self.registry.timer("db.query", tags={"table": "users"})
+        with timer.time():
+            self.clock.add(0.25)
+
+        page = self.reporter.report_now().decode()
+
+        self.assertIn("# TYPE db_query summary", page)
+        self.assertIn('db_query{table="users",quantile="0.99"} 0.25', page)
+        self.assertIn('db_query_count{table="users"} 1.0', page)
+
+    def test_cumulative_samples_are_histograms(self):
+        self.reporter.buckets = [0.1, 1]
+        timer = self.registry.timer("db.query", sample=HdrHistogramSample())
+        for value in (0.05, 0.5, 0.5, 2):
+            timer._update(value)
+        histogram = self.registry.histogram(
+            "payload", tags={"kind": "json"}, sample=DDSketchSample()
+        )
+        histogram.add(0.5)
+
+        lines = self.reporter.report_now().decode().splitlines()
+
+        self.assertEqual(
+            [
+                "# TYPE db_query histogram",
+                'db_query_bucket{le="0.1"} 1.0',
+                'db_query_bucket{le="1.0"} 3.0',
+                'db_query_bucket{le="+Inf"} 4.0',
+                "db_query_sum 3.05",
+                "db_query_count 4.0",
+                "# TYPE payload histogram",
+                'payload_bucket{kind="json",le="0.1"} 0.0',
+                'payload_bucket{kind="json",le="1.0"} 1.0',
+                'payload_bucket{kind="json",le="+Inf"} 1.0',
+                'payload_sum{kind="json"} 0.5',
+                'payload_count{kind="json"} 1.0',
+            ],
+            lines,
+        )
+
+    def test_clashing_names_are_skipped(self):
+        self.registry.counter("latency").inc()
+        self.registry.histogram("latency").add(1)
+        self.registry.timer("db").hist.add(1)
+        self.registry.gauge("db_count").set_value(1)
+        self.registry.counter("logins_total").inc(5)
+        self.registry.meter("logins").mark()
+        self.registry.counter("queue", tags={"host": "a"}).inc(2)
+        self.registry.gauge("queue", tags={"host": "b"}).set_value(3)
+
+        with mock.patch("pyformance.reporters.prometheus.LOG") as log:
+            lines = self.reporter.report_now().decode().splitlines()
+            self.reporter.report_now()
+
+        self.assertEqual(
+            [
+                "# TYPE db_count gauge",
+                "db_count 1.0",
+                "# TYPE latency gauge",
+                "latency 1.0",
+                "# TYPE logins_total gauge",
+                "logins_total 5.0",
+                "# TYPE queue gauge",
+                'queue{host="a"} 2.0',
+                'queue{host="b"} 3.0',
+            ],
+            lines,
+        )
+        # each clash is only logged once
+        self.assertEqual(3, log.warning.call_count)
+
+    def test_render_is_cached(self):
+        counter = self.registry.counter("requests")
+        counter.inc()
+        self.reporter.min_refresh_interval = 5
+        first = self.reporter.render()
+
+        counter.inc()
+        with mock.patch.object(self.reporter, "_render") as render:
+            self.assertEqual(first, self.reporter.render())
+            render.assert_not_called()
+
+        self.clock.add(5)
+        self.assertIn(b"requests 2.0", self.reporter.render())
+
+    def test_forked_child_leaves_fixed_port_to_parent(self):
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        reporter = PrometheusReporter(
+            registry=self.registry, host="127.0.0.1", port=port, clock=self.clock
+        )
+        self.addCleanup(reporter.stop)
+        reporter.restart_after_fork = True
+        self.reporter.restart_after_fork = True
+        reporter.start()
+        self.reporter.start()
+
+        def work():
+            return [reporter.server_address, self.reporter.server_address is not None]
+
+        # the child does not try to bind the parent's port, a free one is fine
+        self.assertEqual(in_forked_child(work), [None, True])
+        # the parent still serves on it
+        self.assertEqual(200, urlopen("http://127.0.0.1:%d/metrics" % port).getcode())
+
+    def test_serves_metrics_over_http(self):
+        self.registry.counter("requests").inc()
+        self.assertTrue(self.reporter.start())
+        self.assertFalse(self.reporter.start())
+        host, port = self.reporter.server_address
+
+        response = urlopen("http://%s:%d/metrics" % (host, port))
+        self.assertEqual(
+            "text/plain; version=0.0.4; charset=utf-8", response.headers["Content-Type"]
+        )
+        self.assertEqual(b"# TYPE requests gauge\nrequests 1.0\n", response.read())
+
+        with self.assertRaises(HTTPError):
+            urlopen("http://%s:%d/other" % (host, port))
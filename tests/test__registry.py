@@ -1,6 +1,13 @@
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
 from pyformance import MetricsRegistry, time_calls, timer
-from pyformance.meters import Meter, BaseMetric, EventPoint
-from tests import TimedTestCase
+from pyformance.meters import Meter, BaseMetric, EventPoint, StripedCounter, StripedHistogram, \
+    StripedMeter, StripedTimer
+from pyformance.registry import IncrementalRegistryView
+from tests import ManualClock, TimedTestCase, in_forked_child
 from pyformance.decorators import get_qualname
 
 
@@ -40,6 +47,23 @@ class RegistryTestCase(TimedTestCase):
             {"weather": "rainy", "cloudy": True}
         ).get_count(), 2)
 
+    def test_striped_counter(self):
+        counter = self.registry.counter("test_counter", striped=True)
+        self.assertIsInstance(counter, StripedCounter)
+        counter.inc()
+        self.assertEqual(self.registry.dump_metrics(), {"test_counter": {"count": 1}})
+
+    def test_cached_lookup_returns_same_metric(self):
+        tags = {"weather": "sunny"}
+        counter = self.registry.counter("test_counter", tags)
+        self.assertIs(self.registry.counter("test_counter", tags), counter)
+        self.assertIs(self.registry.counter("test_counter", {"weather": "sunny"}), counter)
+        self.assertIsNot(self.registry.counter("test_counter", {"weather": "rainy"}), counter)
+        self.assertIsNot(self.registry.meter("test_counter", tags), counter)
+
+        self.registry.clear()
+        self.assertIsNot(self.registry.counter("test_counter", tags), counter)
+
     def test_get_metrics(self):
         self.registry.counter("test_counter").inc()
         self.assertEqual(self.registry.get_metrics("test_counter"), {"count": 1})
@@ -74,6 +98,24 @@ class RegistryTestCase(TimedTestCase):
             BaseMetric("test_event", {"tag1": "val1"}): {}
         })
 
+    def test_dump_timer_takes_a_single_snapshot(self):
+        _timer = self.registry.timer("test_timer")
+        for i in range(10):
+            _timer._update(i)
+        self.clock.add(1)
+
+        with mock.patch.object(
+                _timer.hist.sample, "get_snapshot", wraps=_timer.hist.sample.get_snapshot
+        ) as snapshot_mock:
+            stats = self.registry.dump_metrics()["test_timer"]
+
+        snapshot_mock.assert_called_once_with()
+        self.assertEqual(stats["sum"], 45)
+        self.assertEqual(stats["avg"], 4.5)
+        self.assertEqual(stats["max"], 9)
+        self.assertEqual(stats["min"], 0)
+        self.assertAlmostEqual(stats["std_dev"], 3.0276, delta=0.0001)
+
     def test_time_calls_with_registry(self):
         registry = MetricsRegistry()
 
@@ -105,3 +147,120 @@ class RegistryTestCase(TimedTestCase):
             pass
 
         self.assertEqual(get_qualname(foo), "RegistryTestCase.test_get_qualname.<locals>.foo")
+
+    def test_fork_inherits_values_by_default(self):
+        counter = self.registry.counter("jobs")
+        counter.inc(3)
+        # a lock held by another thread while forking must not deadlock the child
+        counter.lock.acquire()
+        try:
+            count = in_forked_child(lambda: (counter.inc(), counter.get_count())[1])
+        finally:
+            counter.lock.release()
+        self.assertEqual(count, 4)
+        self.assertEqual(counter.get_count(), 3)
+
+    def test_fork_reset_policy_clears_values(self):
+        registry = MetricsRegistry(TimedTestCase.clock, fork_policy="reset")
+        counter = registry.counter("jobs")
+        counter.inc(3)
+        timer = registry.timer("latency")
+        timer._update(1)
+        registry.gauge("size").set_value(5)
+        registry.event("runs").add({"ok": 1})
+
+        def work():
+            metrics = registry.dump_metrics()
+            return [
+                counter.get_count(),
+                timer.get_count(),
+                metrics["size"]["value"],
+                bool(metrics["runs"]),
+            ]
+
+        self.assertEqual(in_forked_child(work), [0, 0, 5, False])
+        self.assertEqual(counter.get_count(), 3)
+
+    def test_unsupported_fork_policy(self):
+        with self.assertRaises(ValueError):
+            MetricsRegistry(fork_policy="share")
+
+    def test_striped_registry(self):
+        clock = ManualClock()
+        registry = MetricsRegistry(clock, striped=True)
+        self.assertIsInstance(registry.counter("counter"), StripedCounter)
+        self.assertIsInstance(registry.meter("meter"), StripedMeter)
+        self.assertIsInstance(registry.histogram("histogram"), StripedHistogram)
+        timer = registry.timer("timer")
+        self.assertIsInstance(timer, StripedTimer)
+        self.assertIsInstance(timer.hist, StripedHistogram)
+        self.assertIsInstance(timer.meter, StripedMeter)
+
+        timer._update(2)
+        timer._update(4)
+        registry.histogram("histogram").add(1)
+        clock.add(1)
+        metrics = registry.dump_metrics()
+        self.assertEqual(metrics["timer"]["count"], 2)
+        self.assertEqual(metrics["timer"]["avg"], 3)
+        self.assertEqual(metrics["histogram"]["count"], 1)
+
+    def test_dump_metrics_since(self):
+        clock = ManualClock()
+        registry = MetricsRegistry(clock)
+        registry.counter("counter").inc()
+        registry.histogram("histogram").add(1)
+        registry.timer("timer")._update(1)
+        registry.gauge("gauge").set_value(1)
+        registry.gauge("callback", lambda: 2)
+        registry.meter("meter").mark()
+        clock.add(1)
+        cursor = registry.cursor()
+        self.assertEqual(registry.dump_metrics(since=cursor), {"callback": {"value": 2}})
+
+        registry.counter("counter").inc()
+        registry.timer("timer")._update(1)
+        registry.gauge("gauge").set_value(3)
+        registry.event("event").add({"value": 1})
+        metrics = registry.dump_metrics(since=cursor)
+        self.assertEqual(
+            sorted(metrics), ["callback", "counter", "event", "gauge", "timer"]
+        )
+        self.assertEqual(metrics["counter"]["count"], 2)
+        self.assertEqual(metrics["timer"]["count"], 2)
+
+        registry.counter("counter").clear()
+        cursor = registry.cursor()
+        self.assertEqual(len(registry.dump_metrics()), 7)
+        self.assertEqual(sorted(registry.dump_metrics(since=cursor)), ["callback"])
+
+    def test_dump_metrics_since_striped(self):
+        registry = MetricsRegistry(ManualClock(), striped=True)
+        registry.counter("counter").inc()
+        registry.histogram("histogram").add(1)
+        cursor = registry.cursor()
+        self.assertEqual(registry.dump_metrics(since=cursor), {})
+        registry.counter("counter").inc()
+        registry.histogram("histogram").add(1)
+        metrics = registry.dump_metrics(since=cursor)
+        self.assertEqual(metrics["counter"]["count"], 2)
+        self.assertEqual(metrics["histogram"]["count"], 2)
+
+    def test_incremental_view(self):
+        clock = ManualClock()
+        registry = MetricsRegistry(clock)
+        view = IncrementalRegistryView(registry, full_refresh_interval=60, clock=clock)
+        registry.counter("a").inc()
+        registry.counter("b").inc()
+        self.assertEqual(sorted(view.dump_metrics()), ["a", "b"])
+        self.assertEqual(view.dump_metrics(), {})
+        registry.counter("b").inc()
+        self.assertEqual(view.dump_metrics(), {"b": {"count": 2}})
+
+        clock.add(60)
+        self.assertEqual(sorted(view.dump_metrics()), ["a", "b"])
+        self.assertEqual(view.dump_metrics(), {})
+        view.refresh()
+        self.assertEqual(sorted(view.dump_metrics()), ["a", "b"])
+        # everything else is the registry's
+        self.assertIs(view.counter("a"), registry.counter("a"))
@@ -0,0 +1,92 @@
+import threading
+
+from pyformance import MetricsRegistry
+from pyformance.reporters.reporter import Reporter
+from tests import ManualClock, TimedTestCase, in_forked_child
+
+
+class RecordingReporter(Reporter):
+    def __init__(self, *args, **kwargs):
+        super(RecordingReporter, self).__init__(*args, **kwargs)
+        self.reported = threading.Event()
+
+    def report_now(self, registry=None, timestamp=None):
+        self.reported.set()
+
+
+class BrokenForkReporter(RecordingReporter):
+    def _after_fork_in_child(self):
+        raise RuntimeError("cannot reset")
+
+
+class ReporterTestCase(TimedTestCase):
+    def setUp(self):
+        super(ReporterTestCase, self).setUp()
+        self.registry = MetricsRegistry(clock=ManualClock())
+        self.reporters = []
+
+    def tearDown(self):
+        super(ReporterTestCase, self).tearDown()
+        for reporter in self.reporters:
+            reporter.stop()
+
+    def reporter(self):
+        reporter = RecordingReporter(self.registry, reporting_interval=60)
+        self.reporters.append(reporter)
+        return reporter
+
+    def test_start_once(self):
+        reporter = self.reporter()
+        self.assertTrue(reporter.start())
+        self.assertFalse(reporter.start())
+        self.assertTrue(reporter.reported.wait(5))
+        reporter.stop()
+        self.assertFalse(reporter.start())
+
+    def test_child_does_not_report_by_default(self):
+        reporter = self.reporter()
+        reporter.start()
+
+        def work():
+            return [reporter._loop_thread.is_alive(), reporter._loop_thread.ident is None]
+
+        self.assertEqual(in_forked_child(work), [False, True])
+
+    def test_child_can_be_started_again(self):
+        reporter = self.reporter()
+        reporter.start()
+
+        def work():
+            reporter.reported.clear()
+            started = reporter.start()
+            return [started, reporter.reported.wait(5)]
+
+        self.assertEqual(in_forked_child(work), [True, True])
+
+    def test_restart_after_fork(self):
+        reporter = self.reporter()
+        reporter.restart_after_fork = True
+        idle = self.reporter()
+        idle.restart_after_fork = True
+        reporter.start()
+
+        def work():
+            return [reporter._loop_thread.is_alive(), idle._loop_thread.is_alive()]
+
+        self.assertEqual(in_forked_child(work), [True, False])
+
+    def test_failing_reporter_does_not_stop_fork_reset(self):
+        broken = BrokenForkReporter(self.registry, reporting_interval=60)
+        self.reporters.append(broken)
+        reporter = self.reporter()
+        reporter.restart_after_fork = True
+        reporter.start()
+        # reset whether it comes before or after the broken one
+        later = self.reporter()
+        later.restart_after_fork = True
+        later.start()
+
+        def work():
+            return [reporter._loop_thread.is_alive(), later._loop_thread.is_alive()]
+
+        self.assertEqual(in_forked_child(work), [True, True])
@@ -0,0 +1,201 @@
+import math
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+from pyformance import MetricsRegistry
+from pyformance.stats.samples import DDSketchSample, ExpDecayingSample, HdrHistogramSample, \
+    SlidingTimeWindowSample
+from tests import ManualClock, TimedTestCase
+
+
+class ExpDecayingSampleTestCase(TimedTestCase):
+    def test__equal_priorities_do_not_overwrite(self):
+        sample = ExpDecayingSample(size=10, clock=self.clock)
+        with mock.patch("pyformance.stats.samples.random.random", return_value=0.5):
+            for i in range(5):
+                sample.update(i)
+
+        self.assertEqual(sorted(sample.get_snapshot().values), [0, 1, 2, 3, 4])
+
+    def test__keeps_highest_priorities(self):
+        sample = ExpDecayingSample(size=100, clock=self.clock)
+        for i in range(10000):
+            sample.update(i)
+
+        self.assertEqual(sample.get_size(), 100)
+        self.assertEqual(len(sample.values), 100)
+        priorities = list(sample.priorities)
+        # heap invariant over the parallel arrays
+        for pos in range(1, len(priorities)):
+            self.assertLessEqual(priorities[(pos - 1) >> 1], priorities[pos])
+
+
+class HdrHistogramSampleTestCase(TimedTestCase):
+    def test__percentiles_within_precision(self):
+        sample = HdrHistogramSample(significant_digits=2)
+        values = [0.0001 * 1.01 ** i for i in range(1200)]  # 100us to ~15s
+        for value in values:
+            sample.update(value)
+
+        snapshot = sample.get_snapshot()
+        self.assertEqual(snapshot.get_size(), 1200)
+        self.assertEqual(snapshot.get_min(), values[0])
+        self.assertEqual(snapshot.get_max(), values[-1])
+        self.assertAlmostEqual(snapshot.get_sum(), sum(values))
+        for quantile in (0.5, 0.75, 0.99, 0.999):
+            expected = values[int(math.ceil(quantile * len(values))) - 1]
+            self.assertAlmostEqual(
+                snapshot.get_percentile(quantile) / expected, 1, delta=0.01
+            )
+
+    def test__values_out_of_range_are_clamped(self):
+        sample = HdrHistogramSample(highest_trackable_value=10)
+        sample.update(-1)
+        sample.update(1000)
+        self.assertEqual(sample.get_size(), 2)
+        self.assertEqual(sum(sample.counts), 2)
+
+    def test__memory_is_fixed(self):
+        sample = HdrHistogramSample()
+        length = len(sample.counts)
+        for i in range(10000):
+            sample.update(i / 1000.0)
+        self.assertEqual(len(sample.counts), length)
+
+        sample.clear()
+        self.assertEqual(sample.get_snapshot().get_size(), 0)
+        self.assertEqual(sample.get_snapshot().get_99th_percentile(), 0)
+
+    def test__snapshot_values_expand_buckets(self):
+        sample = HdrHistogramSample(significant_digits=2)
+        for value in (0.5, 0.25, 0.5, 0.5):
+            sample.update(value)
+
+        values = sample.get_snapshot().values
+        self.assertEqual(4, len(values))
+        self.assertEqual(sorted(values), list(values))
+        for value, expected in zip(values, (0.25, 0.5, 0.5, 0.5)):
+            self.assertAlmostEqual(value / expected, 1, delta=0.01)
+        self.assertEqual((), HdrHistogramSample().get_snapshot().values)
+
+    def test__timer_with_hdr_sample(self):
+        registry = MetricsRegistry(clock=self.clock)
+        timer = registry.timer("hdr_timer", sample=HdrHistogramSample())
+        for i in range(1, 101):
+            timer._update(i / 1000.0)
+
+        snapshot = timer.get_snapshot()
+        self.assertAlmostEqual(snapshot.get_median(), 0.05, delta=0.0005)
+        self.assertAlmostEqual(snapshot.get_99th_percentile(), 0.099, delta=0.001)
+
+
+class DDSketchSampleTestCase(TimedTestCase):
+    def test__percentiles_within_relative_accuracy(self):
+        sample = DDSketchSample(relative_accuracy=0.01)
+        values = [-5, 0] + [0.0001 * 1.013 ** i for i in range(1000)]
+        for value in values:
+            sample.update(value)
+
+        snapshot = sample.get_snapshot()
+        self.assertEqual(snapshot.get_size(), len(values))
+        self.assertEqual(snapshot.get_min(), -5)
+        self.assertEqual(snapshot.get_max(), values[-1])
+        self.assertEqual(snapshot.get_percentile(0), -5)
+        for quantile in (0.5, 0.75, 0.99, 0.999):
+            expected = values[int(math.ceil(quantile * len(values))) - 1]
+            self.assertAlmostEqual(
+                snapshot.get_percentile(quantile) / expected, 1, delta=0.01
+            )
+
+    def test__merge(self):
+        first, second, combined = DDSketchSample(), DDSketchSample(), DDSketchSample()
+        for i in range(1, 1001):
+            (first if i % 2 else second).update(i)
+            combined.update(i)
+
+        first.merge(second)
+        self.assertEqual(first.get_size(), 1000)
+        self.assertEqual(first.positive, combined.positive)
+        self.assertEqual(first.get_snapshot().get_sum(), combined.get_snapshot().get_sum())
+        self.assertEqual(first.get_snapshot().get_min(), 1)
+        self.assertEqual(first.get_snapshot().get_max(), 1000)
+
+        with self.assertRaises(ValueError):
+            first.merge(DDSketchSample(relative_accuracy=0.02))
+
+    def test__serialization_roundtrip(self):
+        sample = DDSketchSample()
+        for value in (-3, -0.5, 0, 0.001, 2, 2, 1e6):
+            sample.update(value)
+
+        restored = DDSketchSample.from_bytes(sample.to_bytes())
+        self.assertEqual(restored.positive, sample.positive)
+        self.assertEqual(restored.negative, sample.negative)
+        self.assertEqual(restored.zero_count, 1)
+        self.assertEqual(restored.get_size(), 7)
+        self.assertEqual(restored.min, -3)
+        self.assertEqual(restored.max, 1e6)
+
+        empty = DDSketchSample.from_bytes(DDSketchSample().to_bytes())
+        self.assertEqual(empty.get_size(), 0)
+        self.assertIsNone(empty.min)
+
+    def test__collapses_lowest_buckets(self):
+        sample = DDSketchSample(max_buckets=10)
+        for i in range(100):
+            sample.update(1.1 ** i)
+
+        self.assertEqual(len(sample.positive), 10)
+        self.assertEqual(sample.get_size(), 100)
+        self.assertAlmostEqual(
+            sample.get_snapshot().get_99th_percentile() / 1.1 ** 98, 1, delta=0.01
+        )
+
+    def test__histogram_with_sketch(self):
+        registry = MetricsRegistry(clock=self.clock)
+        histogram = registry.histogram("sketched", sample=DDSketchSample())
+        for i in range(1, 101):
+            histogram.add(i)
+
+        self.assertAlmostEqual(histogram.get_snapshot().get_median(), 50, delta=0.5)
+
+
+class SlidingTimeWindowSampleTestCase(TimedTestCase):
+    def setUp(self):
+        super(SlidingTimeWindowSampleTestCase, self).setUp()
+        self.clock = ManualClock()
+
+    def test__values_expire_with_the_window(self):
+        sample = SlidingTimeWindowSample(window=10, buckets=10, clock=self.clock)
+        for i in range(20):
+            sample.update(i)
+            self.clock.add(1)
+
+        # the current bucket is empty, the window reaches back one extra bucket
+        self.assertEqual(sorted(sample.get_snapshot().values), list(range(10, 20)))
+
+        self.clock.add(100)
+        self.assertEqual(sample.get_snapshot().get_size(), 0)
+        self.assertEqual(sample.get_size(), 0)
+
+    def test__max_size_bounds_memory(self):
+        sample = SlidingTimeWindowSample(window=10, buckets=5, max_size=50, clock=self.clock)
+        for i in range(10000):
+            sample.update(i)
+        self.assertEqual(sample.get_size(), 10)
+
+        self.clock.add(2)
+        for i in range(10000):
+            sample.update(i)
+        self.assertEqual(sample.get_size(), 20)
+        for value in sample.get_snapshot().values:
+            self.assertTrue(0 <= value < 10000)
+
+    def test__clear(self):
+        sample = SlidingTimeWindowSample(clock=self.clock)
+        sample.update(1)
+        sample.clear()
+        self.assertEqual(sample.get_snapshot().get_size(), 0)
@@ -0,0 +1,132 @@
+import threading
+
+from pyformance import MetricsRegistry
+from pyformance.reporters.reporter import Reporter
+from pyformance.reporters.scheduler import ReportingScheduler
+from tests import ManualClock, TimedTestCase
+
+
+class RecordingReporter(Reporter):
+    def __init__(self, **kwargs):
+        super(RecordingReporter, self).__init__(**kwargs)
+        self.reports = []
+        self.timestamps = []
+
+    def report_now(self, registry=None, timestamp=None):
+        self.reports.append(registry.dump_metrics())
+        self.timestamps.append(timestamp or self.clock.time())
+
+
+class BlockingReporter(RecordingReporter):
+    def __init__(self, **kwargs):
+        super(BlockingReporter, self).__init__(**kwargs)
+        self.release = threading.Event()
+
+    def report_now(self, registry=None, timestamp=None):
+        self.release.wait()
+        super(BlockingReporter, self).report_now(registry, timestamp)
+
+
+class ReportingSchedulerTestCase(TimedTestCase):
+    def setUp(self):
+        super(ReportingSchedulerTestCase, self).setUp()
+        self.registry = MetricsRegistry(clock=self.clock)
+
+    def test_collects_once_for_all_reporters(self):
+        first = RecordingReporter(registry=self.registry)
+        second = RecordingReporter(registry=self.registry)
+        scheduler = ReportingScheduler(
+            [first, second], registry=self.registry, clock=self.clock
+        )
+        self.registry.counter("c1").inc()
+        self.registry.event("e1").add({"field": 1})
+
+        scheduler.report_now()
+        scheduler.flush()
+        scheduler.stop()
+
+        self.assertEqual(first.reports, second.reports)
+        self.assertEqual(1, first.reports[0]["c1"]["count"])
+        self.assertEqual(1, len(first.reports[0]["e1"]["events"]))
+        self.assertEqual({"field": 1}, second.reports[0]["e1"]["events"][0].values)
+
+    def test_reporters_get_separate_copies(self):
+        first = RecordingReporter(registry=self.registry)
+        scheduler = ReportingScheduler(registry=self.registry, clock=self.clock)
+        self.registry.counter("c1").inc()
+        collected = scheduler.collect()
+
+        collected.dump_metrics()["c1"]["count"] = 42
+        first.report_now(collected)
+
+        self.assertEqual(1, first.reports[0]["c1"]["count"])
+        key = list(collected.dump_metrics(key_is_metric=True))[0]
+        self.assertEqual("c1", key.get_key())
+
+    def test_slow_reporter_gets_newest_collection(self):
+        slow = BlockingReporter(registry=self.registry)
+        fast = RecordingReporter(registry=self.registry)
+        scheduler = ReportingScheduler(
+            [slow, fast], registry=self.registry, clock=self.clock
+        )
+        counter = self.registry.counter("c1")
+        for _ in range(4):
+            counter.inc()
+            scheduler.report_now()
+        slow.release.set()
+        scheduler.flush()
+        scheduler.stop()
+
+        self.assertEqual(4, fast.reports[-1]["c1"]["count"])
+        # the first collection was already being sent, the others were replaced
+        self.assertLessEqual(len(slow.reports), 2)
+        self.assertEqual(4, slow.reports[-1]["c1"]["count"])
+
+    def test_reporters_get_collection_time(self):
+        clock = ManualClock()
+        clock.now = 100
+        slow = BlockingReporter(registry=self.registry, clock=clock)
+        fast = RecordingReporter(registry=self.registry, clock=clock)
+        scheduler = ReportingScheduler([slow, fast], registry=self.registry, clock=clock)
+        self.registry.counter("c1").inc()
+
+        scheduler.report_now()
+        clock.add(7)
+        slow.release.set()
+        scheduler.flush()
+        scheduler.report_now(timestamp=50)
+        scheduler.flush()
+        scheduler.stop()
+
+        self.assertEqual([100, 50], slow.timestamps)
+        self.assertEqual([100, 50], fast.timestamps)
+
+    def test_failing_reporter_does_not_stop_others(self):
+        class FailingReporter(Reporter):
+            def report_now(self, registry=None, timestamp=None):
+                raise ValueError("boom")
+
+        working = RecordingReporter(registry=self.registry)
+        scheduler = ReportingScheduler(
+            [FailingReporter(registry=self.registry), working],
+            registry=self.registry,
+            clock=self.clock,
+        )
+        self.registry.counter("c1").inc()
+
+        for _ in range(2):
+            scheduler.report_now()
+            scheduler.flush()
+        scheduler.stop()
+
+        self.assertEqual(2, len(working.reports))
+
+    def test_remove_reporter(self):
+        first = RecordingReporter(registry=self.registry)
+        scheduler = ReportingScheduler([first], registry=self.registry, clock=self.clock)
+        scheduler.remove_reporter(first)
+
+        scheduler.report_now()
+        scheduler.flush()
+
+        self.assertEqual([], first.reports)
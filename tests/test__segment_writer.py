@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+
+from pyformance.reporters.segment_writer import SegmentWriter, open_segment
+from tests import ManualClock, TimedTestCase
+
+
+class SegmentWriterTestCase(TimedTestCase):
+    def setUp(self):
+        super(SegmentWriterTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.clock = ManualClock()
+        self.clock.now = 1000
+
+    def tearDown(self):
+        super(SegmentWriterTestCase, self).tearDown()
+        shutil.rmtree(self.path)
+
+    def read_segments(self, writer):
+        contents = []
+        for segment in writer.sealed_segments():
+            with open_segment(segment) as f:
+                contents.append(f.read())
+        return contents
+
+    def test_appends_to_one_segment(self):
+        writer = SegmentWriter(self.path, clock=self.clock)
+        writer.write("a value=1 1")
+        writer.write("b value=2 2\nc value=3 2")
+
+        self.assertEqual([], writer.sealed_segments())
+        self.assertEqual(1, len(list(writer.path.glob("*.open"))))
+
+        writer.close()
+        self.assertEqual(["a value=1 1\nb value=2 2\nc value=3 2\n"], self.read_segments(writer))
+        self.assertEqual([], list(writer.path.glob("*.open")))
+
+    def test_rotates_by_size(self):
+        writer = SegmentWriter(self.path, max_segment_bytes=20, clock=self.clock)
+        for i in range(5):
+            writer.write("line %d" % i)
+        writer.close()
+
+        self.assertEqual(
+            ["line 0\nline 1\nline 2\n", "line 3\nline 4\n"], self.read_segments(writer)
+        )
+
+    def test_rotates_by_age(self):
+        writer = SegmentWriter(self.path, max_segment_age=60, clock=self.clock)
+        writer.write("early")
+        self.clock.add(59)
+        writer.write("")
+        self.assertEqual([], writer.sealed_segments())
+
+        self.clock.add(1)
+        writer.write("")
+        self.assertEqual(["early\n"], self.read_segments(writer))
+
+    def test_compression(self):
+        for compression, suffix in (("gzip", ".gz"), ("lzma", ".xz")):
+            writer = SegmentWriter(self.path, compression=compression, clock=self.clock)
+            writer.write("cpu value=1 1")
+            writer.close()
+
+            segment = writer.sealed_segments()[-1]
+            self.assertEqual(suffix, segment.suffix)
+            with open_segment(segment) as f:
+                self.assertEqual("cpu value=1 1\n", f.read())
+
+    def test_seals_segments_of_dead_processes(self):
+        # pids are at most 2 ** 22 on linux
+        dead = os.path.join(self.path, "0000000001000-%d-1.open" % (2 ** 22 + 1))
+        alive = os.path.join(self.path, "0000000001000-%d-1.open" % os.getpid())
+        for path in (dead, alive):
+            with open(path, "w") as f:
+                f.write("left over\n")
+
+        writer = SegmentWriter(self.path, clock=self.clock)
+
+        self.assertEqual(["left over\n"], self.read_segments(writer))
+        self.assertTrue(os.path.exists(alive))
@@ -0,0 +1,91 @@
+import shutil
+import tempfile
+
+from pyformance.reporters.spool import DiskSpool
+from tests import TimedTestCase
+
+
+class DiskSpoolTestCase(TimedTestCase):
+    def setUp(self):
+        super(DiskSpoolTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(DiskSpoolTestCase, self).tearDown()
+        shutil.rmtree(self.path)
+
+    def test_read_and_commit(self):
+        spool = DiskSpool(self.path)
+        spool.append("a value=1 1\nb value=2 1")
+        spool.append("c value=3 2")
+
+        data, position, lines = spool.read(max_lines=2)
+        self.assertEqual("a value=1 1\nb value=2 1", data)
+        self.assertEqual(2, lines)
+        # not committed, so it is read again
+        self.assertEqual(data, spool.read(max_lines=2)[0])
+
+        spool.commit(position)
+        data, position, lines = spool.read()
+        self.assertEqual("c value=3 2", data)
+        spool.commit(position)
+
+        self.assertIsNone(spool.read())
+        self.assertEqual(0, spool.pending_bytes)
+        self.assertEqual([], list(spool.path.glob("*.txt")))
+
+    def test_position_survives_restart(self):
+        spool = DiskSpool(self.path)
+        for i in range(4):
+            spool.append("m value=%d 1" % i)
+        _, position, _ = spool.read(max_lines=3)
+        spool.commit(position)
+
+        spool = DiskSpool(self.path)
+        self.assertEqual("m value=3 1", spool.read()[0])
+        spool.append("m value=4 1")
+        _, position, lines = spool.read()
+        self.assertEqual(2, lines)
+
+    def test_read_limits_bytes(self):
+        spool = DiskSpool(self.path)
+        spool.append("aaaa\nbbbb\ncccc")
+
+        self.assertEqual("aaaa\nbbbb", spool.read(max_bytes=12)[0])
+        # a single line larger than the limit is still read
+        self.assertEqual("aaaa", spool.read(max_bytes=2)[0])
+
+    def test_drops_oldest_when_full(self):
+        spool = DiskSpool(self.path, max_bytes=30, segment_bytes=10)
+        for i in range(6):
+            spool.append("line %04d" % i)
+
+        lines = []
+        batch = spool.read()
+        while batch is not None:
+            lines.append(batch[0])
+            spool.commit(batch[1])
+            batch = spool.read()
+        self.assertEqual(["line 0003", "line 0004", "line 0005"], lines)
+
+    def test_ignores_partial_line(self):
+        spool = DiskSpool(self.path)
+        spool.append("complete")
+        with open(str(spool.path / "000000000000.txt"), "a") as segment:
+            segment.write("cut sho")
+
+        self.assertEqual("complete", spool.read()[0])
+
+    def test_reopening_drops_partial_line(self):
+        spool = DiskSpool(self.path)
+        spool.append("complete")
+        with open(str(spool.path / "000000000000.txt"), "a") as segment:
+            segment.write("cut sho")
+
+        spool = DiskSpool(self.path)
+        spool.append("next")
+
+        data, position, lines = spool.read()
+        self.assertEqual("complete\nnext", data)
+        spool.commit(position)
+        self.assertEqual(0, spool.pending_bytes)
@@ -0,0 +1,188 @@
+from pyformance import MetricsRegistry
+from pyformance.registry import FORK_RESET, IncrementalRegistryView
+from pyformance.reporters.statsd_reporter import DROPPED_PACKETS_METRIC, StatsdReporter
+from tests import ManualClock, TimedTestCase
+import os
+import socket
+import tempfile
+
+
+class FakeDatagramSocket(object):
+    def __init__(self, family, kind):
+        self.family = family
+        self.kind = kind
+        self.address = None
+        self.blocking = True
+        self.packets = []
+        self.fail = False
+        self.closed = False
+
+    def connect(self, address):
+        self.address = address
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def send(self, data):
+        if self.fail:
+            raise BlockingIOError()
+        self.packets.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+class TestStatsdReporter(TimedTestCase):
+    def setUp(self):
+        super(TestStatsdReporter, self).setUp()
+        self.clock = ManualClock()
+        self.registry = MetricsRegistry(clock=self.clock)
+        self.sockets = []
+
+    def socket_factory(self, family, kind):
+        sock = FakeDatagramSocket(family, kind)
+        self.sockets.append(sock)
+        return sock
+
+    def reporter(self, **kwargs):
+        return StatsdReporter(
+            registry=self.registry,
+            clock=self.clock,
+            socket_factory=self.socket_factory,
+            **kwargs
+        )
+
+    def lines(self):
+        return [
+            line
+            for sock in self.sockets
+            for packet in sock.packets
+            for line in packet.decode("utf-8").split("\n")
+        ]
+
+    def test_counters_are_sent_as_deltas(self):
+        r = self.reporter(prefix="app")
+        counter = self.registry.counter("hits", tags={"host": "a"})
+        counter.inc(5)
+        r.report_now()
+        self.assertEqual(self.lines(), ["app.hits:5|c|#host:a"])
+        counter.inc(2)
+        r.report_now()
+        self.assertEqual(self.lines()[1:], ["app.hits:2|c|#host:a"])
+        # nothing changed, nothing is sent
+        r.report_now()
+        self.assertEqual(len(self.lines()), 2)
+
+    def test_decremented_counters_send_negative_deltas(self):
+        r = self.reporter()
+        counter = self.registry.counter("inflight")
+        counter.inc(10)
+        r.report_now()
+        counter.dec(2)
+        r.report_now()
+        self.assertEqual(self.lines(), ["inflight:10|c", "inflight:-2|c"])
+
+    def test_counts_start_over_when_registry_is_cleared(self):
+        r = self.reporter()
+        self.registry.counter("hits").inc(5)
+        r.report_now()
+        self.registry.clear()
+        self.registry.counter("hits").inc(2)
+        r.report_now()
+        self.assertEqual(self.lines(), ["hits:5|c", "hits:2|c"])
+
+    def test_counts_start_over_in_forked_child_with_reset_policy(self):
+        r = self.reporter()
+        self.registry.counter("hits").inc(5)
+        r.report_now()
+        self.registry.fork_policy = FORK_RESET
+        self.registry._after_fork_in_child()
+        r._after_fork_in_child()
+        self.registry.counter("hits").inc(2)
+        r.report_now()
+        self.assertEqual(self.lines()[-1], "hits:2|c")
+
+    def test_incremental_view_keeps_counts_of_unchanged_metrics(self):
+        r = self.reporter()
+        view = IncrementalRegistryView(self.registry, clock=self.clock)
+        hits = self.registry.counter("hits")
+        misses = self.registry.counter("misses")
+        hits.inc(5)
+        misses.inc(1)
+        r.report_now(view)
+        hits.inc(2)
+        r.report_now(view)
+        self.assertEqual(self.lines()[2:], ["hits:2|c"])
+        misses.inc(3)
+        r.report_now(view)
+        self.assertEqual(self.lines()[3:], ["misses:3|c"])
+
+    def test_gauges_and_histograms(self):
+        r = self.reporter(global_tags={"env": "test"})
+        self.registry.gauge("temp").set_value(-3)
+        hist = self.registry.histogram("size")
+        for value in (1, 2, 3):
+            hist.add(value)
+        self.registry.meter("reqs").mark(4)
+        self.clock.add(1)
+        r.report_now()
+        lines = self.lines()
+        self.assertIn("temp:-3|g|#env:test", lines)
+        self.assertIn("size.count:3|c|#env:test", lines)
+        self.assertIn("size.max:3|g|#env:test", lines)
+        self.assertIn("size.avg:2|g|#env:test", lines)
+        self.assertIn("reqs.count:4|c|#env:test", lines)
+        # the agent computes the rates
+        self.assertFalse([line for line in lines if "_rate" in line])
+
+    def test_plain_statsd_drops_tags_and_resets_negative_gauges(self):
+        r = self.reporter(dogstatsd=False)
+        self.registry.gauge("temp", tags={"host": "a"}).set_value(-3)
+        r.report_now()
+        self.assertEqual(self.lines(), ["temp:0|g", "temp:-3|g"])
+
+    def test_names_are_sanitized(self):
+        r = self.reporter()
+        self.registry.counter("a:b|c", tags={"k": "x,y"}).inc()
+        r.report_now()
+        self.assertEqual(self.lines(), ["a_b_c:1|c|#k:x_y"])
+
+    def test_lines_are_packed_into_packets(self):
+        r = self.reporter(max_packet_size=64)
+        for i in range(10):
+            self.registry.counter("counter%d" % i).inc()
+        r.report_now()
+        self.assertEqual(len(self.sockets), 1)
+        sock = self.sockets[0]
+        self.assertEqual(sock.address, ("127.0.0.1", 8125))
+        self.assertEqual(sock.kind, socket.SOCK_DGRAM)
+        self.assertFalse(sock.blocking)
+        self.assertEqual(len(self.lines()), 10)
+        self.assertGreater(len(sock.packets), 1)
+        for packet in sock.packets:
+            self.assertLessEqual(len(packet), 64)
+
+    def test_dropped_packets_are_counted(self):
+        r = self.reporter()
+        self.registry.counter("hits").inc()
+        r.report_now()
+        self.sockets[0].fail = True
+        self.registry.counter("hits").inc()
+        r.report_now()
+        self.assertEqual(self.registry.counter(DROPPED_PACKETS_METRIC).get_count(), 1)
+        # a full buffer does not drop the socket
+        self.assertEqual(len(self.sockets), 1)
+
+    def test_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), "statsd.sock")
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        server.bind(path)
+        try:
+            r = StatsdReporter(registry=self.registry, clock=self.clock, socket_path=path)
+            self.registry.counter("hits").inc(3)
+            r.report_now()
+            self.assertEqual(server.recv(8192), b"hits:3|c")
+            r.stop()
+        finally:
+            server.close()
+            os.unlink(path)
@@ -1,4 +1,5 @@
 # Copyright (c) 2023 Lightricks. All rights reserved.
+import gzip
 import os
 import shutil
 import tempfile
@@ -38,6 +39,27 @@ class LineProtocolReporterTests(unittest.TestCase):
             expected_lines = f.read()
         self.assertEqual(expected_lines, "test-counter count=1 1234567890")
 
+    def test_report_now_appends_to_segment(self) -> None:
+        reporter = LineProtocolReporter(
+            registry=self.registry, clock=self.clock, path=self.path, segments=True,
+            segment_compression="gzip"
+        )
+        counter = reporter.registry.counter("test-counter")
+        counter.inc()
+        reporter.report_now(timestamp=1234567890)
+        counter.inc()
+        reporter.report_now(timestamp=1234567900)
+
+        self.assertEqual([], list(Path(reporter.path).glob("*.txt*")))
+        reporter.stop()
+
+        files = list(Path(reporter.path).glob("*.txt.gz"))
+        self.assertEqual(1, len(files))
+        with gzip.open(files[0], "rt") as f:
+            self.assertEqual(
+                "test-counter count=1 1234567890\ntest-counter count=2 1234567900\n", f.read()
+            )
+
     def test_get_table_name_returns_metric_key_when_prefix_empty(self) -> None:
         reporter = LineProtocolReporter()
         table_name = reporter._get_table_name("metric_key")